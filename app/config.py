@@ -1,11 +1,55 @@
+import os
+from typing import List
 from pydantic import BaseModel
+from domain.notification import RateLimitRule
 
-class RateLimits(BaseModel):
-    status_count: int = 2
-    status_period: int = 60
-    news_count: int = 1
-    news_period: int = 86400
-    marketing_count: int = 3
-    marketing_period: int = 3600
+# Seeded into the shared rule store the first time a deployment starts; from then on the
+# stored, versioned configuration is authoritative. The algorithm is one of
+# domain.notification.RATE_LIMIT_STRATEGIES; sliding_log is exact, the others keep O(1) state.
+DEFAULT_RATE_LIMITS = {
+    'status': RateLimitRule(2, 60, 'sliding_log'),
+    'news': RateLimitRule(1, 86400, 'sliding_log'),
+    'marketing': RateLimitRule(3, 3600, 'sliding_log'),
+}
 
-rate_limits_config = RateLimits()
+class RedisSettings(BaseModel):
+    host: str = 'localhost'
+    port: int = 6379
+    max_connections: int = 50
+    pool_timeout: float = 5.0
+    socket_timeout: float = 5.0
+    socket_connect_timeout: float = 5.0
+    health_check_interval: int = 30
+    key_prefix: str = 'ratelimit'
+    clear_chunk_size: int = 1000
+    rules_poll_interval: float = 30.0
+    # host:port of every shard; empty means the single node at host and port
+    nodes: List[str] = []
+    # 'plain' or 'compact'; see infrastructure.redis_repository.KEY_ENCODINGS
+    key_encoding: str = 'plain'
+    # Deadline for each rate-limit check; slower or failing checks count against the circuit breaker
+    command_timeout: float = 0.5
+    breaker_failure_threshold: int = 5
+    breaker_reset_timeout: float = 5.0
+    # Processes limiting independently while Redis is unavailable; each allows 1/n of every limit
+    degraded_workers: int = 1
+
+def load_redis_settings():
+    return RedisSettings(
+        host=os.getenv('REDIS_HOST', 'localhost'),
+        port=int(os.getenv('REDIS_PORT', 6379)),
+        max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', 50)),
+        pool_timeout=float(os.getenv('REDIS_POOL_TIMEOUT', 5.0)),
+        socket_timeout=float(os.getenv('REDIS_SOCKET_TIMEOUT', 5.0)),
+        socket_connect_timeout=float(os.getenv('REDIS_SOCKET_CONNECT_TIMEOUT', 5.0)),
+        health_check_interval=int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', 30)),
+        key_prefix=os.getenv('REDIS_KEY_PREFIX', 'ratelimit'),
+        clear_chunk_size=int(os.getenv('REDIS_CLEAR_CHUNK_SIZE', 1000)),
+        rules_poll_interval=float(os.getenv('RULES_POLL_INTERVAL', 30)),
+        nodes=[node.strip() for node in os.getenv('REDIS_NODES', '').split(',') if node.strip()],
+        key_encoding=os.getenv('REDIS_KEY_ENCODING', 'plain'),
+        command_timeout=float(os.getenv('REDIS_COMMAND_TIMEOUT', 0.5)),
+        breaker_failure_threshold=int(os.getenv('REDIS_BREAKER_FAILURE_THRESHOLD', 5)),
+        breaker_reset_timeout=float(os.getenv('REDIS_BREAKER_RESET_TIMEOUT', 5.0)),
+        degraded_workers=int(os.getenv('DEGRADED_WORKERS', os.getenv('WEB_CONCURRENCY', 1))),
+    )
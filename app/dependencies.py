@@ -1,18 +1,325 @@
+import asyncio
+import logging
 import os
-from domain.notification import NotificationService
+import redis.asyncio
+from redis.exceptions import RedisError
+from domain.exceptions import RuleVersionConflictException
+from domain.notification import NotificationService, RuleTable
 from application.services import NotificationServiceApp
-from infrastructure.redis_repository import RedisRepository
-from app.config import rate_limits_config
+from infrastructure.async_redis_repository import AsyncRedisRepository
+from infrastructure.redis_repository import create_connection_pool
+from infrastructure.sharded_repository import AsyncShardedRedisRepository
+from infrastructure.deny_cache import DenyCache
+from infrastructure.memory_repository import AsyncInMemoryRepository
+from infrastructure.delivery_queue import DeliveryQueue, PrintSender
+from infrastructure.rule_store import RedisRuleStore, InMemoryRuleStore
+from infrastructure.deferred_schedule import RedisSchedule, InMemorySchedule, DeferredScheduler
+from infrastructure.circuit_breaker import CircuitBreaker, AsyncFallbackRepository
+from infrastructure.auth import token_cache
+from infrastructure.metrics import metrics
+from app.config import DEFAULT_RATE_LIMITS, load_redis_settings
 
-def get_notification_service_app():
-    redis_repository = RedisRepository(
-        redis_host=os.getenv('REDIS_HOST', 'localhost'),
-        redis_port=int(os.getenv('REDIS_PORT', 6379))
+logger = logging.getLogger(__name__)
+
+# Read-merge-write rounds of a field update before giving up on concurrent updates
+RULE_UPDATE_ATTEMPTS = 5
+
+# Built once per application lifetime by the FastAPI lifespan and shared by all requests
+_service_app = None
+_repository = None
+_rule_store = None
+_rule_watcher = None
+_delivery_queue = None
+_scheduler = None
+_scheduler_task = None
+_started = False
+
+def build_memory_repository():
+    return AsyncInMemoryRepository(
+        shards=int(os.getenv('MEMORY_SHARDS', 16)),
+        eviction_interval=float(os.getenv('MEMORY_EVICTION_INTERVAL', 30)),
+    )
+
+def guard_redis_repository(repository, settings, name):
+    """Wrap a Redis node so rate-limit checks fall back to a local limiter while it is slow or down."""
+    return AsyncFallbackRepository(
+        repository,
+        build_memory_repository(),
+        CircuitBreaker(settings.breaker_failure_threshold, settings.breaker_reset_timeout, name=name),
+        timeout=settings.command_timeout,
+        share=1 / max(1, settings.degraded_workers),
+    )
+
+def build_backend():
+    """Return the ``(repository, rule_store, schedule)`` of the configured ``RATE_LIMIT_BACKEND``;
+    the schedule is None when deferred sending is disabled.
+    """
+    backend = os.getenv('RATE_LIMIT_BACKEND', 'redis')
+    deferred_max_size = int(os.getenv('DEFERRED_MAX_SIZE', 100000))
+    if backend == 'memory':
+        repository = build_memory_repository()
+        schedule = InMemorySchedule(deferred_max_size) if deferred_max_size > 0 else None
+        return repository, InMemoryRuleStore(), schedule
+    if backend != 'redis':
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND {backend}")
+    settings = load_redis_settings()
+    if not settings.nodes:
+        node = AsyncRedisRepository(
+            connection_pool=create_connection_pool(settings, redis_module=redis.asyncio),
+            key_prefix=settings.key_prefix,
+            clear_chunk_size=settings.clear_chunk_size,
+            key_encoding=settings.key_encoding,
+        )
+        repository = guard_redis_repository(node, settings, f"{settings.host}:{settings.port}")
+        redis_client = node.redis_client
+    else:
+        shards = []
+        for node in settings.nodes:
+            host, _, port = node.rpartition(':')
+            shards.append(AsyncRedisRepository(
+                connection_pool=create_connection_pool(settings, host=host, port=int(port), redis_module=redis.asyncio),
+                key_prefix=settings.key_prefix,
+                clear_chunk_size=settings.clear_chunk_size,
+                key_encoding=settings.key_encoding,
+            ))
+        # One breaker per node, so a single failing node only degrades its own recipients
+        repository = AsyncShardedRedisRepository(
+            [guard_redis_repository(shard, settings, node) for shard, node in zip(shards, settings.nodes)], settings.nodes
+        )
+        # Rules and the deferred schedule are shared by all recipients; they stay on the first node instead of being sharded
+        redis_client = shards[0].redis_client
+    rule_store = RedisRuleStore(redis_client, settings.key_prefix, settings.rules_poll_interval)
+    schedule = None
+    if deferred_max_size > 0:
+        schedule = RedisSchedule(redis_client, settings.key_prefix, deferred_max_size, settings.command_timeout)
+    return repository, rule_store, schedule
+
+def build_delivery_queue():
+    queue_size = int(os.getenv('DELIVERY_QUEUE_SIZE', 10000))
+    if queue_size <= 0:
+        return None
+    return DeliveryQueue(
+        PrintSender(),
+        max_size=queue_size,
+        workers=int(os.getenv('DELIVERY_WORKERS', 4)),
+        batch_size=int(os.getenv('DELIVERY_BATCH_SIZE', 50)),
     )
-    rate_limits = {
-        'status': (rate_limits_config.status_count, rate_limits_config.status_period),
-        'news': (rate_limits_config.news_count, rate_limits_config.news_period),
-        'marketing': (rate_limits_config.marketing_count, rate_limits_config.marketing_period)
-    }
-    notification_service = NotificationService(redis_repository, rate_limits)
-    return NotificationServiceApp(notification_service)
+
+def init_notification_service_app():
+    global _service_app, _repository, _rule_store, _delivery_queue, _scheduler
+    if _service_app is None:
+        _repository, _rule_store, schedule = build_backend()
+        _delivery_queue = build_delivery_queue()
+        deny_cache_size = int(os.getenv('DENY_CACHE_SIZE', 10000))
+        deny_cache = DenyCache(deny_cache_size) if deny_cache_size > 0 else None
+        # Version 0 defaults apply until the shared configuration has been loaded
+        notification_service = NotificationService(
+            _repository, RuleTable(0, DEFAULT_RATE_LIMITS), deny_cache, _delivery_queue, metrics, schedule
+        )
+        if schedule is not None:
+            _scheduler = DeferredScheduler(
+                notification_service,
+                schedule,
+                interval=float(os.getenv('DEFERRED_POLL_INTERVAL', 1)),
+                batch_size=int(os.getenv('DEFERRED_BATCH_SIZE', 100)),
+                lease=float(os.getenv('DEFERRED_LEASE', 30)),
+                max_attempts=int(os.getenv('DEFERRED_MAX_ATTEMPTS', 10)),
+            )
+        _service_app = NotificationServiceApp(notification_service)
+        register_types(DEFAULT_RATE_LIMITS)
+    return _service_app
+
+def register_types(notification_types):
+    # Compact keys refuse filters whose key code belongs to another configured type
+    register = getattr(_repository, 'register_types', None)
+    if register is not None:
+        register(notification_types)
+
+def apply_rule_table(table):
+    # Updates can arrive both from this worker and through the watcher; never go backwards
+    if _service_app is not None and table.version > _service_app.notification_service.rate_limits.version:
+        register_types(table)
+        _service_app.notification_service.set_rate_limits(table)
+
+def clear_deny_cache():
+    if _service_app is not None and _service_app.notification_service.deny_cache is not None:
+        _service_app.notification_service.deny_cache.clear()
+
+async def start_notification_service_app():
+    # Called from the lifespan so background tasks run on the server's event loop. Every
+    # step is guarded, so it also completes a service that a sync helper built first.
+    global _rule_watcher, _scheduler_task, _started
+    init_notification_service_app()
+    _started = True
+    if _delivery_queue is not None:
+        _delivery_queue.start()
+    if _scheduler is not None and _scheduler_task is None:
+        _scheduler_task = asyncio.create_task(_scheduler.run())
+    if _rule_watcher is None:
+        try:
+            apply_rule_table(await _rule_store.seed(DEFAULT_RATE_LIMITS))
+        except (RedisError, OSError):
+            logger.warning("Could not load rate-limit rules, using defaults until Redis is reachable", exc_info=True)
+        _rule_watcher = asyncio.create_task(
+            _rule_store.watch(apply_rule_table, _service_app.notification_service.rate_limits.version, clear_deny_cache)
+        )
+
+async def close_notification_service_app():
+    global _service_app, _repository, _rule_store, _rule_watcher, _delivery_queue, _scheduler, _scheduler_task, _started
+    for task in (_rule_watcher, _scheduler_task):
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    if _delivery_queue is not None:
+        await _delivery_queue.drain(float(os.getenv('DELIVERY_DRAIN_TIMEOUT', 10)))
+    if _repository is not None:
+        await _repository.close()
+    _service_app = None
+    _repository = None
+    _rule_store = None
+    _rule_watcher = None
+    _delivery_queue = None
+    _scheduler = None
+    _scheduler_task = None
+    _started = False
+
+def get_rule_table():
+    return init_notification_service_app().notification_service.rate_limits
+
+async def update_rate_limit_rules(changes, expected_version=None):
+    """Store ``{notification_type: RateLimitRule or None}`` for every worker and apply it here right away.
+
+    With ``expected_version`` nothing is stored and ``None`` is returned if the stored rules
+    have another version.
+    """
+    init_notification_service_app()
+    # Raises ValueError before storing a table in which two types share a key code
+    current = _service_app.notification_service.rate_limits
+    register_types([name for name in current if name not in changes] + [name for name, rule in changes.items() if rule])
+    table = await _rule_store.update(changes, expected_version)
+    if table is not None:
+        apply_rule_table(table)
+    return table
+
+async def patch_rate_limit_rules(fields):
+    """Merge ``{notification_type: {field: value}}`` into the stored rules of every worker.
+
+    Each attempt reads the stored rules and writes them back only if no other update
+    landed in between, so concurrent updates of different fields of one type are kept.
+    """
+    init_notification_service_app()
+    for _ in range(RULE_UPDATE_ATTEMPTS):
+        stored = await _rule_store.load()
+        changes = {
+            notification_type: (stored.get(notification_type) or DEFAULT_RATE_LIMITS[notification_type])._replace(**changed)
+            for notification_type, changed in fields.items()
+        }
+        table = await update_rate_limit_rules(changes, stored.version)
+        if table is not None:
+            return table
+    raise RuleVersionConflictException("Rate-limit rules were changed concurrently, retry the update")
+
+async def clear_notifications(service_app, notification_type=None):
+    """Clear rate-limit state and make every worker drop its deny cache, whose blocks were
+    computed from the deleted keys. The rules and their version are left alone.
+    """
+    deleted = await service_app.clear_all_notifications_async(notification_type)
+    init_notification_service_app()
+    try:
+        await _rule_store.invalidate()
+    except (RedisError, OSError):
+        logger.warning("Could not announce the clear, other workers keep their deny caches until they expire", exc_info=True)
+    return deleted
+
+def get_pool_stats():
+    # None when the configured backend does not use a Redis connection pool
+    init_notification_service_app()
+    pool_stats = getattr(_repository, 'pool_stats', None)
+    return pool_stats() if pool_stats is not None else None
+
+def get_degraded_stats():
+    """Return the breaker stats of every Redis node, or None without Redis."""
+    init_notification_service_app()
+    nodes = [node for node in getattr(_repository, 'shards', [_repository]) if isinstance(node, AsyncFallbackRepository)]
+    return [node.degraded_stats() for node in nodes] or None
+
+async def get_memory_report(sample):
+    # None when the configured backend does not store rate limits in Redis
+    init_notification_service_app()
+    memory_report = getattr(_repository, 'memory_report', None)
+    return await memory_report(sample) if memory_report is not None else None
+
+async def migrate_keys():
+    """Move rate-limit keys of the plain layout into the compact one; None without Redis."""
+    init_notification_service_app()
+    migrate = getattr(_repository, 'migrate_keys', None)
+    return await migrate() if migrate is not None else None
+
+def get_delivery_queue_stats():
+    init_notification_service_app()
+    return _delivery_queue.stats() if _delivery_queue is not None else None
+
+async def get_notification_service_app():
+    # Declared async so FastAPI resolves it on the event loop instead of the threadpool.
+    # Checks _started rather than _service_app: /metrics and other sync helpers build the
+    # service without starting the rule watcher and the scheduler.
+    if not _started:
+        await start_notification_service_app()
+    return _service_app
+
+def get_runtime_metrics():
+    """Return ``(name, type, help, value)`` samples of the caches, queue and pool for ``/metrics``."""
+    notification_service = init_notification_service_app().notification_service
+    token_stats = token_cache.stats()
+    samples = [
+        ("token_cache_size", "gauge", "Verified tokens currently cached.", token_stats["size"]),
+        ("token_cache_hits_total", "counter", "Requests that skipped JWT verification.", token_stats["hits"]),
+        ("token_cache_misses_total", "counter", "Requests that verified a JWT signature.", token_stats["misses"]),
+        ("rate_limit_rules_version", "gauge", "Version of the rate-limit rule table in use.",
+         notification_service.rate_limits.version),
+    ]
+    if notification_service.deny_cache is not None:
+        samples.append(("deny_cache_hits_total", "counter", "Sends rejected without a repository call.",
+                        notification_service.deny_cache.hits))
+    if _delivery_queue is not None:
+        queue_stats = _delivery_queue.stats()
+        samples.extend([
+            ("delivery_queue_depth", "gauge", "Notifications waiting for delivery.", queue_stats["depth"]),
+            ("delivery_queue_reserved", "gauge", "Queue slots reserved by in-flight requests.", queue_stats["reserved"]),
+            ("delivery_queue_delivered_total", "counter", "Notifications delivered.", queue_stats["delivered"]),
+            ("delivery_queue_failed_total", "counter", "Notifications the sender failed to deliver.", queue_stats["failed"]),
+            ("delivery_queue_rejected_total", "counter", "Notifications rejected because the queue was full.",
+             queue_stats["rejected"]),
+            ("delivery_queue_wait_seconds_p99", "gauge", "99th percentile time spent queued.", queue_stats["wait_seconds_p99"]),
+            ("delivery_queue_send_seconds_p99", "gauge", "99th percentile provider send time.", queue_stats["send_seconds_p99"]),
+        ])
+    if _scheduler is not None:
+        scheduler_stats = _scheduler.stats()
+        samples.extend([
+            ("deferred_delivered_total", "counter", "Deferred notifications sent once due.", scheduler_stats["delivered"]),
+            ("deferred_rescheduled_total", "counter", "Due deferred notifications still over their limit.",
+             scheduler_stats["rescheduled"]),
+            ("deferred_dropped_total", "counter", "Deferred notifications given up on.", scheduler_stats["dropped"]),
+        ])
+    degraded_stats = get_degraded_stats()
+    if degraded_stats is not None:
+        samples.extend([
+            ("redis_circuit_open", "gauge", "Redis nodes whose circuit breaker is open or half-open.",
+             sum(stats["state"] != "closed" for stats in degraded_stats)),
+            ("redis_circuit_opened_total", "counter", "Times a Redis circuit breaker opened.",
+             sum(stats["opened"] for stats in degraded_stats)),
+            ("redis_degraded_seconds_total", "counter", "Node-seconds spent limiting locally instead of in Redis.",
+             sum(stats["degraded_seconds"] for stats in degraded_stats)),
+            ("rate_limit_fallback_checks_total", "counter", "Rate-limit checks answered by the local limiter.",
+             sum(stats["fallback_calls"] for stats in degraded_stats)),
+        ])
+    pool_stats = get_pool_stats()
+    if pool_stats is not None:
+        samples.append(
+            ("redis_pool_max_connections", "gauge", "Size of the Redis connection pool.", pool_stats["max_connections"])
+        )
+        if pool_stats["in_use_connections"] is not None:
+            samples.append(
+                ("redis_pool_in_use_connections", "gauge", "Redis connections checked out.", pool_stats["in_use_connections"])
+            )
+    return samples
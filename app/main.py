@@ -1,43 +1,200 @@
-from typing import Optional
+import json
+import math
+import re
+import time
+from typing import Dict, List, Optional
+from contextlib import asynccontextmanager
 from datetime import timedelta
-from fastapi import FastAPI, Depends, HTTPException, status, Body
+from fastapi import FastAPI, Depends, HTTPException, status, Body, Query
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 from application.services import NotificationServiceApp
-from domain.exceptions import RateLimitExceededException
-from app.dependencies import get_notification_service_app
-from app.config import rate_limits_config
+from domain.exceptions import RateLimitExceededException, DeliveryQueueFullException, RuleVersionConflictException
+from domain.notification import ALL_TYPES, RATE_LIMIT_STRATEGIES, RateLimitRule, DeferredNotification
+from app.dependencies import get_notification_service_app, start_notification_service_app, close_notification_service_app, get_rule_table, update_rate_limit_rules, patch_rate_limit_rules, clear_notifications, get_pool_stats, get_delivery_queue_stats, get_runtime_metrics, get_memory_report, migrate_keys
 from fastapi.staticfiles import StaticFiles
 from infrastructure.auth import authenticate_admin_user, create_access_token, get_current_active_user, Token, ACCESS_TOKEN_EXPIRE_MINUTES
+from infrastructure.metrics import metrics, ServerTimingMiddleware, PROMETHEUS_CONTENT_TYPE
 
 class NotificationRequest(BaseModel):
     notification_type: str = Field(..., json_schema_extra={"example": "status"})
     recipient: str = Field(..., json_schema_extra={"example": "user1@example.com"})
     message: str = Field(..., json_schema_extra={"example": "Status update 1"})
+    # None follows the defer setting of the type's rule
+    defer: Optional[bool] = Field(None, json_schema_extra={"example": None})
 
 class NotificationResponse(BaseModel):
     status: str = Field(..., json_schema_extra={"example": "success"})
     message: str = Field(..., json_schema_extra={"example": "Notification sent to user1@example.com"})
 
+class DeferredResponse(NotificationResponse):
+    deferred_id: str = Field(..., json_schema_extra={"example": "3f2b8c0e5d6a4f1e9b7c2a1d0e8f7a6b"})
+    scheduled_at: float = Field(..., json_schema_extra={"example": 1700000060.0})
+
+class DeferredNotificationModel(BaseModel):
+    id: str = Field(..., json_schema_extra={"example": "3f2b8c0e5d6a4f1e9b7c2a1d0e8f7a6b"})
+    notification_type: str = Field(..., json_schema_extra={"example": "status"})
+    recipient: str = Field(..., json_schema_extra={"example": "user1@example.com"})
+    message: str = Field(..., json_schema_extra={"example": "Status update 3"})
+    due_at: float = Field(..., json_schema_extra={"example": 1700000060.0})
+    deferred_at: float = Field(..., json_schema_extra={"example": 1700000012.5})
+    attempts: int = Field(..., json_schema_extra={"example": 0})
+
+class DeferredListResponse(BaseModel):
+    total: int = Field(..., json_schema_extra={"example": 1})
+    items: List[DeferredNotificationModel]
+
+class ClearNotificationsResponse(NotificationResponse):
+    deleted: int = Field(..., json_schema_extra={"example": 42})
+
 class ErrorResponse(BaseModel):
     detail: str = Field(..., json_schema_extra={"example": "Rate limit exceeded for status to user1@example.com"})
 
 class RateLimitUpdateRequest(BaseModel):
-    status_count: Optional[int] = Field(None, json_schema_extra={"example": 2})
-    status_period: Optional[int] = Field(None, json_schema_extra={"example": 60})
-    news_count: Optional[int] = Field(None, json_schema_extra={"example": 1})
-    news_period: Optional[int] = Field(None, json_schema_extra={"example": 86400})
-    marketing_count: Optional[int] = Field(None, json_schema_extra={"example": 3})
-    marketing_period: Optional[int] = Field(None, json_schema_extra={"example": 3600})
+    status_count: Optional[int] = Field(None, gt=0, json_schema_extra={"example": 2})
+    status_period: Optional[int] = Field(None, gt=0, json_schema_extra={"example": 60})
+    news_count: Optional[int] = Field(None, gt=0, json_schema_extra={"example": 1})
+    news_period: Optional[int] = Field(None, gt=0, json_schema_extra={"example": 86400})
+    marketing_count: Optional[int] = Field(None, gt=0, json_schema_extra={"example": 3})
+    marketing_period: Optional[int] = Field(None, gt=0, json_schema_extra={"example": 3600})
+    status_algorithm: Optional[str] = Field(None, json_schema_extra={"example": "sliding_log"})
+    news_algorithm: Optional[str] = Field(None, json_schema_extra={"example": "gcra"})
+    marketing_algorithm: Optional[str] = Field(None, json_schema_extra={"example": "sliding_window"})
+
+class PoolStatsResponse(BaseModel):
+    max_connections: int = Field(..., json_schema_extra={"example": 50})
+    created_connections: Optional[int] = Field(None, json_schema_extra={"example": 12})
+    idle_connections: Optional[int] = Field(None, json_schema_extra={"example": 10})
+    in_use_connections: Optional[int] = Field(None, json_schema_extra={"example": 2})
+
+class KeyLayoutUsage(BaseModel):
+    keys: int = Field(..., json_schema_extra={"example": 1000})
+    bytes: int = Field(..., json_schema_extra={"example": 96000})
+
+class MemoryReportResponse(BaseModel):
+    encoding: str = Field(..., json_schema_extra={"example": "compact"})
+    used_memory: int = Field(..., json_schema_extra={"example": 104857600})
+    db_keys: int = Field(..., json_schema_extra={"example": 1200000})
+    sampled_keys: int = Field(..., json_schema_extra={"example": 1000})
+    sampled_bytes: int = Field(..., json_schema_extra={"example": 96000})
+    average_key_bytes: float = Field(..., json_schema_extra={"example": 96.0})
+    layouts: Dict[str, KeyLayoutUsage]
+
+class MigrateKeysResponse(NotificationResponse):
+    migrated: int = Field(..., json_schema_extra={"example": 42})
+
+class DeliveryQueueStatsResponse(BaseModel):
+    depth: int = Field(..., json_schema_extra={"example": 12})
+    max_size: int = Field(..., json_schema_extra={"example": 10000})
+    reserved: int = Field(..., json_schema_extra={"example": 1})
+    workers: int = Field(..., json_schema_extra={"example": 4})
+    delivered: int = Field(..., json_schema_extra={"example": 1520})
+    failed: int = Field(..., json_schema_extra={"example": 0})
+    rejected: int = Field(..., json_schema_extra={"example": 0})
+    wait_seconds_p50: float = Field(..., json_schema_extra={"example": 0.002})
+    wait_seconds_p99: float = Field(..., json_schema_extra={"example": 0.05})
+    send_seconds_p50: float = Field(..., json_schema_extra={"example": 0.01})
+    send_seconds_p99: float = Field(..., json_schema_extra={"example": 0.2})
+
+class BatchItemResult(BaseModel):
+    index: int = Field(..., json_schema_extra={"example": 0})
+    status_code: int = Field(..., json_schema_extra={"example": 200})
+    message: Optional[str] = Field(None, json_schema_extra={"example": "Notification sent to user1@example.com"})
+    detail: Optional[str] = Field(None, json_schema_extra={"example": None})
+    retry_after: Optional[int] = Field(None, json_schema_extra={"example": None})
+    rule: Optional[str] = Field(None, json_schema_extra={"example": None})
+    deferred_id: Optional[str] = Field(None, json_schema_extra={"example": None})
+    scheduled_at: Optional[float] = Field(None, json_schema_extra={"example": None})
+
+class BatchNotificationResponse(BaseModel):
+    results: List[BatchItemResult]
+
+MAX_BATCH_SIZE = 1000
+
+class RateLimitWindowModel(BaseModel):
+    max_count: int = Field(..., gt=0, json_schema_extra={"example": 20})
+    period: int = Field(..., gt=0, json_schema_extra={"example": 86400})
+
+class RateLimitRuleModel(BaseModel):
+    max_count: int = Field(..., gt=0, json_schema_extra={"example": 2})
+    period: int = Field(..., gt=0, json_schema_extra={"example": 60})
+    algorithm: str = Field("sliding_log", json_schema_extra={"example": "sliding_log"})
+    windows: List[RateLimitWindowModel] = Field([], json_schema_extra={"example": [{"max_count": 20, "period": 86400}]})
+    defer: bool = Field(False, json_schema_extra={"example": False})
+
+    @model_validator(mode="after")
+    def check_distinct_periods(self):
+        periods = [self.period] + [window.period for window in self.windows]
+        if len(set(periods)) != len(periods):
+            raise ValueError("Every window of a rule needs a different period")
+        return self
+
+class RuleTableResponse(BaseModel):
+    version: int = Field(..., json_schema_extra={"example": 3})
+    rules: Dict[str, RateLimitRuleModel]
+
+class RateLimitsResponse(RateLimitUpdateRequest):
+    version: int = Field(..., json_schema_extra={"example": 3})
+    rules: Dict[str, RateLimitRuleModel]
+
+# Types configurable through the flat fields of RateLimitUpdateRequest
+LEGACY_RATE_LIMIT_TYPES = ('status', 'news', 'marketing')
+NOTIFICATION_TYPE_PATTERN = re.compile(r'[A-Za-z0-9_.-]+')
+
+def rule_response(rule):
+    return dict(rule._asdict(), windows=[{"max_count": max_count, "period": period} for max_count, period in rule.windows])
+
+def rule_table_response(table):
+    return {"version": table.version, "rules": {notification_type: rule_response(rule) for notification_type, rule in table.items()}}
+
+def check_algorithm(algorithm: Optional[str]):
+    if algorithm is not None and algorithm not in RATE_LIMIT_STRATEGIES:
+        raise HTTPException(status_code=400, detail=f"Unknown rate limit algorithm {algorithm}")
+
+def rate_limit_headers(exc: RateLimitExceededException):
+    headers = {}
+    if exc.retry_after is not None:
+        headers["Retry-After"] = str(math.ceil(exc.retry_after))
+    if exc.rule is not None:
+        headers["X-RateLimit-Rule"] = exc.rule
+    return headers or None
+
+def deferred_response(deferred: DeferredNotification):
+    return {
+        "status": "deferred",
+        "message": f"Notification to {deferred.recipient} deferred until its rate limit frees up",
+        "deferred_id": deferred.id,
+        "scheduled_at": deferred.due_at,
+    }
+
+def metric_type(notification_type: str):
+    # Label values come from client input; fold unknown types into one series
+    return notification_type if notification_type != ALL_TYPES and notification_type in get_rule_table() else "other"
+
+def is_valid_recipient(recipient: str):
+    recipient = recipient.strip()
+    return bool(recipient) and "@" in recipient
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_notification_service_app()
+    yield
+    await close_notification_service_app()
 
 app = FastAPI(
     title="Notification API",
     description="API for sending notifications with rate limiting and JWT authentication",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+if metrics.server_timing:
+    app.add_middleware(ServerTimingMiddleware, metrics=metrics)
+
 @app.post("/token", response_model=Token, summary="Login for access token", description="Login using the admin credentials to obtain a JWT access token.")
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     user = authenticate_admin_user(form_data.username, form_data.password)
@@ -55,14 +212,19 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 @app.post("/send-notification/",
           summary="Send a notification",
-          description="Send a notification to a specified recipient. Requires JWT authentication.",
+          description="Send a notification to a specified recipient. With `defer` (or a rule with `defer`), an over-limit "
+                      "notification is scheduled for when its window frees up and answered with `202` instead of `429`. "
+                      "Requires JWT authentication.",
           responses={
               200: {"description": "Notification sent successfully", "model": NotificationResponse},
+              202: {"description": "Notification deferred until its rate limit frees up", "model": DeferredResponse},
               400: {"description": "Invalid request", "model": ErrorResponse},
               429: {"description": "Rate limit exceeded", "model": ErrorResponse},
-              401: {"description": "Unauthorized", "model": ErrorResponse}
+              401: {"description": "Unauthorized", "model": ErrorResponse},
+              503: {"description": "Delivery queue is full", "model": ErrorResponse}
           })
-def send_notification(
+async def send_notification(
+    response: Response,
     request: NotificationRequest = Body(..., json_schema_extra={"example":{
         "notification_type": "status",
         "recipient": "user1@example.com",
@@ -71,77 +233,386 @@ def send_notification(
     service: NotificationServiceApp = Depends(get_notification_service_app),
     current_user: dict = Depends(get_current_active_user)
 ):
+    if not metrics.enabled:
+        return await send_one(request, service, response)
+    started = time.perf_counter()
+    outcome = 500
+    try:
+        result = await send_one(request, service, response)
+        outcome = response.status_code or 200
+        return result
+    except HTTPException as e:
+        outcome = e.status_code
+        raise
+    finally:
+        metrics.record_send(metric_type(request.notification_type), outcome, started)
+
+async def send_one(request: NotificationRequest, service: NotificationServiceApp, response: Response):
     # External validation for the request
-    recipient = request.recipient.strip()
-    if not recipient or "@" not in recipient:
+    with metrics.stage('validation'):
+        valid = is_valid_recipient(request.recipient)
+    if not valid:
         raise HTTPException(status_code=400, detail="Invalid recipient email") 
     
     try:
-        service.send_notification(request.notification_type, request.recipient, request.message)
+        result = await service.send_notification_async(
+            request.notification_type, request.recipient, request.message, request.defer
+        )
+        if isinstance(result, DeferredNotification):
+            response.status_code = 202
+            return deferred_response(result)
         return {"status": "success", "message": f"Notification sent to {request.recipient}"}
     except RateLimitExceededException as e:
-        raise HTTPException(status_code=429, detail=str(e))
+        raise HTTPException(status_code=429, detail=str(e), headers=rate_limit_headers(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except DeliveryQueueFullException as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+@app.post("/send-notification/batch/",
+          summary="Send a batch of notifications",
+          description="Send several notifications at once. Rate limits for the whole batch are evaluated in one Redis round trip and each item gets its own status code (200, 202 when deferred, 400, 429 or 503). Requires JWT authentication.",
+          response_model=BatchNotificationResponse,
+          responses={
+              200: {"description": "Batch processed; see the per-item status codes", "model": BatchNotificationResponse},
+              400: {"description": "Invalid request", "model": ErrorResponse},
+              401: {"description": "Unauthorized", "model": ErrorResponse}
+          })
+async def send_notification_batch(
+    requests: List[NotificationRequest] = Body(..., json_schema_extra={"example": [
+        {"notification_type": "status", "recipient": "user1@example.com", "message": "Status update 1"},
+        {"notification_type": "news", "recipient": "user2@example.com", "message": "News update 1"}
+    ]}),
+    service: NotificationServiceApp = Depends(get_notification_service_app),
+    current_user: dict = Depends(get_current_active_user)
+):
+    if len(requests) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Batch size exceeds {MAX_BATCH_SIZE} notifications")
+
+    results = [None] * len(requests)
+    accepted = []
+    for index, request in enumerate(requests):
+        if is_valid_recipient(request.recipient):
+            accepted.append(index)
+        else:
+            results[index] = {"index": index, "status_code": 400, "detail": "Invalid recipient email"}
+
+    outcomes = await service.send_notifications_async(
+        [(requests[index].notification_type, requests[index].recipient, requests[index].message) for index in accepted],
+        [requests[index].defer for index in accepted]
+    ) if accepted else []
+    for index, outcome in zip(accepted, outcomes):
+        if isinstance(outcome, DeferredNotification):
+            results[index] = {"index": index, "status_code": 202, "message": deferred_response(outcome)["message"],
+                              "deferred_id": outcome.id, "scheduled_at": outcome.due_at}
+        elif isinstance(outcome, RateLimitExceededException):
+            retry_after = math.ceil(outcome.retry_after) if outcome.retry_after is not None else None
+            results[index] = {"index": index, "status_code": 429, "detail": str(outcome), "retry_after": retry_after, "rule": outcome.rule}
+        elif isinstance(outcome, ValueError):
+            results[index] = {"index": index, "status_code": 400, "detail": str(outcome)}
+        elif isinstance(outcome, DeliveryQueueFullException):
+            results[index] = {"index": index, "status_code": 503, "detail": str(outcome), "retry_after": 1}
+        else:
+            results[index] = {"index": index, "status_code": 200, "message": f"Notification sent to {requests[index].recipient}"}
+    if metrics.enabled:
+        for request, result in zip(requests, results):
+            metrics.count_send(metric_type(request.notification_type), result["status_code"])
+    return {"results": results}
 
 @app.put("/rate-limits/", 
          summary="Update rate limits", 
-         description="Update the rate limits for notifications. Requires JWT authentication.",
+         description="Update the rate limits for notifications. Each type can use the exact `sliding_log` algorithm "
+                     "or the constant-memory `gcra` and `sliding_window` algorithms. Requires JWT authentication.",
          responses={
              200: {"description": "Rate limits updated successfully", "model": NotificationResponse},
              400: {"description": "Invalid request", "model": ErrorResponse},
-             401: {"description": "Unauthorized", "model": ErrorResponse}
+             401: {"description": "Unauthorized", "model": ErrorResponse},
+             409: {"description": "The rules kept changing concurrently", "model": ErrorResponse}
          })
-def update_rate_limits(
+async def update_rate_limits(
     rate_limit_update: RateLimitUpdateRequest,
     current_user: dict = Depends(get_current_active_user)
 ):
-    if rate_limit_update.status_count is not None:
-        rate_limits_config.status_count = rate_limit_update.status_count
-    if rate_limit_update.status_period is not None:
-        rate_limits_config.status_period = rate_limit_update.status_period
-    if rate_limit_update.news_count is not None:
-        rate_limits_config.news_count = rate_limit_update.news_count
-    if rate_limit_update.news_period is not None:
-        rate_limits_config.news_period = rate_limit_update.news_period
-    if rate_limit_update.marketing_count is not None:
-        rate_limits_config.marketing_count = rate_limit_update.marketing_count
-    if rate_limit_update.marketing_period is not None:
-        rate_limits_config.marketing_period = rate_limit_update.marketing_period
+    update = rate_limit_update.model_dump()
+    changes = {}
+    for notification_type in LEGACY_RATE_LIMIT_TYPES:
+        check_algorithm(update[f"{notification_type}_algorithm"])
+        fields = {
+            field: update[f"{notification_type}_{name}"]
+            for field, name in (("max_count", "count"), ("period", "period"), ("algorithm", "algorithm"))
+            if update[f"{notification_type}_{name}"] is not None
+        }
+        if fields:
+            changes[notification_type] = fields
+    if changes:
+        # Merged into the stored rules, so updates of other fields from other workers are kept
+        try:
+            await patch_rate_limit_rules(changes)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except RuleVersionConflictException as e:
+            raise HTTPException(status_code=409, detail=str(e))
     return {"status": "success", "message": "Rate limits updated successfully"}
 
 @app.delete("/notifications", 
             summary="Clear all notifications",
-            description="Clear all notifications. Requires JWT authentication.",
+            description="Clear all notifications, or only those of `notification_type` when given. Keys are removed incrementally "
+                        "without blocking Redis and the number of deleted keys is reported. Requires JWT authentication.",
             responses={
-                200: {"description": "All notifications cleared successfully", "model": NotificationResponse},
+                200: {"description": "All notifications cleared successfully", "model": ClearNotificationsResponse},
+                400: {"description": "Invalid notification type", "model": ErrorResponse},
                 401: {"description": "Unauthorized", "model": ErrorResponse}
             })
-def clear_all_notifications(service: NotificationServiceApp = Depends(get_notification_service_app), current_user: dict = Depends(get_current_active_user)):
-    service.clear_all_notifications()
-    return {"status": "success", "message": "All notifications cleared successfully"}
+async def clear_all_notifications(notification_type: Optional[str] = None, service: NotificationServiceApp = Depends(get_notification_service_app), current_user: dict = Depends(get_current_active_user)):
+    try:
+        deleted = await clear_notifications(service, notification_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    scope = f"{notification_type} " if notification_type else ""
+    return {"status": "success", "message": f"All {scope}notifications cleared successfully", "deleted": deleted}
 
 @app.get("/rate-limits/", summary="Get rate limits", description="Fetch the current rate limits.", responses={
-    200: {"description": "Rate limits fetched successfully", "model": RateLimitUpdateRequest},
+    200: {"description": "Rate limits fetched successfully", "model": RateLimitsResponse},
     401: {"description": "Unauthorized", "model": ErrorResponse}
 })
-def get_rate_limits(current_user: dict = Depends(get_current_active_user)):
-    return {
-        "status_count": rate_limits_config.status_count,
-        "status_period": rate_limits_config.status_period,
-        "news_count": rate_limits_config.news_count,
-        "news_period": rate_limits_config.news_period,
-        "marketing_count": rate_limits_config.marketing_count,
-        "marketing_period": rate_limits_config.marketing_period
-    }
+async def get_rate_limits(current_user: dict = Depends(get_current_active_user)):
+    table = get_rule_table()
+    response = rule_table_response(table)
+    for notification_type in LEGACY_RATE_LIMIT_TYPES:
+        rule = table.get(notification_type)
+        response[f"{notification_type}_count"] = rule.max_count if rule else None
+        response[f"{notification_type}_period"] = rule.period if rule else None
+        response[f"{notification_type}_algorithm"] = rule.algorithm if rule else None
+    return response
+
+@app.get("/rate-limits/rules",
+         summary="Get rate limit rules",
+         description="Fetch the rate limit rule of every notification type together with the configuration version. Requires JWT authentication.",
+         response_model=RuleTableResponse,
+         responses={
+             401: {"description": "Unauthorized", "model": ErrorResponse}
+         })
+async def get_rate_limit_rules(current_user: dict = Depends(get_current_active_user)):
+    return rule_table_response(get_rule_table())
+
+@app.put("/rate-limits/rules/{notification_type}",
+         summary="Create or update a rate limit rule",
+         description="Set the rate limit of any notification type, creating the type if needed. Extra `windows` are enforced "
+                     "together with the first one, e.g. 2 per minute and 20 per day. The `*` rule caps each recipient across "
+                     "all types. With `defer`, over-limit notifications of the type are scheduled instead of rejected unless a request "
+                     "sets `defer` itself. The change is stored in Redis and pushed to every worker. Requires JWT authentication.",
+         response_model=RuleTableResponse,
+         responses={
+             400: {"description": "Invalid request", "model": ErrorResponse},
+             401: {"description": "Unauthorized", "model": ErrorResponse}
+         })
+async def put_rate_limit_rule(notification_type: str, rule: RateLimitRuleModel, current_user: dict = Depends(get_current_active_user)):
+    check_algorithm(rule.algorithm)
+    # Stored counters use ':' and '@' as separators and '{}' as the hash tag, and SCAN filters treat '*?[]' as globs
+    if notification_type != ALL_TYPES and not NOTIFICATION_TYPE_PATTERN.fullmatch(notification_type):
+        raise HTTPException(
+            status_code=400, detail="Notification types may only contain letters, digits, '_', '.' and '-'"
+        )
+    windows = tuple((window.max_count, window.period) for window in rule.windows)
+    try:
+        table = await update_rate_limit_rules({notification_type: RateLimitRule(rule.max_count, rule.period, rule.algorithm, windows, rule.defer)})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return rule_table_response(table)
+
+@app.delete("/rate-limits/rules/{notification_type}",
+            summary="Delete a rate limit rule",
+            description="Remove a notification type; sending it is rejected afterwards. Requires JWT authentication.",
+            response_model=RuleTableResponse,
+            responses={
+                401: {"description": "Unauthorized", "model": ErrorResponse},
+                404: {"description": "Unknown notification type", "model": ErrorResponse}
+            })
+async def delete_rate_limit_rule(notification_type: str, current_user: dict = Depends(get_current_active_user)):
+    if notification_type not in get_rule_table():
+        raise HTTPException(status_code=404, detail="Unknown notification type")
+    table = await update_rate_limit_rules({notification_type: None})
+    return rule_table_response(table)
 
 @app.get("/usage/",
          summary="Get all users notification usage",
-         description="Fetch the notification usage for all users. Requires JWT authentication.",
+         description="Fetch the notification usage for all users, optionally filtered by notification type or recipient prefix. "
+                     "A type filter also covers the type's extra windows (`<type>@<period>`), and `*` the cross-type windows. "
+                     "Pass `cursor` (0 to start) to page through the results instead of fetching them all at once; "
+                     "the response then contains the cursor of the next page, which is 0 after the last page. A key may appear on "
+                     "more than one page with the same count, so merge pages by key. Requires JWT authentication.",
          responses={
              200: {"description": "All users usage fetched successfully"},
+             400: {"description": "Invalid notification type", "model": ErrorResponse},
+             401: {"description": "Unauthorized", "model": ErrorResponse}
+         })
+async def get_all_users_usage(
+    cursor: Optional[int] = Query(None, ge=0),
+    limit: int = Query(500, ge=1, le=10000),
+    notification_type: Optional[str] = None,
+    recipient_prefix: Optional[str] = None,
+    service: NotificationServiceApp = Depends(get_notification_service_app),
+    current_user: dict = Depends(get_current_active_user)
+):
+    try:
+        if cursor is not None:
+            next_cursor, usage = await service.get_usage_page_async(cursor, limit, notification_type, recipient_prefix)
+            return {"cursor": next_cursor, "usage": usage}
+        return await service.get_all_usage_async(notification_type, recipient_prefix)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/usage/stream",
+         summary="Stream all users notification usage",
+         description="Stream the notification usage for all users as newline-delimited JSON, one recipient and type per line. "
+                     "Keys are read with SCAN, so a recipient and type can occasionally appear twice. Requires JWT authentication.",
+         response_class=StreamingResponse,
+         responses={
+             200: {"description": "Usage streamed successfully", "content": {"application/x-ndjson": {}}},
+             400: {"description": "Invalid notification type", "model": ErrorResponse},
              401: {"description": "Unauthorized", "model": ErrorResponse}
          })
-def get_all_users_usage(service: NotificationServiceApp = Depends(get_notification_service_app), current_user: dict = Depends(get_current_active_user)):
-    usage = service.get_all_usage()
-    return usage
\ No newline at end of file
+async def stream_all_users_usage(
+    notification_type: Optional[str] = None,
+    recipient_prefix: Optional[str] = None,
+    service: NotificationServiceApp = Depends(get_notification_service_app),
+    current_user: dict = Depends(get_current_active_user)
+):
+    usage = service.iter_usage_async(notification_type, recipient_prefix)
+    # Fetch the first item before the response starts, so an invalid filter still gets a 400
+    try:
+        first = [await usage.__anext__()]
+    except StopAsyncIteration:
+        first = []
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    def usage_line(key, count):
+        recipient, key_type = key.rsplit(":", 1)
+        return json.dumps({"recipient": recipient, "notification_type": key_type, "count": count}) + "\n"
+
+    async def usage_lines():
+        for key, count in first:
+            yield usage_line(key, count)
+        async for key, count in usage:
+            yield usage_line(key, count)
+    return StreamingResponse(usage_lines(), media_type="application/x-ndjson")
+
+@app.get("/deferred/",
+         summary="List deferred notifications",
+         description="Fetch the pending deferred notifications, soonest due first, `limit` at a time from `offset`. Requires JWT authentication.",
+         response_model=DeferredListResponse,
+         responses={
+             401: {"description": "Unauthorized", "model": ErrorResponse}
+         })
+async def list_deferred_notifications(
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    service: NotificationServiceApp = Depends(get_notification_service_app),
+    current_user: dict = Depends(get_current_active_user)
+):
+    total, items = await service.list_deferred_async(offset, limit)
+    return {"total": total, "items": [item._asdict() for item in items]}
+
+@app.get("/deferred/{deferred_id}",
+         summary="Get a deferred notification",
+         description="Fetch one pending deferred notification. Requires JWT authentication.",
+         response_model=DeferredNotificationModel,
+         responses={
+             401: {"description": "Unauthorized", "model": ErrorResponse},
+             404: {"description": "Unknown or already sent", "model": ErrorResponse}
+         })
+async def get_deferred_notification(deferred_id: str, service: NotificationServiceApp = Depends(get_notification_service_app), current_user: dict = Depends(get_current_active_user)):
+    item = await service.get_deferred_async(deferred_id)
+    if item is None:
+        raise HTTPException(status_code=404, detail="Unknown deferred notification")
+    return item._asdict()
+
+@app.delete("/deferred/{deferred_id}",
+            summary="Cancel a deferred notification",
+            description="Remove a pending deferred notification so it is never sent. Requires JWT authentication.",
+            responses={
+                200: {"description": "Deferred notification cancelled", "model": NotificationResponse},
+                401: {"description": "Unauthorized", "model": ErrorResponse},
+                404: {"description": "Unknown or already sent", "model": ErrorResponse}
+            })
+async def cancel_deferred_notification(deferred_id: str, service: NotificationServiceApp = Depends(get_notification_service_app), current_user: dict = Depends(get_current_active_user)):
+    if not await service.cancel_deferred_async(deferred_id):
+        raise HTTPException(status_code=404, detail="Unknown deferred notification")
+    return {"status": "success", "message": f"Deferred notification {deferred_id} cancelled"}
+
+@app.get("/redis-pool/",
+         summary="Get Redis connection pool statistics",
+         description="Fetch the shared Redis connection pool usage for capacity planning. Requires JWT authentication.",
+         responses={
+             200: {"description": "Pool statistics fetched successfully", "model": PoolStatsResponse},
+             401: {"description": "Unauthorized", "model": ErrorResponse},
+             404: {"description": "The rate-limit backend does not use Redis", "model": ErrorResponse}
+         })
+async def get_redis_pool_stats(current_user: dict = Depends(get_current_active_user)):
+    stats = get_pool_stats()
+    if stats is None:
+        raise HTTPException(status_code=404, detail="No Redis connection pool in use")
+    return stats
+
+@app.get("/redis-memory/",
+         summary="Get Redis memory usage of rate-limit keys",
+         description="Measure `MEMORY USAGE` of up to `sample` rate-limit keys per Redis node, grouped by key layout "
+                     "(`plain`, `compact` and the `directory` hashes of the compact encoding), together with the nodes' "
+                     "`used_memory` and key counts. Requires JWT authentication.",
+         response_model=MemoryReportResponse,
+         responses={
+             401: {"description": "Unauthorized", "model": ErrorResponse},
+             404: {"description": "The rate-limit backend does not use Redis", "model": ErrorResponse}
+         })
+async def get_redis_memory(sample: int = Query(1000, ge=1, le=100000), current_user: dict = Depends(get_current_active_user)):
+    report = await get_memory_report(sample)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Rate limits are not stored in Redis")
+    report["average_key_bytes"] = report["sampled_bytes"] / report["sampled_keys"] if report["sampled_keys"] else 0.0
+    return report
+
+@app.post("/redis-memory/migrate",
+          summary="Migrate rate-limit keys to the compact encoding",
+          description="Move every rate-limit key of the plain layout into the compact one, keeping its counters. Run it "
+                      "once every worker uses `REDIS_KEY_ENCODING=compact`. Keys are moved incrementally without blocking "
+                      "Redis. Requires JWT authentication.",
+          responses={
+              200: {"description": "Keys migrated", "model": MigrateKeysResponse},
+              400: {"description": "The compact encoding is not enabled", "model": ErrorResponse},
+              401: {"description": "Unauthorized", "model": ErrorResponse},
+              404: {"description": "The rate-limit backend does not use Redis", "model": ErrorResponse}
+          })
+async def migrate_redis_keys(current_user: dict = Depends(get_current_active_user)):
+    try:
+        migrated = await migrate_keys()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if migrated is None:
+        raise HTTPException(status_code=404, detail="Rate limits are not stored in Redis")
+    return {"status": "success", "message": f"Migrated {migrated} keys to the compact encoding", "migrated": migrated}
+
+@app.get("/delivery-queue/",
+         summary="Get delivery queue statistics",
+         description="Fetch the depth, throughput and latency of the asynchronous delivery queue for monitoring. Requires JWT authentication.",
+         responses={
+             200: {"description": "Delivery queue statistics fetched successfully", "model": DeliveryQueueStatsResponse},
+             401: {"description": "Unauthorized", "model": ErrorResponse},
+             404: {"description": "Notifications are delivered inline", "model": ErrorResponse}
+         })
+async def get_delivery_queue(current_user: dict = Depends(get_current_active_user)):
+    stats = get_delivery_queue_stats()
+    if stats is None:
+        raise HTTPException(status_code=404, detail="No delivery queue in use")
+    return stats
+
+@app.get("/metrics",
+         summary="Get Prometheus metrics",
+         description="Export per-stage latency histograms, per-type outcome counters and cache, queue and pool statistics "
+                     "in the Prometheus text format. Latency metrics are collected only with `METRICS_ENABLED=1`.",
+         response_class=Response,
+         responses={
+             200: {"description": "Metrics exported successfully", "content": {PROMETHEUS_CONTENT_TYPE: {}}}
+         })
+async def get_metrics():
+    return Response(metrics.render(get_runtime_metrics()), media_type=PROMETHEUS_CONTENT_TYPE)
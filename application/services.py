@@ -5,10 +5,46 @@ class NotificationServiceApp:
     def send_notification(self, notification_type, recipient, message):
         # strip leading and trailing whitespaces
         recipient = recipient.strip()
-        self.notification_service.send(notification_type, recipient, message)
+        return self.notification_service.send(notification_type, recipient, message)
 
-    def clear_all_notifications(self):
-        self.notification_service.clear_all_notifications()
+    async def send_notification_async(self, notification_type, recipient, message, defer=None):
+        recipient = recipient.strip()
+        return await self.notification_service.send_async(notification_type, recipient, message, defer)
+
+    def send_notifications(self, notifications):
+        return self.notification_service.send_batch(
+            [(notification_type, recipient.strip(), message) for notification_type, recipient, message in notifications]
+        )
+
+    async def send_notifications_async(self, notifications, defer=None):
+        return await self.notification_service.send_batch_async(
+            [(notification_type, recipient.strip(), message) for notification_type, recipient, message in notifications],
+            defer
+        )
+
+    def clear_all_notifications(self, notification_type=None):
+        return self.notification_service.clear_all_notifications(notification_type)
+
+    async def clear_all_notifications_async(self, notification_type=None):
+        return await self.notification_service.clear_all_notifications_async(notification_type)
+
+    def get_all_usage(self, notification_type=None, recipient_prefix=None):
+        return self.notification_service.get_all_usage(notification_type, recipient_prefix)
+
+    async def get_all_usage_async(self, notification_type=None, recipient_prefix=None):
+        return await self.notification_service.get_all_usage_async(notification_type, recipient_prefix)
+
+    async def get_usage_page_async(self, cursor, count, notification_type=None, recipient_prefix=None):
+        return await self.notification_service.get_usage_page_async(cursor, count, notification_type, recipient_prefix)
+
+    def iter_usage_async(self, notification_type=None, recipient_prefix=None):
+        return self.notification_service.iter_usage_async(notification_type, recipient_prefix)
+
+    async def list_deferred_async(self, offset=0, count=100):
+        return await self.notification_service.list_deferred_async(offset, count)
+
+    async def get_deferred_async(self, deferred_id):
+        return await self.notification_service.get_deferred_async(deferred_id)
 
-    def get_all_usage(self):
-        return self.notification_service.get_all_usage()
+    async def cancel_deferred_async(self, deferred_id):
+        return await self.notification_service.cancel_deferred_async(deferred_id)
@@ -0,0 +1,94 @@
+import json
+import os
+import platform
+import time
+from datetime import datetime
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def summarize(name, latencies, elapsed, commands=None, status_codes=None):
+    """Summarize one scenario: throughput, latency percentiles in milliseconds and, when
+    known, the number of storage commands issued per operation.
+    """
+    count = len(latencies)
+    summary = {
+        "name": name,
+        "operations": count,
+        "elapsed_seconds": round(elapsed, 4),
+        "throughput_per_second": round(count / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(max(latencies) * 1000, 3) if latencies else 0.0,
+        },
+    }
+    if commands is not None:
+        summary["commands_per_operation"] = round(commands / count, 3) if count else 0.0
+    if status_codes is not None:
+        summary["status_codes"] = {str(code): total for code, total in sorted(status_codes.items())}
+    return summary
+
+def print_summary(summary):
+    latency = summary["latency_ms"]
+    line = (f"{summary['name']:<40} {summary['operations']:>8} ops {summary['throughput_per_second']:>10.1f}/s "
+            f"p50 {latency['p50']:>8.3f}ms p95 {latency['p95']:>8.3f}ms p99 {latency['p99']:>8.3f}ms")
+    if "commands_per_operation" in summary:
+        line += f" cmds/op {summary['commands_per_operation']:.2f}"
+    if "status_codes" in summary:
+        line += f" {summary['status_codes']}"
+    print(line)
+
+def save_results(kind, config, summaries, output=None):
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, "w") as results_file:
+        json.dump({
+            "kind": kind,
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "config": config,
+            "results": summaries,
+        }, results_file, indent=2)
+    print(f"Results saved to {output}")
+    return output
+
+class RedisCommandCounter:
+    """Counts commands executed by a Redis server from ``INFO commandstats`` deltas."""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    def total(self):
+        stats = self.redis_client.info("commandstats")
+        # The INFO call used to read the counters is not part of the measured workload
+        return sum(entry["calls"] for command, entry in stats.items() if command != "cmdstat_info")
+
+class CallCounter:
+    """Wraps a repository and counts calls to its methods, standing in for Redis
+    command counts when benchmarking the in-process backend.
+    """
+
+    def __init__(self, target):
+        self._target = target
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return attribute(*args, **kwargs)
+        return counted
+
+    def total(self):
+        return self.calls
@@ -0,0 +1,44 @@
+"""Compare two benchmark result files scenario by scenario::
+
+    python -m benchmarks.compare benchmarks/results/load-before.json benchmarks/results/load-after.json
+"""
+import argparse
+import json
+
+def load(path):
+    with open(path) as results_file:
+        return {summary["name"]: summary for summary in json.load(results_file)["results"]}
+
+def change(before, after):
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+def compare(baseline, candidate):
+    print(f"{'scenario':<40} {'throughput/s':>22} {'p50 ms':>22} {'p99 ms':>22} {'cmds/op':>14}")
+    for name, before in baseline.items():
+        after = candidate.get(name)
+        if after is None:
+            print(f"{name:<40} missing from candidate")
+            continue
+        columns = [
+            (before["throughput_per_second"], after["throughput_per_second"]),
+            (before["latency_ms"]["p50"], after["latency_ms"]["p50"]),
+            (before["latency_ms"]["p99"], after["latency_ms"]["p99"]),
+        ]
+        line = f"{name:<40}" + "".join(
+            f" {after_value:>12.2f} {change(before_value, after_value):>9}" for before_value, after_value in columns
+        )
+        if "commands_per_operation" in before and "commands_per_operation" in after:
+            line += f" {after['commands_per_operation']:>6.2f} {change(before['commands_per_operation'], after['commands_per_operation']):>7}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    args = parser.parse_args()
+    compare(load(args.baseline), load(args.candidate))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Drive the HTTP API at a fixed concurrency and report throughput, latency percentiles
+and storage commands per request.
+
+By default the application runs in-process through ``httpx.ASGITransport`` against the
+backend selected by ``RATE_LIMIT_BACKEND``; pass ``--url`` to target a running server.
+Run from the repository root::
+
+    RATE_LIMIT_BACKEND=memory python -m benchmarks.load_test --requests 5000 --concurrency 50
+    python -m benchmarks.load_test --url http://localhost:8000 --redis-host localhost
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import time
+from collections import Counter
+
+import httpx
+import redis
+
+from benchmarks.common import CallCounter, RedisCommandCounter, print_summary, save_results, summarize
+
+BENCHMARK_TYPE = "benchmark"
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Base URL of a running server; the app runs in-process when omitted")
+    parser.add_argument("--redis-host", default=os.getenv("REDIS_HOST", "localhost"),
+                        help="Redis server whose INFO commandstats is sampled (Redis backend only)")
+    parser.add_argument("--redis-port", type=int, default=int(os.getenv("REDIS_PORT", 6379)))
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20, help="Requests in flight at once")
+    parser.add_argument("--recipients", type=int, default=1000, help="Distinct recipients to spread sends over")
+    parser.add_argument("--max-count", type=int, default=1000,
+                        help="Per-recipient limit of the benchmark notification type; lower it to measure rejections")
+    parser.add_argument("--period", type=int, default=3600)
+    parser.add_argument("--algorithm", default="sliding_log")
+    parser.add_argument("--scenarios", default="send,usage,clear",
+                        help="Comma-separated subset of send, usage, clear")
+    parser.add_argument("--username", default=os.getenv("ADMIN_USERNAME", "admin"))
+    parser.add_argument("--password", default=os.getenv("ADMIN_PASSWORD", "password"))
+    parser.add_argument("--output", help="JSON results file (default: benchmarks/results/load-<timestamp>.json)")
+    return parser
+
+def send_request(args):
+    def request(client, index):
+        return client.post("/send-notification/", json={
+            "notification_type": BENCHMARK_TYPE,
+            "recipient": f"user{index % args.recipients}@example.com",
+            "message": "benchmark",
+        })
+    return request
+
+def usage_request(args):
+    def request(client, index):
+        return client.get("/usage/", params={"cursor": 0, "limit": 100, "notification_type": BENCHMARK_TYPE})
+    return request
+
+def clear_request(args):
+    def request(client, index):
+        return client.delete("/notifications", params={"notification_type": BENCHMARK_TYPE})
+    return request
+
+SCENARIOS = {
+    "send": send_request,
+    "usage": usage_request,
+    "clear": clear_request,
+}
+
+async def run_scenario(client, name, request, total, concurrency, counter):
+    latencies = []
+    status_codes = Counter()
+    next_index = iter(range(total))
+
+    async def worker():
+        for index in next_index:
+            started = time.perf_counter()
+            response = await request(client, index)
+            latencies.append(time.perf_counter() - started)
+            status_codes[response.status_code] += 1
+
+    commands_before = counter.total() if counter is not None else None
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    commands = counter.total() - commands_before if counter is not None else None
+    return summarize(name, latencies, elapsed, commands, status_codes)
+
+async def authenticate(client, args):
+    response = await client.post("/token", data={"username": args.username, "password": args.password})
+    response.raise_for_status()
+    client.headers["Authorization"] = f"Bearer {response.json()['access_token']}"
+
+async def prepare(client, args):
+    response = await client.put(f"/rate-limits/rules/{BENCHMARK_TYPE}", json={
+        "max_count": args.max_count, "period": args.period, "algorithm": args.algorithm,
+    })
+    response.raise_for_status()
+    # Start every run from an empty keyspace so results are comparable
+    (await client.delete("/notifications", params={"notification_type": BENCHMARK_TYPE})).raise_for_status()
+
+def redis_counter(args):
+    counter = RedisCommandCounter(redis.StrictRedis(host=args.redis_host, port=args.redis_port, decode_responses=True))
+    try:
+        counter.total()
+    except (redis.RedisError, OSError):
+        print(f"Redis at {args.redis_host}:{args.redis_port} is unreachable, commands per request are not reported")
+        return None
+    return counter
+
+async def run(args):
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    backend = "remote" if args.url else os.getenv("RATE_LIMIT_BACKEND", "redis")
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url)
+        counter = redis_counter(args)
+    else:
+        from app import dependencies
+        from app.main import app
+        # ASGITransport does not run the lifespan, so start and stop the service explicitly
+        await dependencies.start_notification_service_app()
+        service = dependencies.init_notification_service_app().notification_service
+        if backend == "memory":
+            counter = CallCounter(service.repository)
+            service.repository = counter
+        else:
+            counter = redis_counter(args)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark")
+
+    summaries = []
+    try:
+        async with client:
+            await authenticate(client, args)
+            await prepare(client, args)
+            for name in scenarios:
+                # Keep the delivery sender's per-notification output out of the report
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    summary = await run_scenario(
+                        client, name, SCENARIOS[name](args), args.requests, args.concurrency, counter
+                    )
+                print_summary(summary)
+                summaries.append(summary)
+    finally:
+        if not args.url:
+            await dependencies.close_notification_service_app()
+
+    config = {key: value for key, value in vars(args).items() if key not in ("password", "output")}
+    config["backend"] = backend
+    save_results("load", config, summaries, args.output)
+
+def main():
+    asyncio.run(run(build_parser().parse_args()))
+
+if __name__ == "__main__":
+    main()
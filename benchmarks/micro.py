@@ -0,0 +1,127 @@
+"""Micro-benchmarks of ``NotificationService.send`` and every repository method, called
+directly without the HTTP layer.
+
+Runs against a local Redis through ``RedisRepository`` (``--backend redis``) or the
+in-process ``InMemoryRepository`` (``--backend memory``). Run from the repository root::
+
+    python -m benchmarks.micro --backend memory --iterations 20000
+    python -m benchmarks.micro --backend redis --redis-host localhost
+"""
+import argparse
+import contextlib
+import os
+import time
+from datetime import datetime
+
+import redis
+
+from benchmarks.common import CallCounter, RedisCommandCounter, print_summary, save_results, summarize
+from domain.notification import NotificationService, RateLimitRule, RuleTable
+from infrastructure.memory_repository import InMemoryRepository
+from infrastructure.redis_repository import RedisRepository
+
+BENCHMARK_TYPE = "benchmark"
+# A separate namespace so a benchmark never touches the keys of a running service
+BENCHMARK_KEY_PREFIX = "benchmark"
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=("redis", "memory"), default=os.getenv("RATE_LIMIT_BACKEND", "redis"))
+    parser.add_argument("--redis-host", default=os.getenv("REDIS_HOST", "localhost"))
+    parser.add_argument("--redis-port", type=int, default=int(os.getenv("REDIS_PORT", 6379)))
+    parser.add_argument("--iterations", type=int, default=5000, help="Calls per single-key benchmark")
+    parser.add_argument("--recipients", type=int, default=1000, help="Distinct recipients the calls are spread over")
+    parser.add_argument("--batch-size", type=int, default=100, help="Requests per try_acquire_many call")
+    parser.add_argument("--max-count", type=int, default=1000)
+    parser.add_argument("--period", type=int, default=3600)
+    parser.add_argument("--algorithm", default="sliding_log")
+    parser.add_argument("--key-encoding", choices=("plain", "compact"), default=os.getenv("REDIS_KEY_ENCODING", "plain"))
+    parser.add_argument("--output", help="JSON results file (default: benchmarks/results/micro-<timestamp>.json)")
+    return parser
+
+def build_repository(args):
+    """Return ``(repository, counter)``; ``counter.total()`` reports the commands issued so far."""
+    if args.backend == "memory":
+        # No background evictor: a benchmark run is shorter than any period
+        counter = CallCounter(InMemoryRepository(eviction_interval=0))
+        return counter, counter
+    repository = RedisRepository(
+        args.redis_host, args.redis_port, key_prefix=BENCHMARK_KEY_PREFIX, key_encoding=args.key_encoding
+    )
+    return repository, RedisCommandCounter(redis.StrictRedis(host=args.redis_host, port=args.redis_port))
+
+def measure(name, call, iterations, counter):
+    latencies = []
+    commands_before = counter.total()
+    started = time.perf_counter()
+    for index in range(iterations):
+        call_started = time.perf_counter()
+        call(index)
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    return summarize(name, latencies, elapsed, counter.total() - commands_before)
+
+def benchmarks(args, repository):
+    """Yield ``(name, call, iterations)``; ``call`` receives the iteration index."""
+    recipients = [f"user{index}@example.com" for index in range(args.recipients)]
+
+    def recipient(index):
+        return recipients[index % len(recipients)]
+
+    def try_acquire(index):
+        repository.try_acquire(recipient(index), BENCHMARK_TYPE, args.max_count, args.period, datetime.now(), args.algorithm)
+
+    def try_acquire_many(index):
+        repository.try_acquire_many([
+            (recipient(index * args.batch_size + offset), BENCHMARK_TYPE, args.max_count, args.period, args.algorithm)
+            for offset in range(args.batch_size)
+        ], datetime.now())
+
+    service = NotificationService(repository, RuleTable(0, {
+        BENCHMARK_TYPE: RateLimitRule(args.max_count, args.period, args.algorithm),
+    }))
+
+    def send(index):
+        service.send(BENCHMARK_TYPE, recipient(index), "benchmark")
+
+    def scan_usage(index):
+        repository.scan_usage(0, 100, BENCHMARK_TYPE)
+
+    def get_all_usage(index):
+        repository.get_all_usage(BENCHMARK_TYPE)
+
+    def clear_all_notifications(index):
+        repository.clear_all_notifications(BENCHMARK_TYPE)
+
+    scan_iterations = max(args.iterations // 10, 1)
+    yield "NotificationService.send", send, args.iterations
+    yield "repository.try_acquire", try_acquire, args.iterations
+    yield f"repository.try_acquire_many[{args.batch_size}]", try_acquire_many, max(args.iterations // args.batch_size, 1)
+    yield "repository.scan_usage", scan_usage, scan_iterations
+    yield "repository.get_all_usage", get_all_usage, scan_iterations
+    # The first call deletes every key, the rest measure an empty scan
+    yield "repository.clear_all_notifications", clear_all_notifications, scan_iterations
+
+def run(args):
+    repository, counter = build_repository(args)
+    summaries = []
+    try:
+        repository.clear_all_notifications(BENCHMARK_TYPE)
+        for name, call, iterations in benchmarks(args, repository):
+            # NotificationService delivers by printing; keep that out of the report
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                summary = measure(name, call, iterations, counter)
+            print_summary(summary)
+            summaries.append(summary)
+    finally:
+        repository.clear_all_notifications(BENCHMARK_TYPE)
+        repository.close()
+
+    config = {key: value for key, value in vars(args).items() if key != "output"}
+    save_results("micro", config, summaries, args.output)
+
+def main():
+    run(build_parser().parse_args())
+
+if __name__ == "__main__":
+    main()
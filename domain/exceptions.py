@@ -1,2 +1,13 @@
 class RateLimitExceededException(Exception):
+    def __init__(self, message, retry_after=None, remaining=0, rule=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.remaining = remaining
+        # Scope of the limit that denied the request, e.g. ``status@86400`` or ``*@86400``
+        self.rule = rule
+
+class DeliveryQueueFullException(Exception):
+    pass
+
+class RuleVersionConflictException(Exception):
     pass
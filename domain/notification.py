@@ -1,37 +1,466 @@
+import math
+import time
+import uuid
+from contextlib import nullcontext
+from collections.abc import Mapping
 from datetime import datetime, timedelta
-from domain.exceptions import RateLimitExceededException
+from types import MappingProxyType
+from typing import NamedTuple
+from domain.exceptions import RateLimitExceededException, DeliveryQueueFullException
+
+# Absorbs float rounding so e.g. 3 sends per 3600s never computes 2.9999 slots
+EPSILON = 1e-9
+
+# Rule name whose limits apply to a recipient across every notification type
+ALL_TYPES = '*'
+
+class RateLimitRule(NamedTuple):
+    max_count: int
+    period: int
+    algorithm: str = 'sliding_log'
+    # Additional ``(max_count, period)`` windows enforced together with the first one,
+    # e.g. a burst limit per minute plus a sustained limit per day
+    windows: tuple = ()
+    # Schedule over-limit notifications for when their window frees up instead of rejecting them
+    defer: bool = False
+
+class DeferredNotification(NamedTuple):
+    """An over-limit notification held back until ``due_at``, the POSIX time at which
+    the window that denied it frees up. ``attempts`` counts redeliveries that were
+    still over the limit.
+    """
+    id: str
+    notification_type: str
+    recipient: str
+    message: str
+    due_at: float
+    deferred_at: float
+    attempts: int = 0
+
+class RateLimit(NamedTuple):
+    """One window checked for a request. ``scope`` names the rule and the stored counter:
+    the notification type for a rule's first window, ``<type>@<period>`` for its other
+    windows and ``*@<period>`` for the cross-type limits of the ``ALL_TYPES`` rule.
+    """
+    scope: str
+    max_count: int
+    period: int
+    algorithm: str
+
+def compile_limits(name, rule):
+    first = name if name != ALL_TYPES else f"{ALL_TYPES}@{rule.period}"
+    return (RateLimit(first, rule.max_count, rule.period, rule.algorithm),) + tuple(
+        RateLimit(f"{name}@{period}", max_count, period, rule.algorithm) for max_count, period in rule.windows
+    )
+
+class RuleTable(Mapping):
+    """Immutable notification type to ``RateLimitRule`` lookup, compiled once per
+    configuration ``version`` and shared read-only by every request.
+
+    A rule named ``ALL_TYPES`` caps each recipient across all types; its windows are
+    appended to the ``limits`` of every type.
+    """
+
+    def __init__(self, version, rules):
+        self.version = version
+        self._rules = MappingProxyType({
+            notification_type: self._rule(rule) for notification_type, rule in rules.items()
+        })
+        recipient_limits = compile_limits(ALL_TYPES, self._rules[ALL_TYPES]) if ALL_TYPES in self._rules else ()
+        self._limits = {
+            notification_type: compile_limits(notification_type, rule) + recipient_limits
+            for notification_type, rule in self._rules.items() if notification_type != ALL_TYPES
+        }
+
+    @staticmethod
+    def _rule(rule):
+        rule = RateLimitRule(*rule)
+        return rule._replace(windows=tuple(tuple(window) for window in rule.windows))
+
+    def limits(self, notification_type):
+        """Every ``RateLimit`` a notification of this type must pass, or None for unknown types."""
+        return self._limits.get(notification_type)
+
+    def __getitem__(self, notification_type):
+        return self._rules[notification_type]
+
+    def __iter__(self):
+        return iter(self._rules)
+
+    def __len__(self):
+        return len(self._rules)
+
+class RateLimitStrategy:
+    """Decides whether one more notification fits ``max_count`` per ``period`` seconds.
+
+    Strategies are pure: ``acquire`` receives the state stored for one (recipient, type)
+    and returns ``((allowed, remaining, retry_after), new_state)`` so any repository can
+    persist it. ``now`` is a POSIX timestamp. The Redis repository runs Lua ports of
+    these implementations so the decision stays atomic server-side.
+    """
+    name = None
+
+    def acquire(self, state, max_count, period, now):
+        raise NotImplementedError
+
+    def usage(self, state, max_count, period, now):
+        raise NotImplementedError
+
+class SlidingLogStrategy(RateLimitStrategy):
+    """Exact limit keeping one timestamp per notification in the window; state grows with ``max_count``."""
+    name = 'sliding_log'
+
+    def acquire(self, state, max_count, period, now):
+        window = [timestamp for timestamp in (state or []) if timestamp > now - period]
+        if len(window) >= max_count:
+            retry_after = window[0] + period - now if window else period
+            return (False, 0, max(retry_after, 0.0)), window
+        window.append(now)
+        return (True, max_count - len(window), 0.0), window
+
+    def usage(self, state, max_count, period, now):
+        return sum(1 for timestamp in (state or []) if timestamp > now - period)
+
+class GCRAStrategy(RateLimitStrategy):
+    """Generic cell rate algorithm: stores only the theoretical arrival time (TAT).
+
+    Notifications are spaced ``period / max_count`` apart with a burst of up to
+    ``max_count``, so the limit is smooth rather than a hard count per window.
+    """
+    name = 'gcra'
+
+    def acquire(self, state, max_count, period, now):
+        interval = period / max_count
+        tat = max(state if state is not None else now, now)
+        new_tat = tat + interval
+        allow_at = new_tat - period
+        if allow_at > now + EPSILON:
+            return (False, 0, allow_at - now), state
+        return (True, math.floor((now - allow_at) / interval + EPSILON), 0.0), new_tat
+
+    def usage(self, state, max_count, period, now):
+        if state is None or state <= now:
+            return 0
+        return math.ceil((state - now) / (period / max_count) - EPSILON)
+
+class SlidingWindowCounterStrategy(RateLimitStrategy):
+    """Approximates a sliding window from the counts of the current and previous fixed
+    windows, weighting the previous one by how much of it still overlaps the window.
+
+    State is ``(window_start, current_count, previous_count)``.
+    """
+    name = 'sliding_window'
+
+    def _counts(self, state, period, now):
+        window = math.floor(now / period) * period
+        current, previous = 0, 0
+        if state is not None:
+            stored_window, stored_current, stored_previous = state
+            if stored_window == window:
+                current, previous = stored_current, stored_previous
+            elif stored_window == window - period:
+                previous = stored_current
+        return window, current, previous
+
+    def acquire(self, state, max_count, period, now):
+        window, current, previous = self._counts(state, period, now)
+        elapsed = now - window
+        estimate = previous * (period - elapsed) / period + current
+        if estimate + 1 > max_count + EPSILON:
+            if current + 1 <= max_count:
+                # Wait until enough of the previous window has slid out
+                retry_after = (1 - (max_count - current - 1) / previous) * period - elapsed
+            else:
+                # Wait for the next window, then for this window's count to slide out
+                retry_after = period - elapsed + max(0.0, 1 - (max_count - 1) / current) * period
+            return (False, 0, max(retry_after, 0.0)), state
+        remaining = math.floor(max_count - estimate - 1 + EPSILON)
+        return (True, remaining, 0.0), (window, current + 1, previous)
+
+    def usage(self, state, max_count, period, now):
+        window, current, previous = self._counts(state, period, now)
+        return math.ceil(previous * (period - (now - window)) / period + current - EPSILON)
+
+RATE_LIMIT_STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (SlidingLogStrategy(), GCRAStrategy(), SlidingWindowCounterStrategy())
+}
 
 class NotificationService:
-    def __init__(self, repository, rate_limits):
+    def __init__(self, repository, rate_limits, deny_cache=None, delivery_queue=None, metrics=None, schedule=None):
         self.repository = repository
-        self.rate_limits = rate_limits
+        self.rate_limits = self._rule_table(rate_limits)
+        self.deny_cache = deny_cache
+        # When set, the async path hands accepted notifications to the queue instead of delivering inline
+        self.delivery_queue = delivery_queue
+        # Optional stage timer; anything with a ``stage(name)`` context manager
+        self.metrics = metrics
+        # When set, the async path can defer over-limit notifications instead of rejecting them
+        self.schedule = schedule
+
+    @staticmethod
+    def _rule_table(rate_limits):
+        return rate_limits if isinstance(rate_limits, RuleTable) else RuleTable(0, rate_limits)
+
+    def set_rate_limits(self, rate_limits):
+        # Swap in a fresh table so in-flight requests keep a consistent view; blocks
+        # computed under the old limits no longer apply
+        self.rate_limits = self._rule_table(rate_limits)
+        if self.deny_cache is not None:
+            self.deny_cache.clear()
 
     def send(self, notification_type, recipient, message):
-        if notification_type not in self.rate_limits:
-            raise ValueError("Unknown notification type")
+        limits = self._get_limits(notification_type)
+        now = datetime.now()
+        self._check_deny_cache(notification_type, recipient, now)
+
+        # Check every limit and record the notification atomically
+        with self._stage('repository'):
+            decision = self._acquire(recipient, limits, now)
+        remaining = self._check_allowed(decision, limits, notification_type, recipient, now)
+
+        # Send notification
+        self._deliver_inline(notification_type, recipient, message)
+        return remaining
+
+    async def send_async(self, notification_type, recipient, message, defer=None):
+        """Send one notification and return the remaining quota.
 
-        max_count, period = self.rate_limits[notification_type]
+        An over-limit notification is scheduled instead of rejected when ``defer`` is true,
+        or when it is ``None`` and the type's rule defers; the ``DeferredNotification`` is
+        returned then.
+        """
+        try:
+            return await self._send_async(notification_type, recipient, message)
+        except RateLimitExceededException as e:
+            results = [e]
+            await self._defer_denied([(notification_type, recipient, message)], results, [defer])
+            if results[0] is e:
+                raise
+            return results[0]
+
+    async def _send_async(self, notification_type, recipient, message):
+        limits = self._get_limits(notification_type)
         now = datetime.now()
+        self._check_deny_cache(notification_type, recipient, now)
+
+        # Take a queue slot first so a full queue is reported before any quota is spent
+        if self.delivery_queue is not None:
+            self.delivery_queue.reserve()
+        try:
+            with self._stage('repository'):
+                decision = await self._acquire(recipient, limits, now)
+            remaining = self._check_allowed(decision, limits, notification_type, recipient, now)
+        except BaseException:
+            if self.delivery_queue is not None:
+                self.delivery_queue.release()
+            raise
+
+        self._deliver(notification_type, recipient, message)
+        return remaining
+
+    def send_batch(self, notifications):
+        """Send ``(notification_type, recipient, message)`` tuples with a single repository call.
+
+        Returns one entry per notification: the remaining quota, or the
+        ``ValueError``/``RateLimitExceededException`` that rejected it.
+        """
+        now = datetime.now()
+        results, pending = self._prepare_batch(notifications, now)
+        decisions = []
+        if pending:
+            with self._stage('repository'):
+                decisions = self._acquire_many(pending, now)
+        return self._complete_batch(notifications, results, pending, decisions, now, self._deliver_inline)
+
+    async def send_batch_async(self, notifications, defer=None):
+        """Async ``send_batch``; ``defer`` optionally holds one ``send_async`` defer flag
+        per notification, and deferred notifications get their ``DeferredNotification``.
+        """
+        results = await self._send_batch_async(notifications)
+        await self._defer_denied(notifications, results, defer or [None] * len(notifications))
+        return results
+
+    async def _send_batch_async(self, notifications):
+        now = datetime.now()
+        results, pending = self._prepare_batch(notifications, now)
+        if not pending:
+            return results
+        if self.delivery_queue is not None:
+            try:
+                self.delivery_queue.reserve(len(pending))
+            except DeliveryQueueFullException as e:
+                for index, _ in pending:
+                    results[index] = e
+                return results
+        try:
+            with self._stage('repository'):
+                decisions = await self._acquire_many(pending, now)
+        except BaseException:
+            if self.delivery_queue is not None:
+                self.delivery_queue.release(len(pending))
+            raise
+        results = self._complete_batch(notifications, results, pending, decisions, now, self._deliver)
+        if self.delivery_queue is not None:
+            self.delivery_queue.release(sum(1 for index, _ in pending if isinstance(results[index], Exception)))
+        return results
+
+    def _should_defer(self, notification_type, defer):
+        if defer is not None:
+            return defer
+        rule = self.rate_limits.get(notification_type)
+        return rule is not None and rule.defer
+
+    async def _defer_denied(self, notifications, results, defer):
+        """Replace the rate-limit rejections in ``results`` that opted into deferral with
+        the ``DeferredNotification`` scheduled for them, in one schedule call. Rejections
+        the schedule has no room for are kept.
+        """
+        if self.schedule is None:
+            return
+        candidates = [
+            index for index, result in enumerate(results)
+            if isinstance(result, RateLimitExceededException) and result.retry_after is not None
+            and self._should_defer(notifications[index][0], defer[index])
+        ]
+        if not candidates:
+            return
+        now = time.time()
+        items = [
+            DeferredNotification(uuid.uuid4().hex, *notifications[index], now + results[index].retry_after, now)
+            for index in candidates
+        ]
+        added = await self.schedule.add(items)
+        for index, item in zip(candidates[:added], items):
+            results[index] = item
+
+    def _acquire(self, recipient, limits, now):
+        # Returns a coroutine when the repository is async
+        if len(limits) > 1:
+            return self.repository.try_acquire_limits(recipient, limits, now)
+        # A single window keeps the plain per-key call
+        limit = limits[0]
+        return self.repository.try_acquire(recipient, limit.scope, limit.max_count, limit.period, now, limit.algorithm)
 
-        # Clean up old notifications and check rate limit
-        self.repository.cleanup_old_notifications(recipient, notification_type, period, now)
-        count = self.repository.get_notification_count(recipient, notification_type, period, now)
+    def _acquire_many(self, pending, now):
+        requests = [request for _, request in pending]
+        if all(len(limits) == 1 for _, _, limits in requests):
+            return self.repository.try_acquire_many([
+                (recipient, limits[0].scope, limits[0].max_count, limits[0].period, limits[0].algorithm)
+                for recipient, _, limits in requests
+            ], now)
+        return self.repository.try_acquire_limits_many([(recipient, limits) for recipient, _, limits in requests], now)
 
-        if count >= max_count:
+    def _prepare_batch(self, notifications, now):
+        results = [None] * len(notifications)
+        pending = []
+        for index, (notification_type, recipient, message) in enumerate(notifications):
+            try:
+                limits = self._get_limits(notification_type)
+                self._check_deny_cache(notification_type, recipient, now)
+            except (ValueError, RateLimitExceededException) as e:
+                results[index] = e
+                continue
+            pending.append((index, (recipient, notification_type, limits)))
+        return results, pending
+
+    def _complete_batch(self, notifications, results, pending, decisions, now, deliver):
+        for (index, (recipient, notification_type, limits)), decision in zip(pending, decisions):
+            try:
+                results[index] = self._check_allowed(decision, limits, notification_type, recipient, now)
+            except RateLimitExceededException as e:
+                results[index] = e
+                continue
+            deliver(notification_type, recipient, notifications[index][2])
+        return results
+
+    def _get_limits(self, notification_type):
+        limits = self.rate_limits.limits(notification_type)
+        if limits is None:
+            raise ValueError("Unknown notification type")
+        return limits
+
+    def _check_deny_cache(self, notification_type, recipient, now):
+        if self.deny_cache is None:
+            return
+        blocked_until = self.deny_cache.get(recipient, notification_type, now.timestamp())
+        if blocked_until is not None:
             raise RateLimitExceededException(
-                f"Rate limit exceeded for {notification_type} to {recipient}"
+                f"Rate limit exceeded for {notification_type} to {recipient}",
+                retry_after=blocked_until - now.timestamp(),
             )
 
-        # Send notification
-        self._send_notification(recipient, message)
-        self.repository.log_notification(recipient, notification_type, now, period)
+    def _check_allowed(self, decision, limits, notification_type, recipient, now):
+        """Return the remaining quota of an ``(allowed, remaining, retry_after[, denied])``
+        decision, or raise naming the limit at index ``denied`` that rejected it.
+        """
+        allowed, remaining, retry_after = decision[:3]
+        if allowed:
+            return remaining
+        # Decisions of the single-window call carry no index
+        rule = limits[decision[3]].scope if len(decision) > 3 else limits[0].scope
+        if self.deny_cache is not None and retry_after > 0:
+            self.deny_cache.block(recipient, notification_type, now.timestamp() + retry_after)
+        message = f"Rate limit exceeded for {notification_type} to {recipient}"
+        if rule != notification_type:
+            message += f" ({rule} limit)"
+        raise RateLimitExceededException(message, retry_after=retry_after, rule=rule)
+
+    def _stage(self, name):
+        return self.metrics.stage(name) if self.metrics is not None else nullcontext()
+
+    def _deliver(self, notification_type, recipient, message):
+        with self._stage('delivery'):
+            if self.delivery_queue is not None:
+                self.delivery_queue.submit(notification_type, recipient, message)
+            else:
+                self._send_notification(recipient, message)
+
+    def _deliver_inline(self, notification_type, recipient, message):
+        # The synchronous path may run outside the event loop that owns the queue
+        with self._stage('delivery'):
+            self._send_notification(recipient, message)
 
     def _send_notification(self, recipient, message):
         print(f"Sending '{message}' to {recipient}")
 
-    def clear_all_notifications(self):
-        self.repository.clear_all_notifications()
+    def clear_all_notifications(self, notification_type=None):
+        if self.deny_cache is not None:
+            self.deny_cache.clear()
+        return self.repository.clear_all_notifications(notification_type)
+
+    async def clear_all_notifications_async(self, notification_type=None):
+        if self.deny_cache is not None:
+            self.deny_cache.clear()
+        return await self.repository.clear_all_notifications(notification_type)
+
+    def get_all_usage(self, notification_type=None, recipient_prefix=None):
+        return self.repository.get_all_usage(notification_type, recipient_prefix)
+
+    async def get_all_usage_async(self, notification_type=None, recipient_prefix=None):
+        return await self.repository.get_all_usage(notification_type, recipient_prefix)
+
+    def get_usage_page(self, cursor, count, notification_type=None, recipient_prefix=None):
+        return self.repository.scan_usage(cursor, count, notification_type, recipient_prefix)
+
+    async def get_usage_page_async(self, cursor, count, notification_type=None, recipient_prefix=None):
+        return await self.repository.scan_usage(cursor, count, notification_type, recipient_prefix)
+
+    def iter_usage(self, notification_type=None, recipient_prefix=None):
+        return self.repository.iter_usage(notification_type, recipient_prefix)
+
+    def iter_usage_async(self, notification_type=None, recipient_prefix=None):
+        return self.repository.iter_usage(notification_type, recipient_prefix)
+
+    async def list_deferred_async(self, offset=0, count=100):
+        """Return ``(total, items)`` with up to ``count`` pending deferred notifications, soonest due first."""
+        if self.schedule is None:
+            return 0, []
+        return await self.schedule.list(offset, count)
 
-    def get_all_usage(self):
-        return self.repository.get_all_usage()
+    async def get_deferred_async(self, deferred_id):
+        return await self.schedule.get(deferred_id) if self.schedule is not None else None
 
+    async def cancel_deferred_async(self, deferred_id):
+        """Drop a pending deferred notification; returns False if it is unknown or already sent."""
+        return await self.schedule.cancel(deferred_id) if self.schedule is not None else False
@@ -0,0 +1,157 @@
+import logging
+import redis.asyncio as redis
+from datetime import datetime
+from domain.notification import RateLimit
+from infrastructure.redis_repository import (
+    USAGE_SCRIPT, MIGRATE_KEY_SCRIPT, USAGE_SCAN_COUNT, CLEAR_CHUNK_SIZE, MEMORY_SAMPLE_SIZE, create_keyspace,
+    parse_decision, usage_page, build_memory_report, check_migratable, pool_stats, split_cursor,
+    join_cursor
+)
+
+logger = logging.getLogger(__name__)
+
+class AsyncRedisRepository:
+    """``RedisRepository`` built on ``redis.asyncio`` so handlers never block a thread on Redis."""
+
+    def __init__(self, redis_host='localhost', redis_port=6379, redis_db=0, connection_pool=None,
+                 key_prefix='ratelimit', clear_chunk_size=CLEAR_CHUNK_SIZE, key_encoding='plain'):
+        self.keyspace = create_keyspace(key_prefix, key_encoding)
+        self.clear_chunk_size = clear_chunk_size
+        if connection_pool is not None:
+            self.redis_client = redis.StrictRedis(connection_pool=connection_pool)
+        else:
+            self.redis_client = redis.StrictRedis(host=redis_host, port=redis_port, db=redis_db, decode_responses=True)
+        self._try_acquire_script = self.redis_client.register_script(self.keyspace.acquire_script)
+        self._usage_script = self.redis_client.register_script(USAGE_SCRIPT)
+        self._migrate_script = self.redis_client.register_script(MIGRATE_KEY_SCRIPT)
+
+    def register_types(self, notification_types):
+        self.keyspace.register(notification_types)
+
+    async def try_acquire(self, recipient, notification_type, max_count, period, now, algorithm='sliding_log'):
+        keys, args = self.keyspace.acquire_call(
+            recipient, (RateLimit(notification_type, max_count, period, algorithm),), now.timestamp(), now.timestamp()
+        )
+        return parse_decision(await self._try_acquire_script(keys=keys, args=args))[:3]
+
+    async def try_acquire_many(self, requests, now):
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for index, (recipient, notification_type, max_count, period, algorithm) in enumerate(requests):
+            keys, args = self.keyspace.acquire_call(
+                recipient, (RateLimit(notification_type, max_count, period, algorithm),),
+                now.timestamp(), f"{now.timestamp()}:{index}"
+            )
+            await self._try_acquire_script(keys=keys, args=args, client=pipeline)
+        return [parse_decision(result)[:3] for result in await pipeline.execute()]
+
+    async def try_acquire_limits(self, recipient, limits, now):
+        keys, args = self.keyspace.acquire_call(recipient, limits, now.timestamp(), now.timestamp())
+        return parse_decision(await self._try_acquire_script(keys=keys, args=args))
+
+    async def try_acquire_limits_many(self, requests, now):
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for index, (recipient, limits) in enumerate(requests):
+            keys, args = self.keyspace.acquire_call(recipient, limits, now.timestamp(), f"{now.timestamp()}:{index}")
+            await self._try_acquire_script(keys=keys, args=args, client=pipeline)
+        return [parse_decision(result) for result in await pipeline.execute()]
+
+    async def cleanup_old_notifications(self, recipient, notification_type, period, now):
+        key = self.keyspace.key(recipient, notification_type)
+        await self.redis_client.zremrangebyscore(key, 0, self.keyspace.score(now.timestamp() - period))
+
+    async def get_notification_count(self, recipient, notification_type, period, now):
+        key = self.keyspace.key(recipient, notification_type)
+        return await self.redis_client.zcard(key)
+
+    async def log_notification(self, recipient, notification_type, timestamp, ttl):
+        key = self.keyspace.key(recipient, notification_type)
+        score = self.keyspace.score(timestamp.timestamp())
+        await self.redis_client.zadd(key, {score: score})
+        await self.redis_client.expire(key, ttl)
+
+    async def clear_all_notifications(self, notification_type=None, progress=None):
+        deleted = 0
+        for match in self.keyspace.matches(notification_type):
+            cursor = 0
+            while True:
+                cursor, keys = await self.redis_client.scan(cursor=cursor, match=match, count=self.clear_chunk_size)
+                if keys:
+                    deleted += await self.redis_client.unlink(*keys)
+                    logger.debug("Cleared %d rate-limit keys matching %s", deleted, match)
+                    if progress is not None:
+                        progress(deleted)
+                if cursor == 0:
+                    break
+        return deleted
+
+    async def get_all_usage(self, notification_type=None, recipient_prefix=None):
+        return {key: count async for key, count in self.iter_usage(notification_type, recipient_prefix)}
+
+    async def scan_usage(self, cursor=0, count=USAGE_SCAN_COUNT, notification_type=None, recipient_prefix=None):
+        matches = self.keyspace.usage_matches(notification_type, recipient_prefix)
+        index, scan_cursor = split_cursor(cursor, len(matches))
+        scan_cursor, keys = await self.redis_client.scan(cursor=scan_cursor, match=matches[index], count=count)
+        next_cursor = join_cursor(index, scan_cursor, len(matches))
+        if not keys:
+            return next_cursor, {}
+        now = datetime.now().timestamp()
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            await self._usage_script(keys=[key], args=[now], client=pipeline)
+        for directory, field in self.keyspace.directories(keys):
+            pipeline.hmget(directory, 'r', field)
+        results = await pipeline.execute()
+        return next_cursor, usage_page(self.keyspace, keys, results, recipient_prefix)
+
+    async def iter_usage(self, notification_type=None, recipient_prefix=None, count=USAGE_SCAN_COUNT):
+        cursor = 0
+        while True:
+            cursor, usage = await self.scan_usage(cursor, count, notification_type, recipient_prefix)
+            for item in usage.items():
+                yield item
+            if cursor == 0:
+                break
+
+    async def memory_report(self, sample=MEMORY_SAMPLE_SIZE):
+        keys = []
+        cursor = 0
+        while len(keys) < sample:
+            cursor, batch = await self.redis_client.scan(cursor=cursor, match=self.keyspace.namespace(), count=sample)
+            keys.extend(batch)
+            if cursor == 0:
+                break
+        keys = keys[:sample]
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.memory_usage(key)
+        pipeline.info('memory')
+        pipeline.dbsize()
+        *sizes, info, db_keys = await pipeline.execute()
+        return build_memory_report(self.keyspace, keys, sizes, info['used_memory'], db_keys)
+
+    async def migrate_keys(self, progress=None):
+        check_migratable(self.keyspace)
+        migrated = 0
+        cursor = 0
+        while True:
+            cursor, keys = await self.redis_client.scan(
+                cursor=cursor, match=self.keyspace.plain_match(), count=self.clear_chunk_size
+            )
+            if keys:
+                pipeline = self.redis_client.pipeline(transaction=False)
+                for key in keys:
+                    migration_keys, args = self.keyspace.migration_call(key)
+                    await self._migrate_script(keys=migration_keys, args=args, client=pipeline)
+                migrated += sum(await pipeline.execute())
+                logger.debug("Migrated %d rate-limit keys to the compact encoding", migrated)
+                if progress is not None:
+                    progress(migrated)
+            if cursor == 0:
+                break
+        return migrated
+
+    def pool_stats(self):
+        return pool_stats(self.redis_client.connection_pool)
+
+    async def close(self):
+        await self.redis_client.connection_pool.disconnect()
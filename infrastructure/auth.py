@@ -1,10 +1,14 @@
 import os
+import time
+import hashlib
 import jwt
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
+from infrastructure.metrics import metrics
 
 SECRET_KEY = os.getenv('SECRET_KEY', 'your_secret_key')
 ALGORITHM = "HS256"
@@ -23,7 +27,46 @@ class TokenData(BaseModel):
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token",auto_error=False)
 
-def no_auth_dependency():
+class VerifiedTokenCache:
+    """Bounded LRU of tokens whose signature was already verified, keyed by a SHA-256
+    digest of the token so raw tokens are not kept in memory. Entries expire at the
+    token's ``exp``. ``SECRET_KEY`` is read at startup, so rotating it means a restart,
+    which starts with an empty cache.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _digest(self, token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        digest = self._digest(token)
+        entry = self._entries.get(digest)
+        if entry is None or entry[1] <= time.time():
+            self._entries.pop(digest, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(digest)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, token, username, expires_at):
+        if self.max_size <= 0 or expires_at is None:
+            return
+        self._entries[self._digest(token)] = (username, expires_at)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+token_cache = VerifiedTokenCache(int(os.getenv('TOKEN_CACHE_SIZE', 1024)))
+
+async def no_auth_dependency():
     if not (os.getenv('NO_AUTHORIZATION', '0')=='0') :
         return {"username": "admin"}
     else:
@@ -53,14 +96,22 @@ async def get_current_user(token: Optional[str] = Depends(oauth2_scheme), no_aut
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None or username != ADMIN_USERNAME:
-            raise credentials_exception
-        token_data = TokenData(username=username)
-    except jwt.PyJWTError:
+    if token is None:
         raise credentials_exception
+    with metrics.stage('jwt'):
+        # Repeat tokens skip signature verification until they expire
+        username = token_cache.get(token)
+        if username is not None:
+            return {"username": username}
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            username: str = payload.get("sub")
+            if username is None or username != ADMIN_USERNAME:
+                raise credentials_exception
+            token_data = TokenData(username=username)
+        except jwt.PyJWTError:
+            raise credentials_exception
+        token_cache.put(token, username, payload.get("exp"))
     return {"username": username}
 
 async def get_current_active_user(current_user: dict = Depends(get_current_user)):
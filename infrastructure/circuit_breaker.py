@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import time
+from redis.exceptions import ConnectionError, TimeoutError
+from infrastructure.redis_repository import USAGE_SCAN_COUNT, MEMORY_SAMPLE_SIZE
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 5.0
+# Seconds a rate-limit check may take, from waiting for a pooled connection to the reply
+DEFAULT_COMMAND_TIMEOUT = 0.5
+# Errors meaning Redis could not be reached in time; script and command errors are bugs, not outages
+OUTAGE_ERRORS = (ConnectionError, TimeoutError, OSError, asyncio.TimeoutError)
+
+class CircuitBreaker:
+    """Stops calling a failing dependency after ``failure_threshold`` consecutive failures.
+
+    While open, ``allow`` refuses every call. ``reset_timeout`` seconds after opening it
+    lets a single probe through (half-open); the probe's outcome closes the breaker or
+    opens it again. Time spent open or half-open adds up in ``degraded_seconds``.
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT,
+                 clock=time.monotonic, name='redis'):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.name = name
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._degraded_since = None
+        self._degraded_seconds = 0.0
+
+    def allow(self):
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self._probing = False
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        if self.state != CLOSED:
+            self._degraded_seconds += self.clock() - self._degraded_since
+            self._degraded_since = None
+            self.state = CLOSED
+            self._probing = False
+            logger.warning("Circuit breaker %s closed, leaving degraded mode", self.name)
+
+    def release(self):
+        """End a call that neither succeeded nor failed, so a half-open breaker lets the next call probe."""
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            self._open()
+
+    def _open(self):
+        if self.state == CLOSED:
+            self.opened += 1
+            self._degraded_since = self.clock()
+            logger.warning("Circuit breaker %s opened after %d failures, entering degraded mode", self.name, self.failures)
+        self.state = OPEN
+        self._opened_at = self.clock()
+        self._probing = False
+
+    def degraded_seconds(self):
+        if self._degraded_since is None:
+            return self._degraded_seconds
+        return self._degraded_seconds + self.clock() - self._degraded_since
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "opened": self.opened,
+            "degraded_seconds": self.degraded_seconds(),
+        }
+
+class AsyncFallbackRepository:
+    """Guards an async Redis repository with a deadline and a ``CircuitBreaker``.
+
+    Rate-limit checks that fail or take longer than ``timeout`` seconds count against
+    the breaker and are answered by the in-process ``fallback`` instead, and while the
+    breaker is open Redis is not called at all. The fallback enforces ``share`` of every
+    limit: the part one worker may allow while ``1 / share`` workers limit on their own.
+    Usage, clearing and the other operations always go to Redis.
+    """
+
+    def __init__(self, repository, fallback, breaker, timeout=DEFAULT_COMMAND_TIMEOUT, share=1.0):
+        self.repository = repository
+        self.fallback = fallback
+        self.breaker = breaker
+        self.timeout = timeout
+        self.share = share
+        self.fallback_calls = 0
+
+    def _shared(self, max_count):
+        # Never below one, so degraded mode slows recipients down instead of silencing them
+        return max(1, int(max_count * self.share))
+
+    def _shared_limits(self, limits):
+        return tuple(limit._replace(max_count=self._shared(limit.max_count)) for limit in limits)
+
+    async def _guarded(self, method, args, fallback_args):
+        if self.breaker.allow():
+            try:
+                result = await asyncio.wait_for(getattr(self.repository, method)(*args), self.timeout)
+            except OUTAGE_ERRORS as e:
+                self.breaker.record_failure()
+                logger.debug("Rate-limit check %s failed, using the local limiter: %r", method, e)
+            except BaseException:
+                # Cancelled, or an error that says nothing about whether Redis is reachable
+                self.breaker.release()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+        self.fallback_calls += 1
+        return await getattr(self.fallback, method)(*fallback_args)
+
+    async def try_acquire(self, recipient, notification_type, max_count, period, now, algorithm='sliding_log'):
+        return await self._guarded(
+            'try_acquire',
+            (recipient, notification_type, max_count, period, now, algorithm),
+            (recipient, notification_type, self._shared(max_count), period, now, algorithm),
+        )
+
+    async def try_acquire_many(self, requests, now):
+        shared = [
+            (recipient, notification_type, self._shared(max_count), period, algorithm)
+            for recipient, notification_type, max_count, period, algorithm in requests
+        ]
+        return await self._guarded('try_acquire_many', (requests, now), (shared, now))
+
+    async def try_acquire_limits(self, recipient, limits, now):
+        return await self._guarded(
+            'try_acquire_limits', (recipient, limits, now), (recipient, self._shared_limits(limits), now)
+        )
+
+    async def try_acquire_limits_many(self, requests, now):
+        shared = [(recipient, self._shared_limits(limits)) for recipient, limits in requests]
+        return await self._guarded('try_acquire_limits_many', (requests, now), (shared, now))
+
+    def register_types(self, notification_types):
+        self.repository.register_types(notification_types)
+
+    async def cleanup_old_notifications(self, recipient, notification_type, period, now):
+        return await self.repository.cleanup_old_notifications(recipient, notification_type, period, now)
+
+    async def get_notification_count(self, recipient, notification_type, period, now):
+        return await self.repository.get_notification_count(recipient, notification_type, period, now)
+
+    async def log_notification(self, recipient, notification_type, timestamp, ttl):
+        return await self.repository.log_notification(recipient, notification_type, timestamp, ttl)
+
+    async def clear_all_notifications(self, notification_type=None, progress=None):
+        await self.fallback.clear_all_notifications(notification_type)
+        return await self.repository.clear_all_notifications(notification_type, progress)
+
+    async def get_all_usage(self, notification_type=None, recipient_prefix=None):
+        return await self.repository.get_all_usage(notification_type, recipient_prefix)
+
+    async def scan_usage(self, cursor=0, count=USAGE_SCAN_COUNT, notification_type=None, recipient_prefix=None):
+        return await self.repository.scan_usage(cursor, count, notification_type, recipient_prefix)
+
+    def iter_usage(self, notification_type=None, recipient_prefix=None, count=USAGE_SCAN_COUNT):
+        return self.repository.iter_usage(notification_type, recipient_prefix, count)
+
+    async def memory_report(self, sample=MEMORY_SAMPLE_SIZE):
+        return await self.repository.memory_report(sample)
+
+    async def migrate_keys(self, progress=None):
+        return await self.repository.migrate_keys(progress)
+
+    def pool_stats(self):
+        return self.repository.pool_stats()
+
+    def degraded_stats(self):
+        return dict(self.breaker.stats(), fallback_calls=self.fallback_calls)
+
+    async def close(self):
+        await self.repository.close()
+        await self.fallback.close()
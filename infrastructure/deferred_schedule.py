@@ -0,0 +1,264 @@
+import asyncio
+import json
+import logging
+import time
+from redis.exceptions import RedisError
+from domain.exceptions import RateLimitExceededException, DeliveryQueueFullException
+from domain.notification import DeferredNotification
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 100000
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_BATCH_SIZE = 100
+# Seconds a claimed item stays hidden from other schedulers while it is being sent
+DEFAULT_LEASE = 30.0
+DEFAULT_MAX_ATTEMPTS = 10
+
+# KEYS = schedule zset, items hash; ARGV = max_size, then (id, due_at, item json) triples.
+# Adds items in order while the schedule has room and returns how many were added.
+ADD_DEFERRED_SCRIPT = """
+local added = 0
+for index = 2, #ARGV, 3 do
+    if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+        break
+    end
+    redis.call('ZADD', KEYS[1], ARGV[index + 1], ARGV[index])
+    redis.call('HSET', KEYS[2], ARGV[index], ARGV[index + 2])
+    added = added + 1
+end
+return added
+"""
+
+# KEYS = schedule zset, items hash; ARGV = now, count, lease_until.
+# Leases up to count due items by moving their score to lease_until and returns them,
+# so concurrent schedulers never claim the same item while its lease runs. Ids whose
+# item is gone are dropped from the schedule.
+CLAIM_DEFERRED_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local items = {}
+for _, id in ipairs(ids) do
+    local item = redis.call('HGET', KEYS[2], id)
+    if item then
+        redis.call('ZADD', KEYS[1], ARGV[3], id)
+        items[#items + 1] = item
+    else
+        redis.call('ZREM', KEYS[1], id)
+    end
+end
+return items
+"""
+
+# KEYS = schedule zset, items hash; ARGV = (id, due_at, item json) triples.
+# Puts claimed items back unless they were cancelled while leased; returns how many were.
+RESCHEDULE_DEFERRED_SCRIPT = """
+local rescheduled = 0
+for index = 1, #ARGV, 3 do
+    if redis.call('HEXISTS', KEYS[2], ARGV[index]) == 1 then
+        redis.call('ZADD', KEYS[1], ARGV[index + 1], ARGV[index])
+        redis.call('HSET', KEYS[2], ARGV[index], ARGV[index + 2])
+        rescheduled = rescheduled + 1
+    end
+end
+return rescheduled
+"""
+
+def encode_deferred(item):
+    return json.dumps(item._asdict())
+
+def decode_deferred(value):
+    return DeferredNotification(**json.loads(value))
+
+class RedisSchedule:
+    """Deferred notifications shared by every worker and replica through Redis.
+
+    A sorted set orders item ids by the time they are due and a hash holds the items.
+    Keys sit outside the ``<prefix>:`` rate-limit namespace so clearing notifications
+    never removes pending items.
+    """
+
+    def __init__(self, redis_client, key_prefix='ratelimit', max_size=DEFAULT_MAX_SIZE, add_timeout=None):
+        self.redis_client = redis_client
+        self.schedule_key = f"{key_prefix}.deferred"
+        self.items_key = f"{key_prefix}.deferred.items"
+        self.max_size = max_size
+        # Deadline for add, which runs on the request path
+        self.add_timeout = add_timeout
+        self._add_script = redis_client.register_script(ADD_DEFERRED_SCRIPT)
+        self._claim_script = redis_client.register_script(CLAIM_DEFERRED_SCRIPT)
+        self._reschedule_script = redis_client.register_script(RESCHEDULE_DEFERRED_SCRIPT)
+
+    async def add(self, items):
+        """Schedule ``items`` in order while fewer than ``max_size`` are pending; returns how many were added.
+
+        Adds nothing while Redis is unavailable, so the notifications are rejected as over their limit.
+        """
+        args = [self.max_size]
+        for item in items:
+            args += [item.id, item.due_at, encode_deferred(item)]
+        try:
+            return await asyncio.wait_for(
+                self._add_script(keys=[self.schedule_key, self.items_key], args=args), self.add_timeout
+            )
+        except (RedisError, OSError, asyncio.TimeoutError):
+            logger.warning("Could not defer %d notifications", len(items), exc_info=True)
+            return 0
+
+    async def claim(self, now, count, lease_until):
+        """Return up to ``count`` items due by ``now``, hidden from other claims until ``lease_until``."""
+        values = await self._claim_script(keys=[self.schedule_key, self.items_key], args=[now, count, lease_until])
+        return [decode_deferred(value) for value in values if value]
+
+    async def reschedule(self, items):
+        """Put claimed ``items`` back at their new ``due_at`` unless they were cancelled meanwhile;
+        returns how many were put back.
+        """
+        args = []
+        for item in items:
+            args += [item.id, item.due_at, encode_deferred(item)]
+        return await self._reschedule_script(keys=[self.schedule_key, self.items_key], args=args)
+
+    async def complete(self, ids):
+        pipeline = self.redis_client.pipeline(transaction=True)
+        pipeline.zrem(self.schedule_key, *ids)
+        pipeline.hdel(self.items_key, *ids)
+        await pipeline.execute()
+
+    async def cancel(self, deferred_id):
+        pipeline = self.redis_client.pipeline(transaction=True)
+        pipeline.zrem(self.schedule_key, deferred_id)
+        pipeline.hdel(self.items_key, deferred_id)
+        removed, _ = await pipeline.execute()
+        return bool(removed)
+
+    async def get(self, deferred_id):
+        value = await self.redis_client.hget(self.items_key, deferred_id)
+        return decode_deferred(value) if value else None
+
+    async def list(self, offset=0, count=100):
+        pipeline = self.redis_client.pipeline(transaction=True)
+        pipeline.zcard(self.schedule_key)
+        pipeline.zrange(self.schedule_key, offset, offset + count - 1)
+        total, ids = await pipeline.execute()
+        values = await self.redis_client.hmget(self.items_key, ids) if ids else []
+        return total, [decode_deferred(value) for value in values if value]
+
+class InMemorySchedule:
+    """Process-local schedule for the ``memory`` backend with the interface of ``RedisSchedule``."""
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._items = {}
+        # id -> due time, or lease expiry while claimed
+        self._scores = {}
+
+    def _ordered(self):
+        return sorted(self._scores, key=lambda deferred_id: (self._scores[deferred_id], deferred_id))
+
+    async def add(self, items):
+        added = 0
+        for item in items:
+            if len(self._scores) >= self.max_size:
+                break
+            self._items[item.id] = item
+            self._scores[item.id] = item.due_at
+            added += 1
+        return added
+
+    async def claim(self, now, count, lease_until):
+        due = [deferred_id for deferred_id in self._ordered() if self._scores[deferred_id] <= now][:count]
+        for deferred_id in due:
+            self._scores[deferred_id] = lease_until
+        return [self._items[deferred_id] for deferred_id in due]
+
+    async def reschedule(self, items):
+        rescheduled = 0
+        for item in items:
+            if item.id in self._items:
+                self._items[item.id] = item
+                self._scores[item.id] = item.due_at
+                rescheduled += 1
+        return rescheduled
+
+    async def complete(self, ids):
+        for deferred_id in ids:
+            self._items.pop(deferred_id, None)
+            self._scores.pop(deferred_id, None)
+
+    async def cancel(self, deferred_id):
+        self._items.pop(deferred_id, None)
+        return self._scores.pop(deferred_id, None) is not None
+
+    async def get(self, deferred_id):
+        return self._items.get(deferred_id)
+
+    async def list(self, offset=0, count=100):
+        return len(self._scores), [self._items[deferred_id] for deferred_id in self._ordered()[offset:offset + count]]
+
+class DeferredScheduler:
+    """Background task sending due deferred notifications through ``send_batch_async``.
+
+    Items are claimed ``batch_size`` at a time under a lease, so every worker of every
+    replica can run a scheduler, and items held by a worker that died become due again
+    once their lease expires. Items still over their limit are put back at the new
+    ``retry_after`` and dropped after ``max_attempts``.
+    """
+
+    def __init__(self, service, schedule, interval=DEFAULT_POLL_INTERVAL, batch_size=DEFAULT_BATCH_SIZE,
+                 lease=DEFAULT_LEASE, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.service = service
+        self.schedule = schedule
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.delivered = 0
+        self.rescheduled = 0
+        self.dropped = 0
+
+    async def run(self):
+        """Drain due items until cancelled, sleeping ``interval`` seconds whenever a batch comes back short."""
+        while True:
+            try:
+                drained = await self.drain_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Deferred scheduler failed, retrying in %.0fs", self.interval, exc_info=True)
+                drained = 0
+            if drained < self.batch_size:
+                await asyncio.sleep(self.interval)
+
+    async def drain_due(self, now=None):
+        """Send one batch of due items and return how many were claimed."""
+        now = time.time() if now is None else now
+        items = await self.schedule.claim(now, self.batch_size, now + self.lease)
+        if not items:
+            return 0
+        results = await self.service.send_batch_async(
+            [(item.notification_type, item.recipient, item.message) for item in items], defer=[False] * len(items)
+        )
+        done, retry = [], []
+        for item, result in zip(items, results):
+            if isinstance(result, (RateLimitExceededException, DeliveryQueueFullException)):
+                if item.attempts + 1 < self.max_attempts:
+                    retry_after = getattr(result, 'retry_after', None) or 1.0
+                    retry.append(item._replace(due_at=now + retry_after, attempts=item.attempts + 1))
+                    continue
+                logger.warning("Dropping deferred %s notification to %s after %d attempts",
+                               item.notification_type, item.recipient, self.max_attempts)
+                self.dropped += 1
+            elif isinstance(result, ValueError):
+                # The type was removed while the item waited
+                self.dropped += 1
+            else:
+                self.delivered += 1
+            done.append(item.id)
+        if retry:
+            self.rescheduled += await self.schedule.reschedule(retry)
+        if done:
+            await self.schedule.complete(done)
+        return len(items)
+
+    def stats(self):
+        return {"delivered": self.delivered, "rescheduled": self.rescheduled, "dropped": self.dropped}
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import NamedTuple
+from domain.exceptions import DeliveryQueueFullException
+
+logger = logging.getLogger(__name__)
+
+# Number of recent samples the latency percentiles are computed from
+LATENCY_SAMPLES = 1024
+
+class Delivery(NamedTuple):
+    notification_type: str
+    recipient: str
+    message: str
+    enqueued_at: float
+
+class PrintSender:
+    """Stand-in delivery provider; production swaps in an SMTP or provider client."""
+
+    async def send_batch(self, deliveries):
+        for delivery in deliveries:
+            print(f"Sending '{delivery.message}' to {delivery.recipient}")
+
+def _percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+class DeliveryQueue:
+    """Bounded hand-off between request handlers and a pool of async delivery workers.
+
+    Handlers ``reserve`` a slot before recording a notification against the rate limit
+    and ``submit`` it once allowed (or ``release`` the slot when denied), so a full queue
+    is reported before any quota is spent. Workers pull up to ``batch_size`` deliveries at
+    a time and hand them to ``sender.send_batch``.
+    """
+
+    def __init__(self, sender, max_size=10000, workers=4, batch_size=50):
+        self.sender = sender
+        self.max_size = max_size
+        self.workers = workers
+        self.batch_size = batch_size
+        self._queue = None
+        self._tasks = []
+        self._reserved = 0
+        self._closed = False
+        self.delivered = 0
+        self.failed = 0
+        self.rejected = 0
+        self._wait_times = deque(maxlen=LATENCY_SAMPLES)
+        self._send_times = deque(maxlen=LATENCY_SAMPLES)
+
+    def start(self):
+        # The asyncio.Queue is created here so it binds to the running event loop
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def reserve(self, count=1):
+        if self._closed or self.depth() + self._reserved + count > self.max_size:
+            self.rejected += count
+            raise DeliveryQueueFullException("Delivery queue is full, retry later")
+        self._reserved += count
+
+    def release(self, count=1):
+        self._reserved -= count
+
+    def submit(self, notification_type, recipient, message):
+        """Enqueue a delivery into a slot previously taken with ``reserve``."""
+        self.start()
+        self._reserved -= 1
+        self._queue.put_nowait(Delivery(notification_type, recipient, message, time.monotonic()))
+
+    async def _work(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            started = time.monotonic()
+            for delivery in batch:
+                self._wait_times.append(started - delivery.enqueued_at)
+            try:
+                await self.sender.send_batch(batch)
+                self.delivered += len(batch)
+            except Exception:
+                self.failed += len(batch)
+                logger.exception("Failed to deliver %d notifications", len(batch))
+            finally:
+                self._send_times.append(time.monotonic() - started)
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def drain(self, timeout=10.0):
+        """Stop accepting deliveries, wait up to ``timeout`` seconds for the queue to empty
+        and stop the workers. Returns the number of deliveries left undelivered.
+        """
+        self._closed = True
+        if self._queue is None:
+            return 0
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Delivery queue drain timed out with %d notifications pending", self.depth())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        return self.depth()
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "max_size": self.max_size,
+            "reserved": self._reserved,
+            "workers": self.workers,
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_seconds_p50": _percentile(self._wait_times, 0.5),
+            "wait_seconds_p99": _percentile(self._wait_times, 0.99),
+            "send_seconds_p50": _percentile(self._send_times, 0.5),
+            "send_seconds_p99": _percentile(self._send_times, 0.99),
+        }
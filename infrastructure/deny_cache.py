@@ -0,0 +1,47 @@
+import threading
+from collections import OrderedDict
+
+class DenyCache:
+    """Bounded in-process record of (recipient, notification_type) pairs that are over
+    their limit, so repeated requests can be rejected without a Redis round trip.
+
+    Entries expire at the time the repository reported the window frees up; the least
+    recently blocked entries are evicted once ``max_size`` is reached.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._blocked_until = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def get(self, recipient, notification_type, now):
+        """Return the timestamp the pair is blocked until, or ``None`` if it is not blocked."""
+        key = (recipient, notification_type)
+        with self._lock:
+            blocked_until = self._blocked_until.get(key)
+            if blocked_until is None:
+                return None
+            if blocked_until <= now:
+                del self._blocked_until[key]
+                return None
+            self._blocked_until.move_to_end(key)
+            self.hits += 1
+            return blocked_until
+
+    def block(self, recipient, notification_type, blocked_until):
+        if self.max_size <= 0:
+            return
+        key = (recipient, notification_type)
+        with self._lock:
+            self._blocked_until[key] = blocked_until
+            self._blocked_until.move_to_end(key)
+            while len(self._blocked_until) > self.max_size:
+                self._blocked_until.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._blocked_until.clear()
+
+    def __len__(self):
+        return len(self._blocked_until)
@@ -0,0 +1,333 @@
+import threading
+from array import array
+from itertools import islice
+from datetime import datetime
+from domain.notification import RATE_LIMIT_STRATEGIES
+
+DEFAULT_SHARDS = 16
+DEFAULT_EVICTION_INTERVAL = 30.0
+
+class TimestampRing:
+    """Fixed-capacity ring buffer of float timestamps in arrival order, backed by a
+    compact ``array('d')`` instead of a list of Python floats. Grows when full.
+    """
+    __slots__ = ('_buffer', '_start', '_size')
+
+    def __init__(self, capacity):
+        self._buffer = array('d', [0.0]) * max(capacity, 1)
+        self._start = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def oldest(self):
+        return self._buffer[self._start]
+
+    def trim(self, cutoff):
+        """Drop timestamps less than or equal to ``cutoff`` from the oldest end."""
+        capacity = len(self._buffer)
+        while self._size and self._buffer[self._start] <= cutoff:
+            self._start = (self._start + 1) % capacity
+            self._size -= 1
+
+    def append(self, timestamp):
+        if self._size == len(self._buffer):
+            self._grow(self._size * 2)
+        self._buffer[(self._start + self._size) % len(self._buffer)] = timestamp
+        self._size += 1
+
+    def reserve(self, capacity):
+        if capacity > len(self._buffer):
+            self._grow(capacity)
+
+    def count_after(self, cutoff):
+        capacity = len(self._buffer)
+        return sum(1 for offset in range(self._size) if self._buffer[(self._start + offset) % capacity] > cutoff)
+
+    def _grow(self, capacity):
+        buffer = array('d', [0.0]) * capacity
+        old_capacity = len(self._buffer)
+        for offset in range(self._size):
+            buffer[offset] = self._buffer[(self._start + offset) % old_capacity]
+        self._buffer = buffer
+        self._start = 0
+
+class _Entry:
+    __slots__ = ('algorithm', 'state', 'expires_at', 'max_count', 'period')
+
+    def __init__(self, algorithm, state):
+        self.algorithm = algorithm
+        self.state = state
+        self.expires_at = 0.0
+        self.max_count = 0
+        self.period = 0
+
+class _Shard:
+    __slots__ = ('lock', 'entries')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+class InMemoryRepository:
+    """Process-local rate-limit storage with the same interface as ``RedisRepository``.
+
+    State is spread over lock-striped shards so concurrent threads rarely contend,
+    ``sliding_log`` windows are kept in array-backed ring buffers and the other
+    algorithms reuse the constant-size state of the domain strategies. A daemon thread
+    evicts expired entries every ``eviction_interval`` seconds.
+    """
+
+    def __init__(self, shards=DEFAULT_SHARDS, eviction_interval=DEFAULT_EVICTION_INTERVAL):
+        self._shards = [_Shard() for _ in range(shards)]
+        self._stopped = threading.Event()
+        self._evictor = None
+        if eviction_interval:
+            self._evictor = threading.Thread(
+                target=self._evict_periodically, args=(eviction_interval,), name="rate-limit-evictor", daemon=True
+            )
+            self._evictor.start()
+
+    def _shard(self, key):
+        # Sharded by recipient, like the Redis hash tag, so one lock covers all of its windows
+        return self._shards[hash(key[0]) % len(self._shards)]
+
+    def try_acquire(self, recipient, notification_type, max_count, period, now, algorithm='sliding_log'):
+        key = (recipient, notification_type)
+        shard = self._shard(key)
+        with shard.lock:
+            allowed, remaining, retry_after, commit = self._check(shard, key, max_count, period, now.timestamp(), algorithm)
+            if allowed:
+                commit()
+            return allowed, remaining, retry_after
+
+    def try_acquire_many(self, requests, now):
+        return [
+            self.try_acquire(recipient, notification_type, max_count, period, now, algorithm)
+            for recipient, notification_type, max_count, period, algorithm in requests
+        ]
+
+    def try_acquire_limits(self, recipient, limits, now):
+        """Record the notification in every ``RateLimit`` window only if all of them allow
+        it; returns ``(allowed, remaining, retry_after, denied)`` like ``RedisRepository``.
+        """
+        shard = self._shard((recipient,))
+        timestamp = now.timestamp()
+        with shard.lock:
+            commits, remaining, retry_after, denied = [], None, 0.0, None
+            for index, limit in enumerate(limits):
+                allowed, left, wait, commit = self._check(
+                    shard, (recipient, limit.scope), limit.max_count, limit.period, timestamp, limit.algorithm
+                )
+                if allowed:
+                    commits.append(commit)
+                    remaining = left if remaining is None else min(remaining, left)
+                elif denied is None or wait > retry_after:
+                    denied, retry_after = index, wait
+            if denied is not None:
+                return False, 0, retry_after, denied
+            for commit in commits:
+                commit()
+            return True, remaining, 0.0, None
+
+    def try_acquire_limits_many(self, requests, now):
+        return [self.try_acquire_limits(recipient, limits, now) for recipient, limits in requests]
+
+    def _check(self, shard, key, max_count, period, now, algorithm):
+        """Decide one window without changing it; returns ``(allowed, remaining, retry_after, commit)``
+        where calling ``commit`` records the notification.
+        """
+        if algorithm not in RATE_LIMIT_STRATEGIES:
+            raise ValueError(f"Unknown rate limit algorithm {algorithm}")
+        entry = shard.entries.get(key)
+        # Expired entries and state left by another algorithm start over, as in Redis; a
+        # fresh entry is only stored once a notification is recorded in it
+        if entry is None or entry.expires_at <= now or entry.algorithm != algorithm:
+            entry = _Entry(algorithm, TimestampRing(max_count) if algorithm == 'sliding_log' else None)
+        entry.max_count, entry.period = max_count, period
+
+        if algorithm == 'sliding_log':
+            ring = entry.state
+            ring.trim(now - period)
+            if len(ring) >= max_count:
+                retry_after = ring.oldest() + period - now if len(ring) else period
+                return False, 0, max(retry_after, 0.0), None
+
+            def commit():
+                ring.reserve(max_count)
+                ring.append(now)
+                entry.expires_at = now + period
+                shard.entries[key] = entry
+            return True, max_count - len(ring) - 1, 0.0, commit
+
+        (allowed, remaining, retry_after), state = RATE_LIMIT_STRATEGIES[algorithm].acquire(
+            entry.state, max_count, period, now
+        )
+
+        def commit():
+            entry.state = state
+            entry.expires_at = state if algorithm == 'gcra' else now + 2 * period
+            shard.entries[key] = entry
+        return allowed, remaining, retry_after, commit
+
+    def cleanup_old_notifications(self, recipient, notification_type, period, now):
+        key = (recipient, notification_type)
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is not None and entry.algorithm == 'sliding_log':
+                entry.state.trim(now.timestamp() - period)
+
+    def get_notification_count(self, recipient, notification_type, period, now):
+        key = (recipient, notification_type)
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None or entry.algorithm != 'sliding_log' or entry.expires_at <= now.timestamp():
+                return 0
+            return len(entry.state)
+
+    def log_notification(self, recipient, notification_type, timestamp, ttl):
+        key = (recipient, notification_type)
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None or entry.algorithm != 'sliding_log':
+                entry = _Entry('sliding_log', TimestampRing(1))
+                entry.period = ttl
+                shard.entries[key] = entry
+            entry.state.append(timestamp.timestamp())
+            entry.expires_at = timestamp.timestamp() + ttl
+
+    def clear_all_notifications(self, notification_type=None, progress=None):
+        deleted = 0
+        for shard in self._shards:
+            with shard.lock:
+                if notification_type is None:
+                    deleted += len(shard.entries)
+                    shard.entries.clear()
+                else:
+                    # Extra windows of the type are stored as ``<type>@<period>``
+                    keys = [
+                        key for key in shard.entries
+                        if key[1] == notification_type or key[1].startswith(f"{notification_type}@")
+                    ]
+                    for key in keys:
+                        del shard.entries[key]
+                    deleted += len(keys)
+            if progress is not None:
+                progress(deleted)
+        return deleted
+
+    def get_all_usage(self, notification_type=None, recipient_prefix=None):
+        return dict(self.iter_usage(notification_type, recipient_prefix))
+
+    def scan_usage(self, cursor=0, count=500, notification_type=None, recipient_prefix=None):
+        """Page through the shards like ``SCAN``: the cursor encodes the shard and the offset
+        inside it, and entries added or evicted during the iteration may be missed.
+        """
+        now = datetime.now().timestamp()
+        shard_index, offset = divmod(cursor, 2 ** 32)
+        usage = {}
+        while shard_index < len(self._shards) and len(usage) < count:
+            shard = self._shards[shard_index]
+            with shard.lock:
+                items = list(islice(shard.entries.items(), offset, offset + count))
+                for (recipient, key_type), entry in items:
+                    offset += 1
+                    # Extra windows of the type count as its keys, as in ``clear_all_notifications``
+                    if notification_type is not None and key_type.partition('@')[0] != notification_type:
+                        continue
+                    if recipient_prefix is not None and not recipient.startswith(recipient_prefix):
+                        continue
+                    used = self._usage(entry, now)
+                    if used:
+                        usage[f"{recipient}:{key_type}"] = used
+            if len(items) < count:
+                shard_index, offset = shard_index + 1, 0
+        next_cursor = 0 if shard_index >= len(self._shards) else shard_index * 2 ** 32 + offset
+        return next_cursor, usage
+
+    def iter_usage(self, notification_type=None, recipient_prefix=None, count=500):
+        cursor = 0
+        while True:
+            cursor, usage = self.scan_usage(cursor, count, notification_type, recipient_prefix)
+            yield from usage.items()
+            if cursor == 0:
+                break
+
+    def _usage(self, entry, now):
+        if entry.expires_at <= now:
+            return 0
+        if entry.algorithm == 'sliding_log':
+            return entry.state.count_after(now - entry.period)
+        return RATE_LIMIT_STRATEGIES[entry.algorithm].usage(entry.state, entry.max_count, entry.period, now)
+
+    def evict_expired(self):
+        now = datetime.now().timestamp()
+        evicted = 0
+        for shard in self._shards:
+            with shard.lock:
+                expired = [key for key, entry in shard.entries.items() if entry.expires_at <= now]
+                for key in expired:
+                    del shard.entries[key]
+                evicted += len(expired)
+        return evicted
+
+    def _evict_periodically(self, interval):
+        while not self._stopped.wait(interval):
+            self.evict_expired()
+
+    def close(self):
+        self._stopped.set()
+
+class AsyncInMemoryRepository:
+    """Coroutine interface over ``InMemoryRepository`` for the async request path; every
+    operation is a short in-process critical section, so it runs directly on the event loop.
+    """
+
+    def __init__(self, shards=DEFAULT_SHARDS, eviction_interval=DEFAULT_EVICTION_INTERVAL):
+        self.repository = InMemoryRepository(shards, eviction_interval)
+
+    async def try_acquire(self, recipient, notification_type, max_count, period, now, algorithm='sliding_log'):
+        return self.repository.try_acquire(recipient, notification_type, max_count, period, now, algorithm)
+
+    async def try_acquire_many(self, requests, now):
+        return self.repository.try_acquire_many(requests, now)
+
+    async def try_acquire_limits(self, recipient, limits, now):
+        return self.repository.try_acquire_limits(recipient, limits, now)
+
+    async def try_acquire_limits_many(self, requests, now):
+        return self.repository.try_acquire_limits_many(requests, now)
+
+    async def cleanup_old_notifications(self, recipient, notification_type, period, now):
+        self.repository.cleanup_old_notifications(recipient, notification_type, period, now)
+
+    async def get_notification_count(self, recipient, notification_type, period, now):
+        return self.repository.get_notification_count(recipient, notification_type, period, now)
+
+    async def log_notification(self, recipient, notification_type, timestamp, ttl):
+        self.repository.log_notification(recipient, notification_type, timestamp, ttl)
+
+    async def clear_all_notifications(self, notification_type=None, progress=None):
+        return self.repository.clear_all_notifications(notification_type, progress)
+
+    async def get_all_usage(self, notification_type=None, recipient_prefix=None):
+        return self.repository.get_all_usage(notification_type, recipient_prefix)
+
+    async def scan_usage(self, cursor=0, count=500, notification_type=None, recipient_prefix=None):
+        return self.repository.scan_usage(cursor, count, notification_type, recipient_prefix)
+
+    async def iter_usage(self, notification_type=None, recipient_prefix=None, count=500):
+        cursor = 0
+        while True:
+            cursor, usage = self.repository.scan_usage(cursor, count, notification_type, recipient_prefix)
+            for item in usage.items():
+                yield item
+            if cursor == 0:
+                break
+
+    async def close(self):
+        self.repository.close()
@@ -0,0 +1,188 @@
+import os
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+# Upper bounds in seconds, from sub-millisecond cache hits to slow Redis or provider calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Stage timings of the request being handled, set by ServerTimingMiddleware
+_request_timings = ContextVar("request_timings", default=None)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    """Fixed-bucket histogram; ``observe`` is one bisect and three additions per call."""
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> per-bucket counts (the last one is +Inf), then sum and count
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def count(self, *label_values):
+        series = self._series.get(label_values)
+        return series[-1] if series is not None else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), series):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, label_values, [("le", bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    __slots__ = ("metrics", "name", "started")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        elapsed = time.perf_counter() - self.started
+        self.metrics.stage_seconds.observe(elapsed, self.name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((self.name, elapsed))
+        return False
+
+class Metrics:
+    """Hot-path latency histograms and outcome counters, exported in the Prometheus
+    text format. While disabled every call returns before reading the clock.
+    """
+
+    def __init__(self, enabled=False, server_timing=False):
+        # Server-Timing headers are built from the stage timers, so they imply collection
+        self.enabled = enabled or server_timing
+        self.server_timing = server_timing
+        self.stage_seconds = Histogram(
+            "notification_stage_duration_seconds", "Time spent in each stage of a request.", ("stage",)
+        )
+        self.send_seconds = Histogram(
+            "notification_send_duration_seconds", "End-to-end /send-notification/ latency.",
+            ("notification_type", "outcome")
+        )
+        self.sends = Counter(
+            "notifications_total", "Notifications handled by outcome status code.", ("notification_type", "outcome")
+        )
+
+    def stage(self, name):
+        """Context manager timing one stage (``jwt``, ``validation``, ``repository``, ``delivery``)."""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def record_send(self, notification_type, outcome, started):
+        if self.enabled:
+            self.send_seconds.observe(time.perf_counter() - started, notification_type, str(outcome))
+            self.sends.inc(notification_type, str(outcome))
+
+    def count_send(self, notification_type, outcome):
+        if self.enabled:
+            self.sends.inc(notification_type, str(outcome))
+
+    def render(self, samples=()):
+        """Render the collected metrics followed by ``(name, type, help, value)`` samples
+        read from other components at scrape time.
+        """
+        lines = []
+        for name, kind, documentation, value in samples:
+            lines.extend((f"# HELP {name} {documentation}", f"# TYPE {name} {kind}", f"{name} {_format_value(value)}"))
+        if self.enabled:
+            for metric in (self.stage_seconds, self.send_seconds, self.sends):
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+class ServerTimingMiddleware:
+    """ASGI middleware adding a ``Server-Timing`` header with the stages timed during the request."""
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = []
+        token = _request_timings.set(timings)
+        started = time.perf_counter()
+
+        async def send_with_timings(message):
+            if message["type"] == "http.response.start":
+                entries = [f"{name};dur={elapsed * 1000:.3f}" for name, elapsed in timings]
+                entries.append(f"total;dur={(time.perf_counter() - started) * 1000:.3f}")
+                message = dict(message, headers=list(message.get("headers", [])) + [
+                    (b"server-timing", ", ".join(entries).encode())
+                ])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            _request_timings.reset(token)
+
+metrics = Metrics(
+    enabled=os.getenv('METRICS_ENABLED', '0') != '0',
+    server_timing=os.getenv('SERVER_TIMING', '0') != '0',
+)
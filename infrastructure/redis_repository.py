@@ -1,32 +1,750 @@
+import base64
+import functools
+import hashlib
+import logging
+import re
 import redis
 from datetime import datetime, timedelta
+from domain.notification import RateLimit
+
+# Lua ports of the strategies in domain.notification. Each algorithm checks one window
+# and returns allowed, remaining, retry_after and, when allowed, a function recording
+# the notification, so several windows can be checked before any of them is updated.
+# retry_after is returned as a string because Redis truncates Lua numbers to integers.
+# State left by a different algorithm is discarded, so switching a type's algorithm
+# resets its counters. Scripts of the compact key encoding set ``compact``: sliding_log
+# then scores entries in integer milliseconds and names them by their hex timestamp.
+RATE_LIMIT_LUA = """
+local EPSILON = 1e-9
+local compact = false
+
+local function score_of(timestamp)
+    if compact then
+        return math.floor(timestamp * 1000)
+    end
+    return timestamp
+end
+
+-- Entries recorded at the same instant get a numbered suffix instead of overwriting each other
+local function add_unique(key, score, member)
+    local unique, suffix = member, 0
+    while redis.call('ZADD', key, 'NX', score, unique) == 0 do
+        suffix = suffix + 1
+        unique = member .. '.' .. suffix
+    end
+end
+
+local function reset_unless(key, expected_type, expected_field)
+    local current = redis.call('TYPE', key)['ok']
+    if current == 'none' then
+        return
+    end
+    if current ~= expected_type or (expected_field and redis.call('HEXISTS', key, expected_field) == 0) then
+        redis.call('DEL', key)
+    end
+end
+
+local function sliding_log(key, now, period, max_count, member)
+    reset_unless(key, 'zset')
+    redis.call('ZREMRANGEBYSCORE', key, 0, score_of(now - period))
+    local count = redis.call('ZCARD', key)
+    if count >= max_count then
+        local retry_after = period
+        local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+        if oldest[2] then
+            retry_after = tonumber(oldest[2]) / score_of(1) + period - now
+        end
+        return 0, 0, retry_after
+    end
+    return 1, max_count - count - 1, 0, function()
+        local score = score_of(now)
+        add_unique(key, score, compact and string.format('%x', score) or member)
+        redis.call('EXPIRE', key, math.ceil(period))
+    end
+end
+
+local function gcra(key, now, period, max_count)
+    reset_unless(key, 'hash', 'tat')
+    local interval = period / max_count
+    local tat = tonumber(redis.call('HGET', key, 'tat')) or now
+    if tat < now then
+        tat = now
+    end
+    local new_tat = tat + interval
+    local allow_at = new_tat - period
+    if allow_at > now + EPSILON then
+        return 0, 0, allow_at - now
+    end
+    return 1, math.floor((now - allow_at) / interval + EPSILON), 0, function()
+        redis.call('HSET', key, 'tat', string.format('%.6f', new_tat), 'i', tostring(interval))
+        redis.call('PEXPIRE', key, math.ceil((new_tat - now) * 1000))
+    end
+end
+
+local function window_counts(key, now, period)
+    local window = math.floor(now / period) * period
+    local state = redis.call('HMGET', key, 'w', 'c', 'p')
+    local stored_window = tonumber(state[1])
+    local current, previous = 0, 0
+    if stored_window == window then
+        current, previous = tonumber(state[2]), tonumber(state[3])
+    elseif stored_window == window - period then
+        previous = tonumber(state[2])
+    end
+    return window, current, previous
+end
+
+local function sliding_window(key, now, period, max_count)
+    reset_unless(key, 'hash', 'w')
+    local window, current, previous = window_counts(key, now, period)
+    local elapsed = now - window
+    local estimate = previous * (period - elapsed) / period + current
+    if estimate + 1 > max_count + EPSILON then
+        local retry_after
+        if current + 1 <= max_count then
+            retry_after = (1 - (max_count - current - 1) / previous) * period - elapsed
+        else
+            retry_after = period - elapsed + math.max(0, 1 - (max_count - 1) / current) * period
+        end
+        return 0, 0, math.max(retry_after, 0)
+    end
+    return 1, math.floor(max_count - estimate - 1 + EPSILON), 0, function()
+        redis.call('HSET', key, 'w', tostring(window), 'c', current + 1, 'p', previous, 'n', tostring(period))
+        redis.call('EXPIRE', key, math.ceil(period * 2))
+    end
+end
+
+local function usage(key, now)
+    local key_type = redis.call('TYPE', key)['ok']
+    if key_type == 'zset' then
+        return redis.call('ZCARD', key)
+    elseif key_type == 'hash' then
+        local tat, interval = unpack(redis.call('HMGET', key, 'tat', 'i'))
+        if tat then
+            return math.max(0, math.ceil((tonumber(tat) - now) / tonumber(interval) - EPSILON))
+        end
+        local period = tonumber(redis.call('HGET', key, 'n'))
+        local window, current, previous = window_counts(key, now, period)
+        return math.ceil(previous * (period - (now - window)) / period + current - EPSILON)
+    end
+    return 0
+end
+
+local ALGORITHMS = {sliding_log = sliding_log, gcra = gcra, sliding_window = sliding_window}
+"""
+
+# Checks KEYS[1..windows] against ARGV = now, member, then algorithm, period and max_count
+# of every window. The notification is recorded in all windows only if every window
+# allows it. Returns {allowed, remaining, retry_after, denied}: the smallest remaining
+# quota, or the longest wait and the 1-based index of the key that imposes it.
+ACQUIRE_LUA = """
+local function acquire(windows)
+    local now, member = tonumber(ARGV[1]), ARGV[2]
+    local commits, remaining, retry_after, denied = {}, nil, 0, 0
+    for index = 1, windows do
+        local offset = 3 * index
+        local algorithm = ALGORITHMS[ARGV[offset]]
+        if not algorithm then
+            return redis.error_reply('unknown rate limit algorithm ' .. ARGV[offset])
+        end
+        local allowed, left, wait, commit = algorithm(KEYS[index], now, tonumber(ARGV[offset + 1]), tonumber(ARGV[offset + 2]), member)
+        if allowed == 1 then
+            commits[#commits + 1] = commit
+            if remaining == nil or left < remaining then
+                remaining = left
+            end
+        elseif denied == 0 or wait > retry_after then
+            denied, retry_after = index, wait
+        end
+    end
+    if denied > 0 then
+        return {0, 0, tostring(math.max(retry_after, 0)), denied}
+    end
+    for _, commit in ipairs(commits) do
+        commit()
+    end
+    return {1, remaining, '0', 0}
+end
+"""
+
+# KEYS = one rate-limit key per window; ARGV as for ``acquire``
+TRY_ACQUIRE_SCRIPT = RATE_LIMIT_LUA + ACQUIRE_LUA + """
+return acquire(#KEYS)
+"""
+
+# Records the recipient, and the scope of each code, in a recipient's directory hash so
+# usage can be reported by name; it lives as long as the longest window of the recipient.
+DIRECTORY_LUA = """
+local function record_directory(directory, ttl, offset)
+    local fields = {'r', ARGV[offset]}
+    for index = offset + 1, #ARGV do
+        fields[#fields + 1] = ARGV[index]
+    end
+    redis.call('HSET', directory, unpack(fields))
+    if ttl > 0 and redis.call('TTL', directory) < ttl then
+        redis.call('EXPIRE', directory, ttl)
+    end
+end
+"""
+
+# Compact encoding: KEYS = one key per window, then the recipient's directory; ARGV as for
+# ``acquire``, followed by the recipient and a (code, scope) pair per window.
+COMPACT_TRY_ACQUIRE_SCRIPT = RATE_LIMIT_LUA + ACQUIRE_LUA + DIRECTORY_LUA + """
+compact = true
+local windows = #KEYS - 1
+local reply = acquire(windows)
+if reply[1] == 1 then
+    local ttl = 0
+    for index = 1, windows do
+        ttl = math.max(ttl, math.ceil(2 * tonumber(ARGV[3 * index + 1])))
+    end
+    record_directory(KEYS[windows + 1], ttl, 3 * windows + 3)
+end
+return reply
+"""
+
+# KEYS = plain key, compact key, directory; ARGV = recipient, code, scope. Moves one key of
+# the plain layout into the compact one, merging sliding_log entries into any compact
+# entries recorded meanwhile and keeping existing compact state of the other algorithms.
+MIGRATE_KEY_SCRIPT = RATE_LIMIT_LUA + DIRECTORY_LUA + """
+compact = true
+local key_type = redis.call('TYPE', KEYS[1])['ok']
+if key_type == 'none' then
+    return 0
+end
+local ttl = redis.call('PTTL', KEYS[1])
+if key_type == 'zset' then
+    local entries = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+    for index = 2, #entries, 2 do
+        local score = score_of(tonumber(entries[index]))
+        add_unique(KEYS[2], score, string.format('%x', score))
+    end
+elseif redis.call('EXISTS', KEYS[2]) == 0 then
+    redis.call('HSET', KEYS[2], unpack(redis.call('HGETALL', KEYS[1])))
+end
+if ttl > 0 and redis.call('PTTL', KEYS[2]) < ttl then
+    redis.call('PEXPIRE', KEYS[2], ttl)
+end
+record_directory(KEYS[3], math.ceil(math.max(ttl, 0) / 1000), 1)
+redis.call('UNLINK', KEYS[1])
+return 1
+"""
+
+# KEYS[1] = rate-limit key; ARGV[1] = now. Returns the number of notifications counted in the window
+USAGE_SCRIPT = RATE_LIMIT_LUA + """
+return usage(KEYS[1], tonumber(ARGV[1]))
+"""
+
+USAGE_SCAN_COUNT = 500
+CLEAR_CHUNK_SIZE = 1000
+MEMORY_SAMPLE_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+def acquire_args(limits, timestamp, member):
+    """``TRY_ACQUIRE_SCRIPT`` arguments for ``domain.notification.RateLimit`` windows."""
+    args = [timestamp, member]
+    for limit in limits:
+        args.extend((limit.algorithm, limit.period, limit.max_count))
+    return args
+
+def parse_decision(result):
+    """Convert a script reply to ``(allowed, remaining, retry_after, denied)`` where
+    ``denied`` is the index of the rejecting window, or None when allowed.
+    """
+    allowed, remaining, retry_after, denied = result
+    return bool(allowed), int(remaining), max(float(retry_after), 0.0), int(denied) - 1 if denied else None
+
+def escape_pattern(value):
+    return re.sub(r'([*?\[\]\\])', r'\\\1', value)
+
+def _digest(value, size):
+    return base64.urlsafe_b64encode(hashlib.blake2b(value.encode(), digest_size=size).digest()).decode()
+
+# Bounded, so filters naming arbitrary types cannot grow it
+@functools.lru_cache(maxsize=1024)
+def type_code(notification_type):
+    """4-character code of a notification type in compact keys."""
+    return _digest(notification_type, 3)
+
+class RedisKeyspace:
+    """Lays out rate-limit keys as ``<prefix>:{<recipient>}:<notification_type>`` so
+    scans and deletes never touch unrelated keys in the same database.
+
+    The braces mark the recipient: every key of one recipient is routed to the same
+    ``REDIS_NODES`` shard, so a script can always touch all of them atomically.
+    """
+    encoding = 'plain'
+    acquire_script = TRY_ACQUIRE_SCRIPT
+
+    def __init__(self, prefix='ratelimit'):
+        self.prefix = prefix
+
+    def key(self, recipient, notification_type):
+        return f"{self.prefix}:{{{recipient}}}:{notification_type}"
+
+    def acquire_call(self, recipient, limits, timestamp, member):
+        """``(keys, args)`` of the ``acquire_script`` call checking ``limits`` for ``recipient``."""
+        return [self.key(recipient, limit.scope) for limit in limits], acquire_args(limits, timestamp, member)
+
+    def score(self, timestamp):
+        return timestamp
+
+    def _pattern(self, recipient_pattern, type_pattern):
+        return f"{escape_pattern(self.prefix)}:{{{recipient_pattern}}}:{type_pattern}"
+
+    def namespace(self):
+        """Pattern matching every key of the namespace, whatever its layout."""
+        return f"{escape_pattern(self.prefix)}:{{*"
+
+    def usage_matches(self, notification_type=None, recipient_prefix=None):
+        """Patterns covering the counters of ``notification_type``, including its extra windows,
+        of recipients starting with ``recipient_prefix``.
+        """
+        recipient_pattern = f"{escape_pattern(recipient_prefix)}*" if recipient_prefix else "*"
+        if notification_type is None:
+            return [self._pattern(recipient_pattern, "*")]
+        type_pattern = escape_pattern(notification_type)
+        return [self._pattern(recipient_pattern, type_pattern), self._pattern(recipient_pattern, f"{type_pattern}@*")]
+
+    def matches(self, notification_type=None):
+        """Patterns covering every key of ``notification_type``, including its extra windows."""
+        return self.usage_matches(notification_type)
+
+    def register(self, notification_types):
+        """Take note of the configured notification types; see ``CompactKeyspace``."""
+
+    def layout(self, key):
+        return 'plain'
+
+    def directories(self, keys):
+        """``(directory, field)`` lookups naming ``keys`` for usage reports; plain keys name themselves."""
+        return []
+
+    def usage_keys(self, keys, names):
+        return [self.usage_key(key) for key in keys]
+
+    def usage_key(self, key):
+        # Usage is reported as ``<recipient>:<notification_type>`` without the namespace
+        recipient, notification_type = key[len(self.prefix) + 2:].rsplit(':', 1)
+        return f"{recipient[:-1]}:{notification_type}"
+
+# Recipient tokens are 16 URL-safe base64 characters; unlike the e-mail addresses of plain
+# keys they never contain '@', which tells the two layouts apart in SCAN patterns
+TOKEN_PATTERN = '[^@]' * 16
+
+class CompactKeyspace(RedisKeyspace):
+    """Lays out keys as ``<prefix>:{<token>}:<code>``: a 96-bit hash of the recipient and a
+    4-character hash of the notification type (``<code>@<period>`` for extra windows), so
+    key length no longer grows with the address. ``sliding_log`` entries are scored in
+    integer milliseconds and named by their hex timestamp.
+
+    Names are kept once per recipient in a directory hash ``<prefix>:{<token>}`` that
+    maps ``r`` to the recipient and each code to its scope, for usage reports.
+    """
+    encoding = 'compact'
+    acquire_script = COMPACT_TRY_ACQUIRE_SCRIPT
+
+    def __init__(self, prefix='ratelimit'):
+        super().__init__(prefix)
+        # Code -> configured notification type, replaced whenever the rule table changes
+        self._types = {}
+
+    @staticmethod
+    def token(recipient):
+        return _digest(recipient, 12)
+
+    def register(self, notification_types):
+        self._types = type_codes(notification_types)
+
+    def code(self, scope):
+        notification_type, at, period = scope.partition('@')
+        code = type_code(notification_type)
+        # A 24-bit code: refuse to touch a configured type's counters for a different name
+        other = self._types.get(code)
+        if other is not None and other != notification_type:
+            raise ValueError(f"Notification type {notification_type} shares the key code {code} with {other}")
+        return code + at + period
+
+    def key(self, recipient, notification_type):
+        return f"{self.prefix}:{{{self.token(recipient)}}}:{self.code(notification_type)}"
+
+    def directory(self, recipient):
+        return f"{self.prefix}:{{{self.token(recipient)}}}"
+
+    def acquire_call(self, recipient, limits, timestamp, member):
+        tagged = self.directory(recipient)
+        codes = [self.code(limit.scope) for limit in limits]
+        args = acquire_args(limits, timestamp, member) + [recipient]
+        for code, limit in zip(codes, limits):
+            args += [code, limit.scope]
+        return [f"{tagged}:{code}" for code in codes] + [tagged], args
+
+    def migration_call(self, plain_key):
+        """``(keys, args)`` of the ``MIGRATE_KEY_SCRIPT`` call moving one plain key."""
+        recipient, scope = RedisKeyspace.usage_key(self, plain_key).rsplit(':', 1)
+        tagged = self.directory(recipient)
+        code = self.code(scope)
+        return [plain_key, f"{tagged}:{code}", tagged], [recipient, code, scope]
+
+    def plain_match(self):
+        # '@' inside the hash tag only occurs in the e-mail addresses of plain keys
+        return self._pattern("*@*", "*")
+
+    def score(self, timestamp):
+        return int(timestamp * 1000)
+
+    def usage_matches(self, notification_type=None, recipient_prefix=None):
+        # Tokens cannot be matched by recipient prefix; usage reports filter by name instead.
+        # Plain keys left over from before a migration are reported too.
+        plain_recipients = f"{escape_pattern(recipient_prefix)}*" if recipient_prefix else "*@*"
+        if notification_type is None:
+            return [self._pattern(TOKEN_PATTERN, "*"), self._pattern(plain_recipients, "*")]
+        patterns = []
+        for recipient_pattern, type_pattern in (
+            (TOKEN_PATTERN, escape_pattern(self.code(notification_type))),
+            (plain_recipients, escape_pattern(notification_type)),
+        ):
+            patterns += [self._pattern(recipient_pattern, type_pattern), self._pattern(recipient_pattern, f"{type_pattern}@*")]
+        return patterns
+
+    def matches(self, notification_type=None):
+        # Plain keys left over from before a migration are covered too
+        if notification_type is None:
+            return [self._pattern("*", "*"), f"{escape_pattern(self.prefix)}:{{{TOKEN_PATTERN}}}"]
+        patterns = []
+        for type_pattern in (escape_pattern(self.code(notification_type)), escape_pattern(notification_type)):
+            patterns += [self._pattern("*", type_pattern), self._pattern("*", f"{type_pattern}@*")]
+        return patterns
+
+    def layout(self, key):
+        tagged, _, code = key.partition('}:')
+        if not code:
+            return 'directory'
+        return 'plain' if '@' in tagged else 'compact'
+
+    def directories(self, keys):
+        lookups = []
+        for key in keys:
+            tagged, _, code = key.partition('}:')
+            lookups.append((tagged + '}', code))
+        return lookups
+
+    def usage_keys(self, keys, names):
+        usage_keys = []
+        for key, (recipient, scope) in zip(keys, names):
+            tagged, _, code = key.partition('}:')
+            usage_keys.append(f"{recipient or tagged[len(self.prefix) + 2:]}:{scope or code}")
+        return usage_keys
+
+def type_codes(notification_types):
+    """Map the compact key code of every notification type to the type, refusing a table in
+    which two types share a code because their counters would be merged.
+    """
+    types = {}
+    for notification_type in notification_types:
+        code = type_code(notification_type)
+        other = types.setdefault(code, notification_type)
+        if other != notification_type:
+            raise ValueError(f"Notification types {other} and {notification_type} share the key code {code}")
+    return types
+
+KEY_ENCODINGS = {keyspace.encoding: keyspace for keyspace in (RedisKeyspace, CompactKeyspace)}
+
+def create_keyspace(key_prefix='ratelimit', key_encoding='plain'):
+    if key_encoding not in KEY_ENCODINGS:
+        raise ValueError(f"Unknown key encoding {key_encoding}")
+    return KEY_ENCODINGS[key_encoding](key_prefix)
+
+def build_memory_report(keyspace, keys, sizes, used_memory, db_keys):
+    """Summarize the ``MEMORY USAGE`` of sampled ``keys`` by layout (``plain``, ``compact``
+    or ``directory``); a sample with plain keys left means a migration is unfinished.
+    """
+    layouts = {}
+    for key, size in zip(keys, sizes):
+        # Keys that expired since the SCAN report no size
+        if size is None:
+            continue
+        layout = layouts.setdefault(keyspace.layout(key), {"keys": 0, "bytes": 0})
+        layout["keys"] += 1
+        layout["bytes"] += size
+    return {
+        "encoding": keyspace.encoding,
+        "used_memory": used_memory,
+        "db_keys": db_keys,
+        "sampled_keys": sum(layout["keys"] for layout in layouts.values()),
+        "sampled_bytes": sum(layout["bytes"] for layout in layouts.values()),
+        "layouts": layouts,
+    }
+
+def merge_memory_reports(reports):
+    merged = dict(reports[0], layouts={})
+    for field in ("used_memory", "db_keys", "sampled_keys", "sampled_bytes"):
+        merged[field] = sum(report[field] for report in reports)
+    for report in reports:
+        for name, layout in report["layouts"].items():
+            total = merged["layouts"].setdefault(name, {"keys": 0, "bytes": 0})
+            total["keys"] += layout["keys"]
+            total["bytes"] += layout["bytes"]
+    return merged
+
+def split_cursor(cursor, scans):
+    # Page cursors interleave the scan in progress (a pattern or a node) with its SCAN cursor
+    return cursor % scans, cursor // scans
+
+def join_cursor(scan, scan_cursor, scans):
+    if scan_cursor:
+        return scan_cursor * scans + scan
+    # This scan is done: continue with the next one, or finish after the last
+    return scan + 1 if scan + 1 < scans else 0
+
+def usage_page(keyspace, keys, results, recipient_prefix=None):
+    """Map ``usage_key`` to count from the usage script replies of ``keys`` followed by
+    their directory lookups.
+    """
+    counts, names = results[:len(keys)], results[len(keys):]
+    # Keys that expired or emptied since the SCAN report 0 and are skipped
+    return {
+        usage_key: count for usage_key, count in zip(keyspace.usage_keys(keys, names), counts)
+        if count and (not recipient_prefix or usage_key.startswith(recipient_prefix))
+    }
+
+def check_migratable(keyspace):
+    if not isinstance(keyspace, CompactKeyspace):
+        raise ValueError("Migrating keys requires the compact key encoding")
+
+def pool_stats(pool):
+    """Return the size and connection counts of a sync or async redis-py pool.
+
+    redis-py exposes no public connection counters, so the counts read attributes that are
+    private to the pinned redis-py version; when a release renames them only
+    ``max_connections`` is reported and the counts are ``None``.
+    """
+    connections = getattr(pool, '_connections', None)
+    idle_queue = getattr(getattr(pool, 'pool', None), 'queue', None)
+    if connections is not None and idle_queue is not None:
+        # Sync BlockingConnectionPool: a LIFO queue of idle connections padded with None
+        created = len(connections)
+        idle = sum(1 for connection in list(idle_queue) if connection is not None)
+    else:
+        available = getattr(pool, '_available_connections', None)
+        in_use = getattr(pool, '_in_use_connections', None)
+        created = idle = None
+        if available is not None and in_use is not None:
+            created, idle = len(available) + len(in_use), len(available)
+    return {
+        "max_connections": pool.max_connections,
+        "created_connections": created,
+        "idle_connections": idle,
+        "in_use_connections": created - idle if created is not None else None,
+    }
+
+def sum_pool_stats(stats):
+    # A count unknown for any node is unknown for the whole cluster
+    return {
+        field: None if any(node_stats[field] is None for node_stats in stats) else sum(node_stats[field] for node_stats in stats)
+        for field in stats[0]
+    }
+
+def create_connection_pool(settings, redis_db=0, host=None, port=None, redis_module=redis):
+    """Build a bounded pool shared by every request for the application lifetime.
+
+    Callers block for up to ``settings.pool_timeout`` seconds when all
+    ``settings.max_connections`` connections are checked out. ``host`` and ``port``
+    override the settings for one node of a sharded deployment. Pass ``redis.asyncio``
+    as ``redis_module`` for a pool of ``AsyncRedisRepository``.
+    """
+    return redis_module.BlockingConnectionPool(
+        host=host or settings.host,
+        port=port or settings.port,
+        db=redis_db,
+        max_connections=settings.max_connections,
+        timeout=settings.pool_timeout,
+        socket_timeout=settings.socket_timeout,
+        socket_connect_timeout=settings.socket_connect_timeout,
+        health_check_interval=settings.health_check_interval,
+        decode_responses=True,
+    )
 
 class RedisRepository:
-    def __init__(self, redis_host='localhost', redis_port=6379, redis_db=0):
-        self.redis_client = redis.StrictRedis(host=redis_host, port=redis_port, db=redis_db, decode_responses=True)
+    def __init__(self, redis_host='localhost', redis_port=6379, redis_db=0, connection_pool=None,
+                 key_prefix='ratelimit', clear_chunk_size=CLEAR_CHUNK_SIZE, key_encoding='plain'):
+        self.keyspace = create_keyspace(key_prefix, key_encoding)
+        self.clear_chunk_size = clear_chunk_size
+        if connection_pool is not None:
+            self.redis_client = redis.StrictRedis(connection_pool=connection_pool)
+        else:
+            self.redis_client = redis.StrictRedis(host=redis_host, port=redis_port, db=redis_db, decode_responses=True)
+        self._try_acquire_script = self.redis_client.register_script(self.keyspace.acquire_script)
+        self._usage_script = self.redis_client.register_script(USAGE_SCRIPT)
+        self._migrate_script = self.redis_client.register_script(MIGRATE_KEY_SCRIPT)
+
+    def register_types(self, notification_types):
+        """Check the configured notification types against each other and remember them, so
+        usage and clear filters naming a different type with the same key code are refused.
+        """
+        self.keyspace.register(notification_types)
+
+    def try_acquire(self, recipient, notification_type, max_count, period, now, algorithm='sliding_log'):
+        """Atomically check the limit and record the notification if allowed.
+
+        Returns a tuple ``(allowed, remaining, retry_after)`` where ``retry_after``
+        is the number of seconds until the oldest entry leaves the window.
+        """
+        keys, args = self.keyspace.acquire_call(
+            recipient, (RateLimit(notification_type, max_count, period, algorithm),), now.timestamp(), now.timestamp()
+        )
+        return parse_decision(self._try_acquire_script(keys=keys, args=args))[:3]
+
+    def try_acquire_many(self, requests, now):
+        """Evaluate ``try_acquire`` for every ``(recipient, notification_type, max_count, period, algorithm)``
+        in one pipelined round trip. Scripts run in order, so requests for the same key are
+        counted against each other.
+        """
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for index, (recipient, notification_type, max_count, period, algorithm) in enumerate(requests):
+            keys, args = self.keyspace.acquire_call(
+                recipient, (RateLimit(notification_type, max_count, period, algorithm),),
+                now.timestamp(), f"{now.timestamp()}:{index}"
+            )
+            self._try_acquire_script(keys=keys, args=args, client=pipeline)
+        return [parse_decision(result)[:3] for result in pipeline.execute()]
+
+    def try_acquire_limits(self, recipient, limits, now):
+        """Check every ``RateLimit`` window of one recipient and record the notification in
+        all of them only if all allow it, in one script call. The keys share the
+        recipient's hash tag, so they live on one node.
+
+        Returns ``(allowed, remaining, retry_after, denied)``; ``denied`` is the index in
+        ``limits`` of the window with the longest wait, or None when allowed.
+        """
+        keys, args = self.keyspace.acquire_call(recipient, limits, now.timestamp(), now.timestamp())
+        return parse_decision(self._try_acquire_script(keys=keys, args=args))
+
+    def try_acquire_limits_many(self, requests, now):
+        """Pipelined ``try_acquire_limits`` for ``(recipient, limits)`` pairs."""
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for index, (recipient, limits) in enumerate(requests):
+            keys, args = self.keyspace.acquire_call(recipient, limits, now.timestamp(), f"{now.timestamp()}:{index}")
+            self._try_acquire_script(keys=keys, args=args, client=pipeline)
+        return [parse_decision(result) for result in pipeline.execute()]
 
     def cleanup_old_notifications(self, recipient, notification_type, period, now):
-        key = f"{recipient}:{notification_type}"
-        self.redis_client.zremrangebyscore(key, 0, now.timestamp() - period)
+        key = self.keyspace.key(recipient, notification_type)
+        self.redis_client.zremrangebyscore(key, 0, self.keyspace.score(now.timestamp() - period))
 
     def get_notification_count(self, recipient, notification_type, period, now):
-        key = f"{recipient}:{notification_type}"
+        key = self.keyspace.key(recipient, notification_type)
         cutoff = now - timedelta(seconds=period)
         return self.redis_client.zcard(key)
 
     def log_notification(self, recipient, notification_type, timestamp, ttl):
-        key = f"{recipient}:{notification_type}"
-        self.redis_client.zadd(key, {timestamp.timestamp(): timestamp.timestamp()})
+        key = self.keyspace.key(recipient, notification_type)
+        score = self.keyspace.score(timestamp.timestamp())
+        self.redis_client.zadd(key, {score: score})
         self.redis_client.expire(key, ttl)
         
-    def clear_all_notifications(self):
-        keys = self.redis_client.keys('*:*')
-        if keys:
-            self.redis_client.delete(*keys)
-
-    def get_all_usage(self):
-        keys = self.redis_client.keys('*:*')
-        usage = {}
+    def clear_all_notifications(self, notification_type=None, progress=None):
+        """Delete rate-limit keys in ``SCAN`` chunks with ``UNLINK`` so Redis frees the
+        memory in the background and never blocks on one huge ``DELETE``.
+
+        ``progress`` is called with the running deleted count after every chunk.
+        Returns the total number of keys deleted.
+        """
+        deleted = 0
+        for match in self.keyspace.matches(notification_type):
+            cursor = 0
+            while True:
+                cursor, keys = self.redis_client.scan(cursor=cursor, match=match, count=self.clear_chunk_size)
+                if keys:
+                    deleted += self.redis_client.unlink(*keys)
+                    logger.debug("Cleared %d rate-limit keys matching %s", deleted, match)
+                    if progress is not None:
+                        progress(deleted)
+                if cursor == 0:
+                    break
+        return deleted
+
+    def get_all_usage(self, notification_type=None, recipient_prefix=None):
+        return dict(self.iter_usage(notification_type, recipient_prefix))
+
+    def scan_usage(self, cursor=0, count=USAGE_SCAN_COUNT, notification_type=None, recipient_prefix=None):
+        """Run one incremental ``SCAN`` step and fetch the counts of the keys it
+        returned with a single pipelined round of usage script calls. The patterns of
+        ``usage_matches`` are scanned one after another; the cursor carries the pattern.
+
+        Returns ``(next_cursor, usage)``; a ``next_cursor`` of 0 means the scan is complete.
+        Like ``SCAN``, a key may be returned on more than one page, so callers merge pages by key.
+        """
+        matches = self.keyspace.usage_matches(notification_type, recipient_prefix)
+        index, scan_cursor = split_cursor(cursor, len(matches))
+        scan_cursor, keys = self.redis_client.scan(cursor=scan_cursor, match=matches[index], count=count)
+        next_cursor = join_cursor(index, scan_cursor, len(matches))
+        if not keys:
+            return next_cursor, {}
+        now = datetime.now().timestamp()
+        pipeline = self.redis_client.pipeline(transaction=False)
         for key in keys:
-            usage[key] = self.redis_client.zcard(key)
-        return usage
+            self._usage_script(keys=[key], args=[now], client=pipeline)
+        for directory, field in self.keyspace.directories(keys):
+            pipeline.hmget(directory, 'r', field)
+        results = pipeline.execute()
+        return next_cursor, usage_page(self.keyspace, keys, results, recipient_prefix)
+
+    def iter_usage(self, notification_type=None, recipient_prefix=None, count=USAGE_SCAN_COUNT):
+        cursor = 0
+        while True:
+            cursor, usage = self.scan_usage(cursor, count, notification_type, recipient_prefix)
+            yield from usage.items()
+            if cursor == 0:
+                break
+
+    def memory_report(self, sample=MEMORY_SAMPLE_SIZE):
+        """Measure ``MEMORY USAGE`` of up to ``sample`` keys of the namespace, alongside the
+        node's ``used_memory`` and key count. See ``build_memory_report``.
+        """
+        keys = []
+        cursor = 0
+        while len(keys) < sample:
+            cursor, batch = self.redis_client.scan(cursor=cursor, match=self.keyspace.namespace(), count=sample)
+            keys.extend(batch)
+            if cursor == 0:
+                break
+        keys = keys[:sample]
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.memory_usage(key)
+        pipeline.info('memory')
+        pipeline.dbsize()
+        *sizes, info, db_keys = pipeline.execute()
+        return build_memory_report(self.keyspace, keys, sizes, info['used_memory'], db_keys)
+
+    def migrate_keys(self, progress=None):
+        """Move every key of the plain layout into the compact one, one ``SCAN`` chunk per
+        pipelined round of ``MIGRATE_KEY_SCRIPT`` calls. Counters keep their state.
+
+        ``progress`` is called with the running migrated count after every chunk.
+        Returns the number of keys migrated.
+        """
+        check_migratable(self.keyspace)
+        migrated = 0
+        cursor = 0
+        while True:
+            cursor, keys = self.redis_client.scan(cursor=cursor, match=self.keyspace.plain_match(), count=self.clear_chunk_size)
+            if keys:
+                pipeline = self.redis_client.pipeline(transaction=False)
+                for key in keys:
+                    migration_keys, args = self.keyspace.migration_call(key)
+                    self._migrate_script(keys=migration_keys, args=args, client=pipeline)
+                migrated += sum(pipeline.execute())
+                if progress is not None:
+                    progress(migrated)
+            if cursor == 0:
+                break
+        return migrated
+
+    def pool_stats(self):
+        return pool_stats(self.redis_client.connection_pool)
+
+    def close(self):
+        self.redis_client.connection_pool.disconnect()
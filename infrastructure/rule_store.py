@@ -0,0 +1,178 @@
+import asyncio
+import json
+import logging
+import redis.asyncio as redis
+from domain.notification import RuleTable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 30.0
+
+# KEYS = rules hash, version key; ARGV = channel, expected version or '', then
+# (notification_type, rule json or '') pairs. An empty rule deletes the type. Applies the
+# changes, bumps the version and announces it in one atomic step so no worker can observe
+# rules without their version. Returns -1 without changes if the version is not the expected one.
+UPDATE_RULES_SCRIPT = """
+if ARGV[2] ~= '' and tonumber(redis.call('GET', KEYS[2]) or '0') ~= tonumber(ARGV[2]) then
+    return -1
+end
+for index = 3, #ARGV, 2 do
+    if ARGV[index + 1] == '' then
+        redis.call('HDEL', KEYS[1], ARGV[index])
+    else
+        redis.call('HSET', KEYS[1], ARGV[index], ARGV[index + 1])
+    end
+end
+local version = redis.call('INCR', KEYS[2])
+redis.call('PUBLISH', ARGV[1], version)
+return version
+"""
+
+# KEYS = rules hash, version key; ARGV = (notification_type, rule json) pairs.
+# Seeds the defaults only if no configuration exists yet; returns the current version.
+SEED_RULES_SCRIPT = """
+local version = redis.call('GET', KEYS[2])
+if version then
+    return tonumber(version)
+end
+for index = 1, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[index], ARGV[index + 1])
+end
+redis.call('SET', KEYS[2], 1)
+return 1
+"""
+
+def encode_rule(rule):
+    encoded = {"max_count": rule.max_count, "period": rule.period, "algorithm": rule.algorithm}
+    if rule.windows:
+        encoded["windows"] = [list(window) for window in rule.windows]
+    if rule.defer:
+        encoded["defer"] = True
+    return json.dumps(encoded)
+
+def decode_rule(value):
+    rule = json.loads(value)
+    windows = tuple(tuple(window) for window in rule.get("windows", ()))
+    return rule["max_count"], rule["period"], rule["algorithm"], windows, rule.get("defer", False)
+
+class RedisRuleStore:
+    """Versioned rate-limit configuration shared by every worker and replica through Redis.
+
+    Rules live in a hash next to a version counter; updates bump the version and publish
+    it, and ``watch`` reloads and compiles a new ``RuleTable`` whenever the version
+    changes. Keys sit outside the ``<prefix>:`` rate-limit namespace so clearing
+    notifications never removes them.
+    """
+
+    def __init__(self, redis_client, key_prefix='ratelimit', poll_interval=DEFAULT_POLL_INTERVAL):
+        self.redis_client = redis_client
+        self.rules_key = f"{key_prefix}.rules"
+        self.version_key = f"{key_prefix}.rules.version"
+        self.channel = f"{key_prefix}.rules.updates"
+        # Bumped whenever rate-limit state is cleared, so every worker drops its deny cache
+        self.clears_key = f"{key_prefix}.clears"
+        self.poll_interval = poll_interval
+        self._update_script = redis_client.register_script(UPDATE_RULES_SCRIPT)
+        self._seed_script = redis_client.register_script(SEED_RULES_SCRIPT)
+
+    async def load(self):
+        pipeline = self.redis_client.pipeline(transaction=True)
+        pipeline.get(self.version_key)
+        pipeline.hgetall(self.rules_key)
+        version, rules = await pipeline.execute()
+        return RuleTable(int(version or 0), {
+            notification_type: decode_rule(value) for notification_type, value in rules.items()
+        })
+
+    async def seed(self, defaults):
+        args = []
+        for notification_type, rule in defaults.items():
+            args += [notification_type, encode_rule(rule)]
+        await self._seed_script(keys=[self.rules_key, self.version_key], args=args)
+        return await self.load()
+
+    async def update(self, changes, expected_version=None):
+        """Apply ``{notification_type: RateLimitRule or None}`` (``None`` removes the type)
+        and return the newly compiled table.
+
+        With ``expected_version`` the changes are only applied if the stored configuration
+        still has that version; otherwise nothing changes and ``None`` is returned.
+        """
+        args = [self.channel, expected_version if expected_version is not None else '']
+        for notification_type, rule in changes.items():
+            args += [notification_type, encode_rule(rule) if rule is not None else '']
+        if await self._update_script(keys=[self.rules_key, self.version_key], args=args) == -1:
+            return None
+        return await self.load()
+
+    async def invalidate(self):
+        """Tell every watcher that rate-limit state was cleared, without changing the rules."""
+        pipeline = self.redis_client.pipeline(transaction=True)
+        pipeline.incr(self.clears_key)
+        pipeline.publish(self.channel, 'clear')
+        await pipeline.execute()
+
+    async def watch(self, on_change, current_version=0, on_clear=None):
+        """Call ``on_change(table)`` for every new configuration version and ``on_clear()``
+        after every ``invalidate`` until cancelled.
+
+        Pub/sub delivers updates immediately; both counters are also polled every
+        ``poll_interval`` seconds because messages published while disconnected are lost.
+        """
+        # Clears before the watcher started are already reflected in this worker's state
+        current_clears = None
+        while True:
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel)
+                while True:
+                    version, clears = await self.redis_client.mget(self.version_key, self.clears_key)
+                    if int(version or 0) > current_version:
+                        table = await self.load()
+                        current_version = table.version
+                        on_change(table)
+                    clears = int(clears or 0)
+                    if current_clears is not None and clears > current_clears and on_clear is not None:
+                        on_clear()
+                    current_clears = clears
+                    await pubsub.get_message(timeout=self.poll_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Rate-limit rule watcher lost Redis, retrying in %.0fs", self.poll_interval, exc_info=True)
+                await asyncio.sleep(self.poll_interval)
+            finally:
+                await pubsub.aclose()
+
+class InMemoryRuleStore:
+    """Process-local rule store for the ``memory`` backend, where there is a single worker to keep in sync."""
+
+    def __init__(self):
+        self._table = RuleTable(0, {})
+
+    async def load(self):
+        return self._table
+
+    async def seed(self, defaults):
+        if self._table.version == 0:
+            self._table = RuleTable(1, defaults)
+        return self._table
+
+    async def update(self, changes, expected_version=None):
+        if expected_version is not None and expected_version != self._table.version:
+            return None
+        rules = dict(self._table)
+        for notification_type, rule in changes.items():
+            if rule is None:
+                rules.pop(notification_type, None)
+            else:
+                rules[notification_type] = rule
+        self._table = RuleTable(self._table.version + 1, rules)
+        return self._table
+
+    async def invalidate(self):
+        # The single worker already cleared its own state
+        return
+
+    async def watch(self, on_change, current_version=0, on_clear=None):
+        return
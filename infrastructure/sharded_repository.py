@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+from bisect import bisect
+from infrastructure.redis_repository import (
+    USAGE_SCAN_COUNT, MEMORY_SAMPLE_SIZE, merge_memory_reports, sum_pool_stats, split_cursor, join_cursor
+)
+
+# Points per node on the ring; enough that recipients spread within a few percent
+DEFAULT_REPLICAS = 160
+
+class HashRing:
+    """Consistent hash ring mapping a recipient to the index of its node, so adding a
+    node moves only about ``1 / len(nodes)`` of the recipients.
+    """
+
+    def __init__(self, nodes, replicas=DEFAULT_REPLICAS):
+        points = sorted(
+            (self._hash(f"{node}#{replica}"), index)
+            for index, node in enumerate(nodes)
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+    def node(self, recipient):
+        position = bisect(self._hashes, self._hash(recipient)) % len(self._hashes)
+        return self._indexes[position]
+
+def _group_by_shard(ring, requests):
+    groups = {}
+    for position, request in enumerate(requests):
+        groups.setdefault(ring.node(request[0]), []).append((position, request))
+    return groups
+
+class AsyncShardedRedisRepository:
+    """Spreads rate-limit state over several ``AsyncRedisRepository`` nodes.
+
+    Recipients are routed with a ``HashRing``, so every check for one recipient stays on
+    one node and remains a single atomic script. Clearing and usage fan out to every
+    node in parallel. ``nodes`` are the node names hashed onto the ring (``host:port``).
+    """
+
+    def __init__(self, repositories, nodes=None, replicas=DEFAULT_REPLICAS):
+        self.shards = list(repositories)
+        self.ring = HashRing(nodes or [str(index) for index in range(len(self.shards))], replicas)
+
+    def shard(self, recipient):
+        return self.shards[self.ring.node(recipient)]
+
+    def register_types(self, notification_types):
+        for repository in self.shards:
+            repository.register_types(notification_types)
+
+    async def try_acquire(self, recipient, notification_type, max_count, period, now, algorithm='sliding_log'):
+        return await self.shard(recipient).try_acquire(recipient, notification_type, max_count, period, now, algorithm)
+
+    async def try_acquire_many(self, requests, now):
+        return await self._acquire_many('try_acquire_many', requests, now)
+
+    async def try_acquire_limits(self, recipient, limits, now):
+        return await self.shard(recipient).try_acquire_limits(recipient, limits, now)
+
+    async def try_acquire_limits_many(self, requests, now):
+        return await self._acquire_many('try_acquire_limits_many', requests, now)
+
+    async def _acquire_many(self, method, requests, now):
+        groups = _group_by_shard(self.ring, requests)
+        results = await asyncio.gather(*(
+            getattr(self.shards[shard], method)([request for _, request in group], now)
+            for shard, group in groups.items()
+        ))
+        decisions = [None] * len(requests)
+        for group, shard_decisions in zip(groups.values(), results):
+            for (position, _), decision in zip(group, shard_decisions):
+                decisions[position] = decision
+        return decisions
+
+    async def cleanup_old_notifications(self, recipient, notification_type, period, now):
+        return await self.shard(recipient).cleanup_old_notifications(recipient, notification_type, period, now)
+
+    async def get_notification_count(self, recipient, notification_type, period, now):
+        return await self.shard(recipient).get_notification_count(recipient, notification_type, period, now)
+
+    async def log_notification(self, recipient, notification_type, timestamp, ttl):
+        return await self.shard(recipient).log_notification(recipient, notification_type, timestamp, ttl)
+
+    async def clear_all_notifications(self, notification_type=None, progress=None):
+        deleted = sum(await asyncio.gather(*(
+            repository.clear_all_notifications(notification_type) for repository in self.shards
+        )))
+        if progress is not None:
+            progress(deleted)
+        return deleted
+
+    async def get_all_usage(self, notification_type=None, recipient_prefix=None):
+        usage = {}
+        for shard_usage in await asyncio.gather(*(
+            repository.get_all_usage(notification_type, recipient_prefix) for repository in self.shards
+        )):
+            usage.update(shard_usage)
+        return usage
+
+    async def scan_usage(self, cursor=0, count=USAGE_SCAN_COUNT, notification_type=None, recipient_prefix=None):
+        shard, shard_cursor = split_cursor(cursor, len(self.shards))
+        shard_cursor, usage = await self.shards[shard].scan_usage(shard_cursor, count, notification_type, recipient_prefix)
+        return join_cursor(shard, shard_cursor, len(self.shards)), usage
+
+    async def iter_usage(self, notification_type=None, recipient_prefix=None, count=USAGE_SCAN_COUNT):
+        for repository in self.shards:
+            async for item in repository.iter_usage(notification_type, recipient_prefix, count):
+                yield item
+
+    async def memory_report(self, sample=MEMORY_SAMPLE_SIZE):
+        return merge_memory_reports(await asyncio.gather(*(repository.memory_report(sample) for repository in self.shards)))
+
+    async def migrate_keys(self, progress=None):
+        migrated = sum(await asyncio.gather(*(repository.migrate_keys() for repository in self.shards)))
+        if progress is not None:
+            progress(migrated)
+        return migrated
+
+    def pool_stats(self):
+        return sum_pool_stats([repository.pool_stats() for repository in self.shards])
+
+    async def close(self):
+        await asyncio.gather(*(repository.close() for repository in self.shards))
@@ -0,0 +1,19 @@
+import fakeredis
+import pytest
+import redis
+import redis.asyncio
+
+# In-process Redis with Lua support, so the shipped scripts run without a server
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+@pytest.fixture
+def redis_pool(redis_server):
+    return redis.ConnectionPool(connection_class=fakeredis.FakeRedisConnection, server=redis_server, decode_responses=True)
+
+@pytest.fixture
+def async_redis_pool(redis_server):
+    return redis.asyncio.ConnectionPool(
+        connection_class=fakeredis.FakeAsyncRedisConnection, server=redis_server, decode_responses=True
+    )
@@ -0,0 +1,26 @@
+import time
+import pytest
+from datetime import timedelta
+from infrastructure import auth
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = auth.VerifiedTokenCache(max_size=2)
+    monkeypatch.setattr(auth, "token_cache", cache)
+    return cache
+
+@pytest.mark.asyncio
+async def test_repeat_token_skips_verification(cache, monkeypatch):
+    token = auth.create_access_token({"sub": "admin"}, expires_delta=timedelta(minutes=30))
+    assert await auth.get_current_user(token, None) == {"username": "admin"}
+
+    def fail_decode(*args, **kwargs):
+        raise AssertionError("token verified twice")
+    monkeypatch.setattr(auth.jwt, "decode", fail_decode)
+    assert await auth.get_current_user(token, None) == {"username": "admin"}
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1}
+
+def test_cache_evicts_expired_entries(cache):
+    cache.put("expired", "admin", time.time() - 1)
+    assert cache.get("expired") is None
+    assert cache.stats()["size"] == 0
@@ -0,0 +1,131 @@
+import asyncio
+from datetime import datetime, timedelta
+import pytest
+from redis.exceptions import ConnectionError, ResponseError
+from domain.notification import RateLimit
+from infrastructure.circuit_breaker import CircuitBreaker, AsyncFallbackRepository
+from infrastructure.memory_repository import AsyncInMemoryRepository
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class UnreliableRepository(AsyncInMemoryRepository):
+    """In-memory repository that fails or hangs on demand, standing in for Redis."""
+
+    def __init__(self):
+        super().__init__(eviction_interval=None)
+        self.failure = None
+        self.calls = 0
+
+    async def try_acquire_limits(self, recipient, limits, now):
+        self.calls += 1
+        if isinstance(self.failure, Exception):
+            raise self.failure
+        if self.failure == "slow":
+            await asyncio.sleep(1)
+        return await super().try_acquire_limits(recipient, limits, now)
+
+def test_breaker_opens_after_consecutive_failures_and_probes_once():
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=5, clock=clock)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    clock.now = 5
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    clock.now = 10
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.stats() == {"state": "closed", "consecutive_failures": 0, "opened": 1, "degraded_seconds": 10}
+
+@pytest.mark.asyncio
+async def test_fallback_enforces_a_share_of_the_limit_until_redis_recovers():
+    clock = Clock()
+    primary = UnreliableRepository()
+    repository = AsyncFallbackRepository(
+        primary, AsyncInMemoryRepository(eviction_interval=None),
+        CircuitBreaker(failure_threshold=2, reset_timeout=5, clock=clock), timeout=0.05, share=0.5
+    )
+    limits = (RateLimit("status", 4, 60, "sliding_log"),)
+    now = datetime(2024, 1, 1)
+
+    primary.failure = "slow"
+    results = [await repository.try_acquire_limits("user1@example.com", limits, now + timedelta(seconds=i)) for i in range(3)]
+    # Two timeouts open the breaker; the third check never reaches Redis
+    assert primary.calls == 2 and repository.breaker.state == "open"
+    assert [result[0] for result in results] == [True, True, False]
+
+    primary.failure = None
+    clock.now = 5
+    allowed = (await repository.try_acquire_limits("user1@example.com", limits, now + timedelta(seconds=10)))[0]
+    assert allowed and primary.calls == 3
+    assert repository.degraded_stats() == {
+        "state": "closed", "consecutive_failures": 0, "opened": 1, "degraded_seconds": 5, "fallback_calls": 3
+    }
+    await repository.close()
+
+@pytest.mark.asyncio
+async def test_connection_errors_count_as_failures():
+    primary = UnreliableRepository()
+    repository = AsyncFallbackRepository(
+        primary, AsyncInMemoryRepository(eviction_interval=None), CircuitBreaker(failure_threshold=1), share=0.1
+    )
+    primary.failure = ConnectionError("Connection refused")
+    limits = (RateLimit("news", 1, 86400, "gcra"),)
+    allowed = (await repository.try_acquire_limits("user1@example.com", limits, datetime(2024, 1, 1)))[0]
+    # A share never rounds a limit down to zero
+    assert allowed
+    assert repository.breaker.state == "open"
+    await repository.close()
+
+def open_breaker(failure):
+    clock = Clock()
+    primary = UnreliableRepository()
+    repository = AsyncFallbackRepository(
+        primary, AsyncInMemoryRepository(eviction_interval=None),
+        CircuitBreaker(failure_threshold=1, reset_timeout=5, clock=clock), timeout=10
+    )
+    repository.breaker.record_failure()
+    clock.now = 5
+    primary.failure = failure
+    return repository
+
+@pytest.mark.asyncio
+async def test_cancelled_probe_lets_the_next_call_probe():
+    repository = open_breaker("slow")
+    limits = (RateLimit("status", 2, 60, "sliding_log"),)
+    probe = asyncio.ensure_future(repository.try_acquire_limits("user1@example.com", limits, datetime(2024, 1, 1)))
+    await asyncio.sleep(0)
+    assert repository.breaker.state == "half_open" and not repository.breaker.allow()
+    probe.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await probe
+    assert repository.breaker.allow()
+    await repository.close()
+
+@pytest.mark.asyncio
+async def test_unexpected_errors_propagate_without_tripping_the_breaker():
+    repository = open_breaker(ValueError("Notification type collides"))
+    limits = (RateLimit("status", 2, 60, "sliding_log"),)
+    with pytest.raises(ValueError):
+        await repository.try_acquire_limits("user1@example.com", limits, datetime(2024, 1, 1))
+    assert repository.breaker.allow()
+    repository.breaker.record_success()
+
+    repository.repository.failure = ResponseError("NOSCRIPT No matching script")
+    with pytest.raises(ResponseError):
+        await repository.try_acquire_limits("user1@example.com", limits, datetime(2024, 1, 1))
+    assert repository.breaker.state == "closed" and repository.fallback_calls == 0
+    await repository.close()
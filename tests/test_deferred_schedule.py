@@ -0,0 +1,94 @@
+import asyncio
+import time
+import pytest
+import redis.asyncio
+from domain.exceptions import RateLimitExceededException
+from domain.notification import DeferredNotification, NotificationService, RateLimitRule, RuleTable
+from infrastructure.deferred_schedule import InMemorySchedule, RedisSchedule, DeferredScheduler
+from infrastructure.memory_repository import AsyncInMemoryRepository
+
+def deferred_service(rules, max_size=100):
+    repository = AsyncInMemoryRepository(eviction_interval=None)
+    schedule = InMemorySchedule(max_size)
+    return NotificationService(repository, RuleTable(1, rules), schedule=schedule), repository, schedule
+
+@pytest.mark.asyncio
+async def test_over_limit_notification_is_deferred_when_opted_in():
+    service, repository, schedule = deferred_service({"news": RateLimitRule(1, 86400)})
+    await service.send_async("news", "user1@example.com", "News update 1")
+    with pytest.raises(RateLimitExceededException):
+        await service.send_async("news", "user1@example.com", "News update 2")
+
+    before = time.time()
+    deferred = await service.send_async("news", "user1@example.com", "News update 2", defer=True)
+    assert isinstance(deferred, DeferredNotification)
+    assert before + 86000 < deferred.due_at <= time.time() + 86400
+    assert await service.list_deferred_async() == (1, [deferred])
+
+    assert await service.cancel_deferred_async(deferred.id)
+    assert not await service.cancel_deferred_async(deferred.id)
+    assert await service.get_deferred_async(deferred.id) is None
+    await repository.close()
+
+@pytest.mark.asyncio
+async def test_rule_defers_batch_items_until_schedule_is_full():
+    service, repository, schedule = deferred_service({"news": RateLimitRule(1, 86400, defer=True)}, max_size=1)
+    results = await service.send_batch_async([
+        ("news", "user1@example.com", "News update 1"),
+        ("news", "user1@example.com", "News update 2"),
+        ("news", "user1@example.com", "News update 3"),
+        ("news", "user1@example.com", "News update 4"),
+    ], defer=[None, False, None, None])
+    assert results[0] == 0
+    assert isinstance(results[1], RateLimitExceededException)
+    assert isinstance(results[2], DeferredNotification)
+    # No room left in the schedule, so the limit is reported as usual
+    assert isinstance(results[3], RateLimitExceededException)
+    await repository.close()
+
+@pytest.mark.asyncio
+async def test_scheduler_sends_due_items_and_reschedules_the_rest():
+    service, repository, schedule = deferred_service({"status": RateLimitRule(1, 1, "gcra")})
+    await service.send_async("status", "user1@example.com", "Status update 1")
+    first = await service.send_async("status", "user1@example.com", "Status update 2", defer=True)
+    second = await service.send_async("status", "user1@example.com", "Status update 3", defer=True)
+    scheduler = DeferredScheduler(service, schedule, batch_size=10)
+
+    assert await scheduler.drain_due(now=time.time()) == 0
+    due_at = max(first.due_at, second.due_at)
+    await asyncio.sleep(due_at - time.time() + 0.01)
+    # Both wait for the same freed slot, which fits only one of them
+    assert await scheduler.drain_due(now=due_at) == 2
+    assert scheduler.stats() == {"delivered": 1, "rescheduled": 1, "dropped": 0}
+    total, [pending] = await schedule.list()
+    assert (total, pending.attempts) == (1, 1)
+    assert pending.due_at > due_at
+    await repository.close()
+
+def deferred(deferred_id, due_at):
+    return DeferredNotification(deferred_id, "news", "user1@example.com", "News update", due_at, 0.0)
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["memory", "redis"])
+async def test_item_cancelled_while_leased_is_not_rescheduled(backend, async_redis_pool):
+    if backend == "redis":
+        schedule = RedisSchedule(redis.asyncio.Redis(connection_pool=async_redis_pool))
+    else:
+        schedule = InMemorySchedule()
+    assert await schedule.add([deferred("a", 10.0), deferred("b", 10.0)]) == 2
+    claimed = await schedule.claim(10.0, 10, 40.0)
+    assert [item.id for item in claimed] == ["a", "b"]
+
+    assert await schedule.cancel("a")
+    assert await schedule.reschedule([item._replace(due_at=20.0, attempts=1) for item in claimed]) == 1
+    total, items = await schedule.list()
+    assert (total, [(item.id, item.due_at) for item in items]) == (1, [("b", 20.0)])
+
+@pytest.mark.asyncio
+async def test_claim_drops_ids_without_an_item(async_redis_pool):
+    client = redis.asyncio.Redis(connection_pool=async_redis_pool)
+    schedule = RedisSchedule(client)
+    await schedule.add([deferred("a", 10.0)])
+    await client.zadd(schedule.schedule_key, {"orphan": 5.0})
+    assert [item.id for item in await schedule.claim(10.0, 10, 40.0)] == ["a"]
+    assert await client.zrange(schedule.schedule_key, 0, -1) == ["a"]
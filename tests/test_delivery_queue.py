@@ -0,0 +1,58 @@
+import asyncio
+import pytest
+from domain.exceptions import DeliveryQueueFullException, RateLimitExceededException
+from domain.notification import NotificationService
+from infrastructure.delivery_queue import DeliveryQueue
+from infrastructure.memory_repository import AsyncInMemoryRepository
+
+class RecordingSender:
+    def __init__(self):
+        self.batches = []
+
+    async def send_batch(self, deliveries):
+        self.batches.append([delivery.recipient for delivery in deliveries])
+
+@pytest.mark.asyncio
+async def test_workers_deliver_in_batches_and_drain():
+    sender = RecordingSender()
+    queue = DeliveryQueue(sender, max_size=10, workers=1, batch_size=3)
+    queue.reserve(5)
+    for index in range(5):
+        queue.submit("status", f"user{index}@example.com", "Status update")
+    assert await queue.drain() == 0
+    assert [len(batch) for batch in sender.batches] == [3, 2]
+    assert queue.stats()["delivered"] == 5
+
+@pytest.mark.asyncio
+async def test_reserve_rejects_when_full():
+    queue = DeliveryQueue(RecordingSender(), max_size=2)
+    queue.reserve(2)
+    with pytest.raises(DeliveryQueueFullException):
+        queue.reserve()
+    queue.release()
+    queue.reserve()
+    assert queue.stats()["rejected"] == 1
+    await queue.drain()
+
+@pytest.mark.asyncio
+async def test_send_async_enqueues_and_releases_denied_slots():
+    sender = RecordingSender()
+    queue = DeliveryQueue(sender, max_size=1, workers=1)
+    repository = AsyncInMemoryRepository(eviction_interval=None)
+    service = NotificationService(repository, {"news": (1, 86400)}, delivery_queue=queue)
+
+    await service.send_async("news", "user1@example.com", "News update 1")
+    await asyncio.sleep(0.01)
+    with pytest.raises(RateLimitExceededException):
+        await service.send_async("news", "user1@example.com", "News update 2")
+    assert queue.stats()["reserved"] == 0
+
+    results = await service.send_batch_async([
+        ("news", "user2@example.com", "News update 1"),
+        ("news", "user3@example.com", "News update 1"),
+    ])
+    assert all(isinstance(result, DeliveryQueueFullException) for result in results)
+
+    await queue.drain()
+    await repository.close()
+    assert sender.batches == [["user1@example.com"]]
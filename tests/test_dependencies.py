@@ -0,0 +1,80 @@
+import asyncio
+import time
+import pytest
+import redis.asyncio as redis
+from app import dependencies
+from app.config import DEFAULT_RATE_LIMITS
+from domain.exceptions import RuleVersionConflictException
+from domain.notification import NotificationService
+from infrastructure.deny_cache import DenyCache
+from infrastructure.rule_store import RedisRuleStore
+
+@pytest.mark.asyncio
+async def test_service_built_by_a_sync_helper_is_started_on_first_request(monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_BACKEND", "memory")
+    await dependencies.close_notification_service_app()
+    # /metrics and the rule endpoints build the service without starting it
+    dependencies.get_rule_table()
+    assert dependencies._rule_watcher is None
+
+    service_app = await dependencies.get_notification_service_app()
+    assert service_app is dependencies._service_app
+    assert dependencies._rule_watcher is not None and dependencies._scheduler_task is not None
+    watcher = dependencies._rule_watcher
+    await dependencies.get_notification_service_app()
+    assert dependencies._rule_watcher is watcher
+    await dependencies.close_notification_service_app()
+
+@pytest.mark.asyncio
+async def test_clear_drops_the_deny_cache_of_every_worker(monkeypatch, async_redis_pool):
+    monkeypatch.setenv("RATE_LIMIT_BACKEND", "memory")
+    await dependencies.close_notification_service_app()
+    service_app = dependencies.init_notification_service_app()
+    rule_store = RedisRuleStore(redis.StrictRedis(connection_pool=async_redis_pool), poll_interval=0.05)
+    monkeypatch.setattr(dependencies, "_rule_store", rule_store)
+    table = await rule_store.seed(DEFAULT_RATE_LIMITS)
+
+    # Another worker with its own deny cache, kept in sync by the rule watcher; clears that
+    # happened before it started are not replayed
+    await rule_store.invalidate()
+    other = NotificationService(None, table, DenyCache())
+    other.deny_cache.block("user1@example.com", "status", time.time() + 60)
+    watcher = asyncio.create_task(rule_store.watch(other.set_rate_limits, table.version, other.deny_cache.clear))
+    await asyncio.sleep(0.1)
+    assert len(other.deny_cache) == 1
+
+    assert await dependencies.clear_notifications(service_app) == 0
+    for _ in range(50):
+        if not len(other.deny_cache):
+            break
+        await asyncio.sleep(0.02)
+    assert len(other.deny_cache) == 0
+    # The rules did not change, so neither did their version
+    assert other.rate_limits.version == table.version
+    assert (await rule_store.load()).version == table.version
+    watcher.cancel()
+    await asyncio.gather(watcher, return_exceptions=True)
+    await dependencies.close_notification_service_app()
+
+@pytest.mark.asyncio
+async def test_field_updates_merge_into_the_stored_rules(monkeypatch, async_redis_pool):
+    monkeypatch.setenv("RATE_LIMIT_BACKEND", "memory")
+    await dependencies.close_notification_service_app()
+    dependencies.init_notification_service_app()
+    rule_store = RedisRuleStore(redis.StrictRedis(connection_pool=async_redis_pool))
+    monkeypatch.setattr(dependencies, "_rule_store", rule_store)
+    dependencies.apply_rule_table(await rule_store.seed(DEFAULT_RATE_LIMITS))
+
+    # Another worker changed the count; this worker has not seen it yet
+    other_store = RedisRuleStore(redis.StrictRedis(connection_pool=async_redis_pool))
+    await other_store.update({"status": DEFAULT_RATE_LIMITS["status"]._replace(max_count=7)})
+    table = await dependencies.patch_rate_limit_rules({"status": {"period": 120}})
+    assert (table["status"].max_count, table["status"].period) == (7, 120)
+    assert dependencies.get_rule_table() is table
+
+    async def conflict(changes, expected_version=None):
+        return None
+    monkeypatch.setattr(rule_store, "update", conflict)
+    with pytest.raises(RuleVersionConflictException):
+        await dependencies.patch_rate_limit_rules({"status": {"period": 60}})
+    await dependencies.close_notification_service_app()
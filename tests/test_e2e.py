@@ -19,7 +19,9 @@ def test_e2e_notification_flow(test_client):
     # Step 2: Clear All Notifications
     response = test_client.delete("/notifications/", headers=headers)
     assert response.status_code == 200
-    assert response.json() == {"status": "success", "message": "All notifications cleared successfully"}
+    body = response.json()
+    assert {"status": body["status"], "message": body["message"]} == {"status": "success", "message": "All notifications cleared successfully"}
+    assert body["deleted"] >= 0
 
     # Step 3: Send Notification
     payload = {
@@ -52,7 +54,9 @@ def test_e2e_update_rate_limits(test_client):
     # Step 2: Clear All Notifications
     response = test_client.delete("/notifications", headers=headers)
     assert response.status_code == 200
-    assert response.json() == {"status": "success", "message": "All notifications cleared successfully"}
+    body = response.json()
+    assert {"status": body["status"], "message": body["message"]} == {"status": "success", "message": "All notifications cleared successfully"}
+    assert body["deleted"] >= 0
 
 
     # Step 3: Update Rate Limits
@@ -88,4 +92,6 @@ def test_e2e_clear_rate_limits(test_client):
     # Step 2: Clear Rate Limits
     response = test_client.delete("/notifications", headers=headers)
     assert response.status_code == 200
-    assert response.json() == {"status": "success", "message": "All notifications cleared successfully"}
+    body = response.json()
+    assert {"status": body["status"], "message": body["message"]} == {"status": "success", "message": "All notifications cleared successfully"}
+    assert body["deleted"] >= 0
@@ -1,7 +1,9 @@
+import json
 import pytest
 from fastapi.testclient import TestClient
 from httpx import AsyncClient
-from domain.exceptions import RateLimitExceededException
+from domain.exceptions import RateLimitExceededException, DeliveryQueueFullException
+from domain.notification import DeferredNotification
 from app.main import app
 from app.dependencies import get_notification_service_app
 
@@ -17,13 +19,37 @@ async def async_client():
         yield ac
 
 class MockNotificationServiceApp:
-    def send_notification(self, notification_type, recipient, message):
+    async def send_notification_async(self, notification_type, recipient, message, defer=None):
+        if notification_type == "rate_limited" and defer:
+            return DeferredNotification("deferred1", notification_type, recipient, message, 1700000060.0, 1700000000.0)
         if notification_type == "rate_limited":
             raise RateLimitExceededException("Rate limit exceeded")
+        if notification_type == "queue_full":
+            raise DeliveryQueueFullException("Delivery queue is full, retry later")
         return
     
-    def clear_all_notifications(self):
-        return
+    async def send_notifications_async(self, notifications, defer=None):
+        return [
+            RateLimitExceededException("Rate limit exceeded") if notification_type == "rate_limited" else 0
+            for notification_type, recipient, message in notifications
+        ]
+
+    async def clear_all_notifications_async(self, notification_type=None):
+        if notification_type == "colliding":
+            raise ValueError("Notification type colliding shares the key code S0pe with status")
+        return 0
+
+    async def get_usage_page_async(self, cursor, count, notification_type=None, recipient_prefix=None):
+        return 0, {"user1@example.com:status": 2}
+
+    async def iter_usage_async(self, notification_type=None, recipient_prefix=None):
+        if notification_type == "colliding":
+            raise ValueError("Notification type colliding shares the key code S0pe with status")
+        for key, count in {"user1@example.com:status": 2, "user2@example.com:news": 1}.items():
+            yield key, count
+
+    async def cancel_deferred_async(self, deferred_id):
+        return deferred_id == "deferred1"
 
 
 # Mock dependency injection
@@ -64,10 +90,121 @@ def test_rate_limited_notification(test_client):
     assert response.status_code == 429
     assert response.json() == {"detail": "Rate limit exceeded"}
 
+def test_deferred_notification(test_client):
+    response = test_client.post("/token", data={"username": "admin", "password": "password"})
+    token = response.json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    payload = {
+        "notification_type": "rate_limited",
+        "recipient": "user1@example.com",
+        "message": "Rate limited notification",
+        "defer": True
+    }
+    response = test_client.post("/send-notification/", json=payload, headers=headers)
+    assert response.status_code == 202
+    assert response.json()["deferred_id"] == "deferred1"
+    assert response.json()["scheduled_at"] == 1700000060.0
+
+    assert test_client.delete("/deferred/deferred1", headers=headers).status_code == 200
+    assert test_client.delete("/deferred/unknown", headers=headers).status_code == 404
+
+def test_send_notification_queue_full(test_client):
+    response = test_client.post("/token", data={"username": "admin", "password": "password"})
+    token = response.json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    payload = {
+        "notification_type": "queue_full",
+        "recipient": "user1@example.com",
+        "message": "Status update 1"
+    }
+    response = test_client.post("/send-notification/", json=payload, headers=headers)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
 def test_clear_all_notifications(test_client):
     response = test_client.post("/token", data={"username": "admin", "password": "password"})
     token = response.json()["access_token"]
     headers = {"Authorization": f"Bearer {token}"}
     response = test_client.delete("/notifications", headers=headers)
     assert response.status_code == 200
-    assert response.json() == {"status": "success", "message": "All notifications cleared successfully"}
\ No newline at end of file
+    assert response.json() == {"status": "success", "message": "All notifications cleared successfully", "deleted": 0}
+
+def test_redis_pool_stats(test_client):
+    response = test_client.post("/token", data={"username": "admin", "password": "password"})
+    token = response.json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    response = test_client.get("/redis-pool/", headers=headers)
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["max_connections"] == 50
+    assert stats["in_use_connections"] == 0
+
+def test_send_notification_batch(test_client):
+    response = test_client.post("/token", data={"username": "admin", "password": "password"})
+    token = response.json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    payload = [
+        {"notification_type": "status", "recipient": "user1@example.com", "message": "Status update 1"},
+        {"notification_type": "status", "recipient": "invalid", "message": "Status update 2"},
+        {"notification_type": "rate_limited", "recipient": "user1@example.com", "message": "Rate limited notification"}
+    ]
+    response = test_client.post("/send-notification/batch/", json=payload, headers=headers)
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["status_code"] for result in results] == [200, 400, 429]
+    assert results[0]["message"] == "Notification sent to user1@example.com"
+    assert results[1]["detail"] == "Invalid recipient email"
+    assert results[2]["detail"] == "Rate limit exceeded"
+
+def test_get_usage_page(test_client):
+    response = test_client.post("/token", data={"username": "admin", "password": "password"})
+    token = response.json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    response = test_client.get("/usage/", params={"cursor": 0, "notification_type": "status"}, headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {"cursor": 0, "usage": {"user1@example.com:status": 2}}
+
+def test_stream_usage(test_client):
+    response = test_client.post("/token", data={"username": "admin", "password": "password"})
+    token = response.json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    response = test_client.get("/usage/stream", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines == [
+        {"recipient": "user1@example.com", "notification_type": "status", "count": 2},
+        {"recipient": "user2@example.com", "notification_type": "news", "count": 1}
+    ]
+
+def test_type_filter_sharing_a_key_code_is_rejected(test_client):
+    response = test_client.post("/token", data={"username": "admin", "password": "password"})
+    token = response.json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    response = test_client.delete("/notifications", params={"notification_type": "colliding"}, headers=headers)
+    assert response.status_code == 400
+    response = test_client.get("/usage/stream", params={"notification_type": "colliding"}, headers=headers)
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Notification type colliding shares the key code S0pe with status"}
+
+def test_rule_rejects_notification_types_that_break_key_layout(test_client):
+    response = test_client.post("/token", data={"username": "admin", "password": "password"})
+    token = response.json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    for notification_type in ("promo:eu", "promo@eu", "promo{eu}", "promo*"):
+        response = test_client.put(f"/rate-limits/rules/{notification_type}", json={"max_count": 1, "period": 60}, headers=headers)
+        assert response.status_code == 400
+
+def test_update_rate_limits_rejects_unknown_algorithm(test_client):
+    response = test_client.post("/token", data={"username": "admin", "password": "password"})
+    token = response.json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    response = test_client.put("/rate-limits/", json={"status_algorithm": "token_bucket"}, headers=headers)
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Unknown rate limit algorithm token_bucket"}
+
+def test_metrics_exports_prometheus_text(test_client):
+    response = test_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE token_cache_hits_total counter" in response.text
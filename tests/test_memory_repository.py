@@ -0,0 +1,108 @@
+import threading
+import pytest
+from datetime import datetime, timedelta
+from domain.notification import RateLimit
+from infrastructure.memory_repository import InMemoryRepository, AsyncInMemoryRepository, TimestampRing
+
+@pytest.fixture
+def repository():
+    repository = InMemoryRepository(shards=4, eviction_interval=None)
+    yield repository
+    repository.close()
+
+def test_timestamp_ring_trims_and_grows():
+    ring = TimestampRing(2)
+    for timestamp in (1.0, 2.0, 3.0):
+        ring.append(timestamp)
+    assert len(ring) == 3
+    ring.trim(2.0)
+    assert len(ring) == 1
+    assert ring.oldest() == 3.0
+
+@pytest.mark.parametrize("algorithm", ["sliding_log", "gcra", "sliding_window"])
+def test_try_acquire_enforces_limit(repository, algorithm):
+    now = datetime.now()
+    decisions = [repository.try_acquire("user1@example.com", "marketing", 3, 3600, now, algorithm) for _ in range(4)]
+    assert [allowed for allowed, _, _ in decisions] == [True, True, True, False]
+    assert decisions[-1][2] > 0
+    assert repository.get_all_usage() == {"user1@example.com:marketing": 3}
+
+def test_sliding_log_window_slides(repository):
+    now = datetime.now()
+    repository.try_acquire("user1@example.com", "status", 1, 60, now)
+    assert repository.try_acquire("user1@example.com", "status", 1, 60, now + timedelta(seconds=30))[0] is False
+    assert repository.try_acquire("user1@example.com", "status", 1, 60, now + timedelta(seconds=61))[0] is True
+
+def test_try_acquire_many_counts_items_against_each_other(repository):
+    now = datetime.now()
+    decisions = repository.try_acquire_many([("user1@example.com", "status", 2, 60, "sliding_log")] * 3, now)
+    assert [allowed for allowed, _, _ in decisions] == [True, True, False]
+
+def test_clear_and_scan_usage(repository):
+    now = datetime.now()
+    for index in range(25):
+        repository.try_acquire(f"user{index}@example.com", "status", 2, 60, now)
+    repository.try_acquire("admin@example.com", "news", 1, 86400, now)
+
+    cursor, pages = 0, {}
+    while True:
+        cursor, usage = repository.scan_usage(cursor, 5)
+        pages.update(usage)
+        if cursor == 0:
+            break
+    assert len(pages) == 26
+    assert repository.get_all_usage(recipient_prefix="admin") == {"admin@example.com:news": 1}
+
+    assert repository.clear_all_notifications("news") == 1
+    assert repository.clear_all_notifications() == 25
+    assert repository.get_all_usage() == {}
+
+def test_evict_expired(repository):
+    past = datetime.now() - timedelta(seconds=120)
+    repository.try_acquire("user1@example.com", "status", 2, 60, past)
+    repository.try_acquire("user2@example.com", "news", 1, 86400, datetime.now())
+    assert repository.evict_expired() == 1
+    assert list(repository.get_all_usage()) == ["user2@example.com:news"]
+
+def test_concurrent_acquires_never_overshoot(repository):
+    allowed = []
+    def send():
+        for _ in range(50):
+            allowed.append(repository.try_acquire("user1@example.com", "marketing", 100, 3600, datetime.now())[0])
+    threads = [threading.Thread(target=send) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(allowed) == 100
+
+@pytest.mark.asyncio
+async def test_async_repository():
+    repository = AsyncInMemoryRepository(eviction_interval=None)
+    assert (await repository.try_acquire("user1@example.com", "news", 1, 86400, datetime.now()))[0] is True
+    assert [item async for item in repository.iter_usage()] == [("user1@example.com:news", 1)]
+    assert await repository.clear_all_notifications() == 1
+    await repository.close()
+
+def test_try_acquire_limits_is_all_or_nothing(repository):
+    now = datetime.now()
+    limits = (RateLimit("status", 5, 60, "sliding_log"), RateLimit("status@3600", 1, 3600, "gcra"))
+    assert repository.try_acquire_limits("user1@example.com", limits, now) == (True, 0, 0.0, None)
+    allowed, remaining, retry_after, denied = repository.try_acquire_limits("user1@example.com", limits, now)
+    assert (allowed, denied) == (False, 1)
+    assert retry_after == pytest.approx(3600)
+    assert repository.get_all_usage() == {"user1@example.com:status": 1, "user1@example.com:status@3600": 1}
+    # Filtering by type covers its extra windows, like clearing it
+    assert repository.get_all_usage("status") == repository.get_all_usage()
+    assert repository.clear_all_notifications("status") == 2
+
+@pytest.mark.parametrize("algorithm", ["sliding_log", "gcra", "sliding_window"])
+def test_denied_request_stores_no_entry(repository, algorithm):
+    now = datetime.now()
+    daily = RateLimit("*@86400", 1, 86400, algorithm)
+    assert repository.try_acquire_limits("user1@example.com", (RateLimit("news", 5, 60, algorithm), daily), now)[0]
+    # The shared window denies, so the status window seen for the first time is not kept
+    assert repository.try_acquire_limits("user1@example.com", (RateLimit("status", 5, 60, algorithm), daily), now)[0] is False
+    assert sorted(key for shard in repository._shards for key in shard.entries) == [
+        ("user1@example.com", "*@86400"), ("user1@example.com", "news")
+    ]
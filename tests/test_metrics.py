@@ -0,0 +1,51 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from domain.notification import NotificationService
+from infrastructure.metrics import Histogram, Metrics, ServerTimingMiddleware
+from tests.test_notification import FakeRepository
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("latency_seconds", "Latency.", ("stage",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, "jwt")
+    histogram.observe(0.5, "jwt")
+    histogram.observe(5.0, "jwt")
+    assert histogram.render() == [
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{stage="jwt",le="0.1"} 1',
+        'latency_seconds_bucket{stage="jwt",le="1.0"} 2',
+        'latency_seconds_bucket{stage="jwt",le="+Inf"} 3',
+        'latency_seconds_sum{stage="jwt"} 5.55',
+        'latency_seconds_count{stage="jwt"} 3',
+    ]
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics(enabled=False)
+    with metrics.stage("jwt"):
+        pass
+    metrics.count_send("status", 200)
+    assert metrics.stage_seconds.count("jwt") == 0
+    assert metrics.render() == "\n"
+
+def test_service_times_repository_and_delivery_stages():
+    metrics = Metrics(enabled=True)
+    service = NotificationService(FakeRepository(), {"status": (1, 60)}, metrics=metrics)
+    service.send("status", "user1@example.com", "Status update 1")
+    assert metrics.stage_seconds.count("repository") == 1
+    assert metrics.stage_seconds.count("delivery") == 1
+
+def test_server_timing_header_lists_stages():
+    metrics = Metrics(server_timing=True)
+    app = FastAPI()
+    app.add_middleware(ServerTimingMiddleware, metrics=metrics)
+
+    @app.get("/")
+    async def index():
+        with metrics.stage("validation"):
+            pass
+        return {}
+
+    response = TestClient(app).get("/")
+    stages = [entry.split(";")[0] for entry in response.headers["server-timing"].split(", ")]
+    assert stages == ["validation", "total"]
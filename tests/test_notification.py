@@ -0,0 +1,165 @@
+import pytest
+from domain.exceptions import RateLimitExceededException
+from datetime import datetime
+from domain.notification import NotificationService, RATE_LIMIT_STRATEGIES, RateLimitRule, RuleTable
+from infrastructure.deny_cache import DenyCache
+from infrastructure.memory_repository import InMemoryRepository
+
+class FakeRepository:
+    def __init__(self):
+        self.entries = {}
+
+    def try_acquire(self, recipient, notification_type, max_count, period, now, algorithm='sliding_log'):
+        key = f"{recipient}:{notification_type}"
+        window = [t for t in self.entries.get(key, []) if t > now.timestamp() - period]
+        if len(window) >= max_count:
+            return False, 0, window[0] + period - now.timestamp()
+        window.append(now.timestamp())
+        self.entries[key] = window
+        return True, max_count - len(window), 0.0
+
+    def try_acquire_many(self, requests, now):
+        return [self.try_acquire(recipient, notification_type, max_count, period, now, algorithm)
+                for recipient, notification_type, max_count, period, algorithm in requests]
+
+def test_send_within_limit_returns_remaining():
+    service = NotificationService(FakeRepository(), {"status": (2, 60)})
+    assert service.send("status", "user1@example.com", "Status update 1") == 1
+    assert service.send("status", "user1@example.com", "Status update 2") == 0
+
+def test_send_over_limit_reports_retry_after():
+    service = NotificationService(FakeRepository(), {"news": (1, 86400)})
+    service.send("news", "user1@example.com", "News update 1")
+    with pytest.raises(RateLimitExceededException) as exc_info:
+        service.send("news", "user1@example.com", "News update 2")
+    assert str(exc_info.value) == "Rate limit exceeded for news to user1@example.com"
+    assert 0 < exc_info.value.retry_after <= 86400
+
+def test_send_unknown_type():
+    service = NotificationService(FakeRepository(), {"status": (2, 60)})
+    with pytest.raises(ValueError):
+        service.send("unknown", "user1@example.com", "Hello")
+
+def test_send_batch_counts_items_against_each_other():
+    service = NotificationService(FakeRepository(), {"status": (2, 60)})
+    results = service.send_batch([
+        ("status", "user1@example.com", "Status update 1"),
+        ("status", "user1@example.com", "Status update 2"),
+        ("status", "user1@example.com", "Status update 3"),
+        ("unknown", "user1@example.com", "Hello"),
+    ])
+    assert results[:2] == [1, 0]
+    assert isinstance(results[2], RateLimitExceededException)
+    assert isinstance(results[3], ValueError)
+
+class AsyncFakeRepository(FakeRepository):
+    async def try_acquire(self, recipient, notification_type, max_count, period, now, algorithm='sliding_log'):
+        return FakeRepository.try_acquire(self, recipient, notification_type, max_count, period, now, algorithm)
+
+@pytest.mark.asyncio
+async def test_send_async_over_limit():
+    service = NotificationService(AsyncFakeRepository(), {"status": (1, 60)})
+    assert await service.send_async("status", "user1@example.com", "Status update 1") == 0
+    with pytest.raises(RateLimitExceededException):
+        await service.send_async("status", "user1@example.com", "Status update 2")
+
+def run_strategy(name, max_count, period, timestamps):
+    strategy = RATE_LIMIT_STRATEGIES[name]
+    state, decisions = None, []
+    for now in timestamps:
+        decision, state = strategy.acquire(state, max_count, period, now)
+        decisions.append(decision)
+    return decisions, state
+
+@pytest.mark.parametrize("name", ["sliding_log", "gcra", "sliding_window"])
+def test_strategy_allows_burst_up_to_limit(name):
+    decisions, _ = run_strategy(name, 3, 3600, [0.0, 1.0, 2.0, 3.0])
+    assert [allowed for allowed, _, _ in decisions] == [True, True, True, False]
+    assert [remaining for _, remaining, _ in decisions[:3]] == [2, 1, 0]
+    assert decisions[3][2] > 0
+
+def test_gcra_frees_one_slot_per_emission_interval():
+    decisions, tat = run_strategy("gcra", 2, 60, [0.0, 0.0, 29.0, 30.0])
+    assert [allowed for allowed, _, _ in decisions] == [True, True, False, True]
+    assert decisions[2][2] == pytest.approx(1.0)
+    assert RATE_LIMIT_STRATEGIES["gcra"].usage(tat, 2, 60, 30.0) == 2
+
+def test_sliding_window_weights_previous_window():
+    # 2 sends at the end of window [0, 60); halfway through the next window they still count as 1
+    decisions, state = run_strategy("sliding_window", 2, 60, [59.0, 59.5, 90.0, 90.5])
+    assert [allowed for allowed, _, _ in decisions] == [True, True, True, False]
+    assert RATE_LIMIT_STRATEGIES["sliding_window"].usage(state, 2, 60, 90.5) == 2
+
+def test_send_passes_configured_algorithm():
+    calls = []
+    class RecordingRepository(FakeRepository):
+        def try_acquire(self, recipient, notification_type, max_count, period, now, algorithm='sliding_log'):
+            calls.append(algorithm)
+            return super().try_acquire(recipient, notification_type, max_count, period, now, algorithm)
+    service = NotificationService(RecordingRepository(), {"status": (2, 60, "gcra"), "news": (1, 86400)})
+    service.send("status", "user1@example.com", "Status update 1")
+    service.send("news", "user1@example.com", "News update 1")
+    assert calls == ["gcra", "sliding_log"]
+
+class CountingRepository(FakeRepository):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def try_acquire(self, recipient, notification_type, max_count, period, now, algorithm='sliding_log'):
+        self.calls += 1
+        return super().try_acquire(recipient, notification_type, max_count, period, now, algorithm)
+
+def test_deny_cache_rejects_without_repository_call():
+    repository = CountingRepository()
+    service = NotificationService(repository, {"news": (1, 86400)}, DenyCache())
+    service.send("news", "user1@example.com", "News update 1")
+    for _ in range(3):
+        with pytest.raises(RateLimitExceededException) as exc_info:
+            service.send("news", "user1@example.com", "News update 2")
+        assert 0 < exc_info.value.retry_after <= 86400
+    assert repository.calls == 2
+
+def test_deny_cache_invalidated_when_limits_change():
+    repository = CountingRepository()
+    service = NotificationService(repository, {"news": (1, 86400)}, DenyCache())
+    service.send("news", "user1@example.com", "News update 1")
+    with pytest.raises(RateLimitExceededException):
+        service.send("news", "user1@example.com", "News update 2")
+    service.set_rate_limits({"news": (2, 86400)})
+    assert service.send("news", "user1@example.com", "News update 2") == 0
+
+def test_deny_cache_evicts_least_recently_used():
+    cache = DenyCache(max_size=2)
+    cache.block("user1@example.com", "news", 100.0)
+    cache.block("user2@example.com", "news", 100.0)
+    cache.block("user3@example.com", "news", 100.0)
+    assert cache.get("user1@example.com", "news", 0.0) is None
+    assert cache.get("user3@example.com", "news", 0.0) == 100.0
+    assert cache.get("user3@example.com", "news", 100.0) is None
+
+def test_all_windows_and_recipient_cap_checked_together():
+    repository = InMemoryRepository(eviction_interval=None)
+    service = NotificationService(repository, RuleTable(1, {
+        "status": RateLimitRule(2, 60, "sliding_log", ((3, 86400),)),
+        "news": RateLimitRule(5, 60),
+        "*": RateLimitRule(4, 86400),
+    }))
+    assert service.send("status", "user1@example.com", "Status update 1") == 1
+    service.send("status", "user1@example.com", "Status update 2")
+    with pytest.raises(RateLimitExceededException) as exc_info:
+        service.send("status", "user1@example.com", "Status update 3")
+    assert exc_info.value.rule == "status"
+
+    service.send("news", "user1@example.com", "News update 1")
+    service.send("news", "user1@example.com", "News update 2")
+    with pytest.raises(RateLimitExceededException) as exc_info:
+        service.send("news", "user1@example.com", "News update 3")
+    assert exc_info.value.rule == "*@86400"
+    assert str(exc_info.value) == "Rate limit exceeded for news to user1@example.com (*@86400 limit)"
+    # The denied send was not recorded in the windows that still had room
+    assert repository.get_all_usage("news") == {"user1@example.com:news": 2}
+
+    results = service.send_batch([("status", "user2@example.com", "Status update")] * 3)
+    assert results[:2] == [1, 0]
+    assert results[2].rule == "status"
@@ -0,0 +1,116 @@
+import pytest
+from datetime import datetime, timedelta
+from domain.notification import RateLimit
+from infrastructure.redis_repository import (
+    CompactKeyspace, RedisKeyspace, RedisRepository, create_keyspace, build_memory_report, merge_memory_reports,
+    type_codes
+)
+from infrastructure.async_redis_repository import AsyncRedisRepository
+
+NOW = datetime(2024, 1, 1)
+
+def test_compact_keys_have_fixed_length_and_share_the_hash_tag():
+    keyspace = CompactKeyspace("ratelimit")
+    short = keyspace.key("a@example.com", "status")
+    long = keyspace.key("a.very.long.recipient.address@subdomain.example.com", "status")
+    assert len(short) == len(long) == len("ratelimit:{}:") + 16 + 4
+    assert keyspace.key("a@example.com", "status@86400") == short + "@86400"
+
+    limits = (RateLimit("status", 2, 60, "sliding_log"), RateLimit("*@86400", 50, 86400, "sliding_log"))
+    keys, args = keyspace.acquire_call("a@example.com", limits, 1700000000.0, 1700000000.0)
+    assert keys == [short, keyspace.key("a@example.com", "*@86400"), keyspace.directory("a@example.com")]
+    assert all(key.startswith(keyspace.directory("a@example.com")) for key in keys)
+    assert args[-5:] == ["a@example.com", keyspace.code("status"), "status", keyspace.code("*@86400"), "*@86400"]
+
+def test_compact_usage_keys_are_named_from_the_directory():
+    keyspace = CompactKeyspace("ratelimit")
+    keys = [keyspace.key("a@example.com", "status"), keyspace.key("b@example.com", "news")]
+    assert keyspace.directories(keys) == [
+        (keyspace.directory("a@example.com"), keyspace.code("status")),
+        (keyspace.directory("b@example.com"), keyspace.code("news")),
+    ]
+    names = [["a@example.com", "status"], [None, None]]
+    token = keyspace.token("b@example.com")
+    assert keyspace.usage_keys(keys, names) == ["a@example.com:status", f"{token}:{keyspace.code('news')}"]
+
+    assert keyspace.layout(keys[0]) == "compact"
+    assert keyspace.layout(keyspace.directory("a@example.com")) == "directory"
+    assert keyspace.layout(RedisKeyspace("ratelimit").key("a@example.com", "status")) == "plain"
+
+def test_memory_reports_group_by_layout_and_merge_across_nodes():
+    keyspace = CompactKeyspace("ratelimit")
+    keys = [keyspace.key("a@example.com", "status"), keyspace.directory("a@example.com"), "ratelimit:{a@example.com}:news"]
+    report = build_memory_report(keyspace, keys + ["expired"], [80, 90, 150, None], 1000, 4)
+    assert report["layouts"] == {
+        "compact": {"keys": 1, "bytes": 80}, "directory": {"keys": 1, "bytes": 90}, "plain": {"keys": 1, "bytes": 150}
+    }
+    assert (report["sampled_keys"], report["sampled_bytes"]) == (3, 320)
+
+    merged = merge_memory_reports([report, report])
+    assert (merged["used_memory"], merged["db_keys"], merged["sampled_keys"]) == (2000, 8, 6)
+    assert merged["layouts"]["plain"] == {"keys": 2, "bytes": 300}
+
+def test_unknown_key_encoding_is_rejected():
+    assert create_keyspace("ratelimit", "compact").encoding == "compact"
+    with pytest.raises(ValueError):
+        create_keyspace("ratelimit", "gzip")
+
+def test_type_filters_are_checked_against_configured_types_without_being_stored():
+    # type622 and type1160 share the key code S0pe
+    with pytest.raises(ValueError):
+        type_codes(["type622", "type1160"])
+    keyspace = CompactKeyspace("ratelimit")
+    assert keyspace.code("type1160@60") == "S0pe@60"
+    keyspace.register(["status", "type622"])
+    with pytest.raises(ValueError):
+        keyspace.matches("type1160")
+    for index in range(100):
+        keyspace.usage_matches(f"filter{index}")
+    assert keyspace._types == type_codes(["status", "type622"])
+
+def test_migration_moves_plain_keys_once_and_keeps_their_counters(redis_pool):
+    # Usage is reported at the current time, which GCRA state must not have left behind yet
+    now = datetime.now()
+    plain = RedisRepository(connection_pool=redis_pool)
+    limits = (RateLimit("status", 2, 60, "sliding_log"), RateLimit("status@86400", 10, 86400, "sliding_log"))
+    for second in range(2):
+        plain.try_acquire_limits("user1@example.com", limits, now + timedelta(seconds=second))
+    plain.try_acquire("user2@example.com", "news", 3, 3600, now, "gcra")
+    usage = plain.get_all_usage()
+    assert usage == {"user1@example.com:status": 2, "user1@example.com:status@86400": 2, "user2@example.com:news": 1}
+
+    compact = RedisRepository(connection_pool=redis_pool, key_encoding="compact")
+    compact.register_types(["status", "news"])
+    assert compact.migrate_keys() == 3
+    assert compact.get_all_usage() == usage
+    assert not list(compact.redis_client.scan_iter(match=compact.keyspace.plain_match()))
+    status_key = compact.keyspace.key("user1@example.com", "status")
+    assert 0 < compact.redis_client.ttl(status_key) <= 60
+    assert compact.try_acquire_limits("user1@example.com", limits, now + timedelta(seconds=2))[:2] == (False, 0)
+
+    assert compact.migrate_keys() == 0
+    assert compact.get_all_usage() == usage
+
+@pytest.mark.asyncio
+async def test_compact_usage_is_named_from_the_directory_and_cleared_by_type(async_redis_pool):
+    repository = AsyncRedisRepository(connection_pool=async_redis_pool, key_encoding="compact")
+    repository.register_types(["status", "news", "type622"])
+    for recipient, notification_type in (("user1@example.com", "status"), ("user1@example.com", "news"),
+                                         ("user2@example.com", "status")):
+        await repository.try_acquire(recipient, notification_type, 5, 60, NOW)
+    assert await repository.get_all_usage() == {
+        "user1@example.com:status": 1, "user1@example.com:news": 1, "user2@example.com:status": 1
+    }
+    assert await repository.get_all_usage(recipient_prefix="user1") == {
+        "user1@example.com:status": 1, "user1@example.com:news": 1
+    }
+    assert await repository.get_all_usage("status") == {"user1@example.com:status": 1, "user2@example.com:status": 1}
+    with pytest.raises(ValueError):
+        await repository.get_all_usage("type1160")
+
+    assert await repository.clear_all_notifications("status") == 2
+    assert await repository.get_all_usage() == {"user1@example.com:news": 1}
+    # The news key and both directories
+    assert await repository.clear_all_notifications() == 3
+    assert await repository.redis_client.dbsize() == 0
+    await repository.close()
@@ -0,0 +1,245 @@
+import fakeredis
+import pytest
+import redis
+import redis.asyncio
+from datetime import datetime, timedelta
+from app.config import load_redis_settings
+from domain.notification import ALL_TYPES, RateLimitRule, RuleTable
+from infrastructure.redis_repository import RedisRepository, create_connection_pool, pool_stats, sum_pool_stats
+from infrastructure.async_redis_repository import AsyncRedisRepository
+from infrastructure.memory_repository import InMemoryRepository
+
+NOW = datetime(2024, 1, 1)
+
+def at(seconds):
+    return NOW + timedelta(seconds=seconds)
+
+def test_try_acquire_allows_until_the_limit_then_reports_retry_after(redis_pool):
+    repository = RedisRepository(connection_pool=redis_pool)
+    assert repository.try_acquire("user1@example.com", "status", 2, 60, at(0)) == (True, 1, 0.0)
+    assert repository.try_acquire("user1@example.com", "status", 2, 60, at(10)) == (True, 0, 0.0)
+    # The oldest entry leaves the window 60s after it was recorded
+    assert repository.try_acquire("user1@example.com", "status", 2, 60, at(20)) == (False, 0, 40.0)
+    assert repository.redis_client.zcard("ratelimit:{user1@example.com}:status") == 2
+    assert repository.try_acquire("user1@example.com", "status", 2, 60, at(60)) == (True, 0, 0.0)
+    assert 0 < repository.redis_client.ttl("ratelimit:{user1@example.com}:status") <= 60
+
+def test_try_acquire_many_counts_requests_against_each_other(redis_pool):
+    repository = RedisRepository(connection_pool=redis_pool)
+    decisions = repository.try_acquire_many([
+        ("user1@example.com", "status", 2, 60, "sliding_log"),
+        ("user1@example.com", "status", 2, 60, "sliding_log"),
+        ("user1@example.com", "status", 2, 60, "sliding_log"),
+        ("user2@example.com", "status", 2, 60, "sliding_log"),
+    ], at(0))
+    assert decisions == [(True, 1, 0.0), (True, 0, 0.0), (False, 0, 60.0), (True, 1, 0.0)]
+    # Entries recorded at the same instant are counted separately
+    assert repository.redis_client.zcard("ratelimit:{user1@example.com}:status") == 2
+
+@pytest.mark.asyncio
+async def test_async_try_acquire_allows_until_the_limit_then_reports_retry_after(async_redis_pool):
+    repository = AsyncRedisRepository(connection_pool=async_redis_pool)
+    assert await repository.try_acquire("user1@example.com", "news", 1, 86400, at(0)) == (True, 0, 0.0)
+    assert await repository.try_acquire("user1@example.com", "news", 1, 86400, at(3600)) == (False, 0, 82800.0)
+    await repository.close()
+
+@pytest.mark.asyncio
+async def test_async_try_acquire_many_counts_requests_against_each_other(async_redis_pool):
+    repository = AsyncRedisRepository(connection_pool=async_redis_pool)
+    decisions = await repository.try_acquire_many([
+        ("user1@example.com", "news", 1, 86400, "sliding_log"),
+        ("user1@example.com", "news", 1, 86400, "sliding_log"),
+        ("user1@example.com", "status", 1, 60, "sliding_log"),
+    ], at(0))
+    assert decisions == [(True, 0, 0.0), (False, 0, 86400.0), (True, 0, 0.0)]
+    await repository.close()
+
+def test_gcra_allows_a_burst_then_one_per_interval(redis_pool):
+    repository = RedisRepository(connection_pool=redis_pool)
+    key = "ratelimit:{user1@example.com}:status"
+    burst = [repository.try_acquire("user1@example.com", "status", 4, 60, at(0), "gcra") for _ in range(4)]
+    assert burst == [(True, 3, 0.0), (True, 2, 0.0), (True, 1, 0.0), (True, 0, 0.0)]
+    assert repository.try_acquire("user1@example.com", "status", 4, 60, at(1), "gcra") == (False, 0, 14.0)
+    # The key lives until the theoretical arrival time, 60s after a full burst
+    assert 59000 < repository.redis_client.pttl(key) <= 60000
+
+    # Steady rate: one notification per 60 / 4 seconds
+    assert repository.try_acquire("user1@example.com", "status", 4, 60, at(15), "gcra") == (True, 0, 0.0)
+    assert repository.try_acquire("user1@example.com", "status", 4, 60, at(16), "gcra") == (False, 0, 14.0)
+    assert repository.try_acquire("user1@example.com", "status", 4, 60, at(30), "gcra") == (True, 0, 0.0)
+    # After a full idle period the whole burst is available again
+    assert repository.try_acquire("user1@example.com", "status", 4, 60, at(200), "gcra") == (True, 3, 0.0)
+
+def test_sliding_window_weights_the_previous_window(redis_pool):
+    repository = RedisRepository(connection_pool=redis_pool)
+    key = "ratelimit:{user1@example.com}:status"
+    start = -(NOW.timestamp() % 60)
+    burst = [repository.try_acquire("user1@example.com", "status", 4, 60, at(start), "sliding_window") for _ in range(4)]
+    assert [remaining for _, remaining, _ in burst] == [3, 2, 1, 0]
+    # A full window drains once its weight in the next window falls to 3 / 4, 15s into it
+    assert repository.try_acquire("user1@example.com", "status", 4, 60, at(start + 1), "sliding_window") == (False, 0, 74.0)
+    assert 119 < repository.redis_client.ttl(key) <= 120
+
+    # Rollover: the previous window counts for the part of it still inside the sliding period
+    assert repository.try_acquire("user1@example.com", "status", 4, 60, at(start + 75), "sliding_window") == (True, 0, 0.0)
+    assert repository.redis_client.hmget(key, "c", "p") == ["1", "4"]
+    assert repository.try_acquire("user1@example.com", "status", 4, 60, at(start + 76), "sliding_window") == (False, 0, 14.0)
+    # Steady rate: the previous window's weight keeps falling
+    assert repository.try_acquire("user1@example.com", "status", 4, 60, at(start + 90), "sliding_window") == (True, 0, 0.0)
+    # Two windows later nothing is carried over
+    assert repository.try_acquire("user1@example.com", "status", 4, 60, at(start + 300), "sliding_window") == (True, 3, 0.0)
+
+RULES = RuleTable(1, {
+    "status": RateLimitRule(3, 60, windows=((10, 86400),)),
+    "news": RateLimitRule(5, 3600),
+    ALL_TYPES: RateLimitRule(4, 86400),
+})
+
+def test_denied_window_records_in_none_of_the_others(redis_pool):
+    repository = RedisRepository(connection_pool=redis_pool)
+    status, news = RULES.limits("status"), RULES.limits("news")
+    assert [limit.scope for limit in status] == ["status", "status@86400", "*@86400"]
+    decisions = [repository.try_acquire_limits("user1@example.com", status, at(second)) for second in range(3)]
+    assert decisions == [(True, 2, 0.0, None), (True, 1, 0.0, None), (True, 0, 0.0, None)]
+
+    # The per-minute window denies; the daily windows must not count the attempt
+    assert repository.try_acquire_limits("user1@example.com", status, at(3)) == (False, 0, 57.0, 0)
+    client = repository.redis_client
+    keys = {scope: f"ratelimit:{{user1@example.com}}:{scope}" for scope in ("status", "status@86400", "*@86400", "news")}
+    assert [client.zcard(keys[scope]) for scope in ("status", "status@86400", "*@86400")] == [3, 3, 3]
+
+    # The cross-type window is shared with news and denies the second news notification
+    assert repository.try_acquire_limits("user1@example.com", news, at(4)) == (True, 0, 0.0, None)
+    assert repository.try_acquire_limits("user1@example.com", news, at(5)) == (False, 0, 86400.0 - 5, 1)
+    assert (client.zcard(keys["news"]), client.zcard(keys["*@86400"])) == (1, 4)
+
+    # Every window key expires with its own period
+    assert 0 < client.ttl(keys["status"]) <= 60
+    assert 3600 < client.ttl(keys["status@86400"]) <= 86400
+    assert 3600 < client.ttl(keys["*@86400"]) <= 86400
+    assert 60 < client.ttl(keys["news"]) <= 3600
+
+@pytest.mark.asyncio
+async def test_async_batch_checks_every_window_of_each_recipient(async_redis_pool):
+    repository = AsyncRedisRepository(connection_pool=async_redis_pool)
+    decisions = await repository.try_acquire_limits_many(
+        [("user1@example.com", RULES.limits("news"))] * 5 + [("user1@example.com", RULES.limits("status"))], at(0)
+    )
+    assert [decision[0] for decision in decisions] == [True, True, True, True, False, False]
+    assert [decision[3] for decision in decisions[4:]] == [1, 2]
+    assert await repository.redis_client.zcard("ratelimit:{user1@example.com}:news") == 4
+    assert not await repository.redis_client.exists(
+        "ratelimit:{user1@example.com}:status", "ratelimit:{user1@example.com}:status@86400"
+    )
+    await repository.close()
+
+def fill(repository, recipients=10):
+    for index in range(recipients):
+        recipient = f"user{index}@example.com"
+        repository.try_acquire_limits(recipient, RULES.limits("status"), at(0))
+        repository.try_acquire(recipient, "statusx", 5, 60, at(0))
+
+def test_clear_by_type_removes_its_windows_only(redis_pool):
+    repository = RedisRepository(connection_pool=redis_pool, clear_chunk_size=3)
+    fill(repository)
+    progress = []
+    # status and status@86400 of every recipient; not the cross-type window or the statusx type
+    assert repository.clear_all_notifications("status", progress.append) == 20
+    assert progress == sorted(progress) and progress[-1] == 20
+    remaining = repository.get_all_usage()
+    assert len(remaining) == 20 and not any(key.endswith((":status", ":status@86400")) for key in remaining)
+
+    assert repository.clear_all_notifications() == 20
+    assert repository.redis_client.dbsize() == 0
+
+@pytest.mark.asyncio
+async def test_clear_escapes_glob_characters_of_the_prefix(redis_pool, async_redis_pool):
+    fill(RedisRepository(connection_pool=redis_pool, key_prefix="rate*limit"), 2)
+    fill(RedisRepository(connection_pool=redis_pool, key_prefix="rate-x-limit"), 3)
+    repository = AsyncRedisRepository(connection_pool=async_redis_pool, key_prefix="rate*limit", clear_chunk_size=2)
+    assert await repository.clear_all_notifications() == 2 * 4
+    assert await repository.clear_all_notifications() == 0
+    assert await repository.redis_client.dbsize() == 3 * 4
+    await repository.close()
+
+def test_usage_pages_through_every_key(redis_pool):
+    repository = RedisRepository(connection_pool=redis_pool)
+    repository.try_acquire_many([(f"user{index}@example.com", "status", 5, 60, "sliding_log") for index in range(250)], datetime.now())
+    cursor, paged, pages = 0, {}, 0
+    while True:
+        cursor, usage = repository.scan_usage(cursor, 20)
+        # SCAN may return a key twice; its count is the same on both pages
+        assert all(paged.get(key, count) == count for key, count in usage.items())
+        paged.update(usage)
+        pages += 1
+        if cursor == 0:
+            break
+    assert pages > 1
+    assert paged == repository.get_all_usage() == {f"user{index}@example.com:status": 1 for index in range(250)}
+
+def test_pool_stats_count_connections_of_the_pinned_redis_py(redis_server):
+    # The counts read private pool attributes; revisit pool_stats when upgrading redis-py
+    assert redis.__version__ == "5.0.8"
+    for pool_class in (redis.ConnectionPool, redis.BlockingConnectionPool):
+        pool = pool_class(connection_class=fakeredis.FakeRedisConnection, server=redis_server, max_connections=5)
+        repository = RedisRepository(connection_pool=pool)
+        connections = [pool.get_connection("PING") for _ in range(2)]
+        pool.release(connections[0])
+        assert repository.pool_stats() == {
+            "max_connections": 5, "created_connections": 2, "idle_connections": 1, "in_use_connections": 1
+        }
+        pool.release(connections[1])
+
+@pytest.mark.asyncio
+async def test_async_pool_stats_count_connections_of_the_pinned_redis_py(redis_server):
+    assert redis.__version__ == "5.0.8"
+    for pool_class in (redis.asyncio.ConnectionPool, redis.asyncio.BlockingConnectionPool):
+        pool = pool_class(connection_class=fakeredis.FakeAsyncRedisConnection, server=redis_server, max_connections=5)
+        repository = AsyncRedisRepository(connection_pool=pool)
+        connections = [await pool.get_connection("PING") for _ in range(2)]
+        await pool.release(connections[0])
+        assert repository.pool_stats() == {
+            "max_connections": 5, "created_connections": 2, "idle_connections": 1, "in_use_connections": 1
+        }
+        await pool.release(connections[1])
+        await repository.close()
+
+def test_pool_stats_without_known_counters_report_the_size_only():
+    class Pool:
+        max_connections = 5
+    assert pool_stats(Pool()) == {
+        "max_connections": 5, "created_connections": None, "idle_connections": None, "in_use_connections": None
+    }
+    assert sum_pool_stats([pool_stats(Pool()), {
+        "max_connections": 5, "created_connections": 2, "idle_connections": 1, "in_use_connections": 1
+    }]) == {"max_connections": 10, "created_connections": None, "idle_connections": None, "in_use_connections": None}
+
+@pytest.mark.parametrize("key_encoding", ["plain", "compact"])
+def test_filtered_usage_matches_the_memory_backend(redis_pool, key_encoding):
+    # Usage is reported at the current time
+    now = datetime.now()
+    memory = InMemoryRepository(eviction_interval=None)
+    repository = RedisRepository(connection_pool=redis_pool, key_encoding=key_encoding, clear_chunk_size=2)
+    repository.register_types(RULES)
+    for backend in (memory, repository):
+        for index in range(5):
+            backend.try_acquire_limits(f"user{index}@example.com", RULES.limits("status"), now)
+        backend.try_acquire_limits("admin@example.com", RULES.limits("news"), now)
+    for notification_type, recipient_prefix in (("status", None), (ALL_TYPES, None), ("news", "admin"), (None, "user1")):
+        usage = dict(repository.iter_usage(notification_type, recipient_prefix, count=2))
+        assert usage == memory.get_all_usage(notification_type, recipient_prefix)
+    assert set(repository.get_all_usage("status")) == {
+        f"user{index}@example.com:{scope}" for index in range(5) for scope in ("status", "status@86400")
+    }
+    memory.close()
+
+def test_connection_pool_builder_serves_the_sync_and_async_clients():
+    settings = load_redis_settings()
+    pool = create_connection_pool(settings, host="redis-b", port=6380)
+    assert isinstance(pool, redis.BlockingConnectionPool)
+    assert (pool.connection_kwargs["host"], pool.connection_kwargs["port"], pool.max_connections) == (
+        "redis-b", 6380, settings.max_connections
+    )
+    async_pool = create_connection_pool(settings, redis_module=redis.asyncio)
+    assert isinstance(async_pool, redis.asyncio.BlockingConnectionPool)
+    assert async_pool.connection_kwargs["host"] == settings.host and async_pool.timeout == settings.pool_timeout
@@ -0,0 +1,45 @@
+import pytest
+import redis.asyncio as redis
+from domain.notification import NotificationService, RateLimitRule, RuleTable
+from infrastructure.rule_store import InMemoryRuleStore, RedisRuleStore, encode_rule, decode_rule
+
+def test_rule_table_is_immutable_and_compiled():
+    table = RuleTable(3, {"status": (2, 60), "alerts": (5, 10, "gcra")})
+    assert table.version == 3
+    assert table["status"] == RateLimitRule(2, 60, "sliding_log")
+    assert table["alerts"].algorithm == "gcra"
+    with pytest.raises(TypeError):
+        table._rules["status"] = RateLimitRule(1, 1)
+
+def test_rule_encoding_round_trip():
+    for rule in (RateLimitRule(5, 10, "gcra"), RateLimitRule(2, 60, "sliding_log", ((20, 86400),)),
+                 RateLimitRule(1, 86400, "gcra", defer=True)):
+        assert RateLimitRule(*decode_rule(encode_rule(rule))) == rule
+
+@pytest.mark.asyncio
+async def test_in_memory_rule_store_versions_updates():
+    store = InMemoryRuleStore()
+    table = await store.seed({"status": RateLimitRule(2, 60)})
+    assert (table.version, list(table)) == (1, ["status"])
+    assert (await store.seed({"news": RateLimitRule(1, 86400)})).version == 1
+
+    table = await store.update({"alerts": RateLimitRule(5, 10, "gcra"), "status": None})
+    assert table.version == 2
+    assert dict(table) == {"alerts": RateLimitRule(5, 10, "gcra")}
+
+def test_service_accepts_arbitrary_types_from_rule_table():
+    class AllowAllRepository:
+        def try_acquire(self, recipient, notification_type, max_count, period, now, algorithm='sliding_log'):
+            return True, max_count - 1, 0.0
+    service = NotificationService(AllowAllRepository(), RuleTable(1, {"alerts": (5, 10, "gcra")}))
+    assert service.send("alerts", "user1@example.com", "Disk almost full") == 4
+    with pytest.raises(ValueError):
+        service.send("status", "user1@example.com", "Status update 1")
+
+@pytest.mark.asyncio
+async def test_update_with_expected_version_is_a_compare_and_set(async_redis_pool):
+    for store in (InMemoryRuleStore(), RedisRuleStore(redis.StrictRedis(connection_pool=async_redis_pool))):
+        table = await store.seed({"status": RateLimitRule(2, 60)})
+        assert (await store.update({"news": RateLimitRule(1, 86400)}, table.version)).version == table.version + 1
+        assert await store.update({"status": None}, table.version) is None
+        assert dict(await store.load()) == {"status": RateLimitRule(2, 60), "news": RateLimitRule(1, 86400)}
@@ -0,0 +1,79 @@
+import fakeredis
+import pytest
+import redis.asyncio
+from datetime import datetime
+from infrastructure.memory_repository import AsyncInMemoryRepository
+from infrastructure.redis_repository import RedisKeyspace
+from infrastructure.async_redis_repository import AsyncRedisRepository
+from infrastructure.sharded_repository import HashRing, AsyncShardedRedisRepository
+
+NODES = ["redis-a:6379", "redis-b:6379", "redis-c:6379"]
+RECIPIENTS = [f"user{index}@example.com" for index in range(300)]
+
+def test_keyspace_hash_tags_recipient():
+    keyspace = RedisKeyspace("ratelimit")
+    key = keyspace.key("user1@example.com", "status")
+    assert key == "ratelimit:{user1@example.com}:status"
+    assert keyspace.usage_key(key) == "user1@example.com:status"
+    assert keyspace.usage_matches("status", "user1") == ["ratelimit:{user1*}:status", "ratelimit:{user1*}:status@*"]
+
+def test_hash_ring_spreads_and_mostly_keeps_recipients():
+    ring = HashRing(NODES)
+    placement = {recipient: ring.node(recipient) for recipient in RECIPIENTS}
+    assert set(placement.values()) == {0, 1, 2}
+
+    grown = HashRing(NODES + ["redis-d:6379"])
+    moved = sum(1 for recipient, node in placement.items() if grown.node(recipient) != node)
+    assert moved < len(RECIPIENTS) / 2
+
+@pytest.mark.asyncio
+async def test_sharded_repository_routes_and_fans_out():
+    repository = AsyncShardedRedisRepository([AsyncInMemoryRepository(eviction_interval=0) for _ in NODES], NODES)
+    now = datetime.now()
+    decisions = await repository.try_acquire_many([(recipient, "status", 1, 60, "sliding_log") for recipient in RECIPIENTS], now)
+    assert all(allowed for allowed, _, _ in decisions)
+    assert (await repository.try_acquire(RECIPIENTS[0], "status", 1, 60, now))[0] is False
+    assert await repository.shard(RECIPIENTS[0]).get_all_usage(recipient_prefix=RECIPIENTS[0]) == {f"{RECIPIENTS[0]}:status": 1}
+    assert sum([len(await shard.get_all_usage()) for shard in repository.shards]) == len(RECIPIENTS)
+
+    assert len(await repository.get_all_usage("status")) == len(RECIPIENTS)
+    cursor, paged = 0, {}
+    while True:
+        cursor, usage = await repository.scan_usage(cursor, 50, "status")
+        paged.update(usage)
+        if cursor == 0:
+            break
+    assert len(paged) == len(RECIPIENTS)
+    assert await repository.clear_all_notifications() == len(RECIPIENTS)
+    await repository.close()
+
+@pytest.mark.asyncio
+async def test_async_sharded_repository_keeps_batch_order():
+    repository = AsyncShardedRedisRepository([AsyncInMemoryRepository(eviction_interval=0) for _ in NODES], NODES)
+    now = datetime.now()
+    requests = [(recipient, "status", 1, 60, "sliding_log") for recipient in RECIPIENTS[:10]]
+    decisions = await repository.try_acquire_many(requests + requests[:1], now)
+    assert [allowed for allowed, _, _ in decisions] == [True] * 10 + [False]
+    assert len([item async for item in repository.iter_usage("status")]) == 10
+    assert await repository.clear_all_notifications("status") == 10
+    await repository.close()
+
+@pytest.mark.asyncio
+async def test_async_sharded_usage_pages_through_real_scan_cursors():
+    repository = AsyncShardedRedisRepository([
+        AsyncRedisRepository(connection_pool=redis.asyncio.ConnectionPool(
+            connection_class=fakeredis.FakeAsyncRedisConnection, server=fakeredis.FakeServer(), decode_responses=True
+        )) for _ in NODES
+    ], NODES)
+    await repository.try_acquire_many([(recipient, "status", 5, 60, "sliding_log") for recipient in RECIPIENTS], datetime.now())
+    cursor, paged, shards = 0, {}, set()
+    while True:
+        shards.add(cursor % len(NODES))
+        cursor, usage = await repository.scan_usage(cursor, 25, "status")
+        paged.update(usage)
+        if cursor == 0:
+            break
+    assert shards == {0, 1, 2}
+    assert paged == {f"{recipient}:status": 1 for recipient in RECIPIENTS}
+    assert len([item async for item in repository.iter_usage("status", count=25)]) == len(RECIPIENTS)
+    await repository.close()